@@ -0,0 +1,51 @@
+"""add pdf_jobs table
+
+Revision ID: 3f9a2c7e1b4d
+Revises: 18bc99b23942
+Create Date: 2025-06-02 10:12:41.518203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9a2c7e1b4d'
+down_revision: Union[str, None] = '18bc99b23942'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('pdf_jobs',
+    sa.Column('id', sa.UUID(), nullable=False),
+    sa.Column('user_id', sa.UUID(), nullable=False),
+    sa.Column('preventivo_id', sa.UUID(), nullable=False),
+    sa.Column('template_id', sa.UUID(), nullable=True),
+    sa.Column('stato', sa.String(length=20), nullable=False),
+    sa.Column('tentativi', sa.Integer(), nullable=False),
+    sa.Column('errore', sa.Text(), nullable=True),
+    sa.Column('nome_file', sa.String(length=255), nullable=True),
+    sa.Column('pdf', sa.LargeBinary(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['preventivo_id'], ['preventivi.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['template_id'], ['document_templates.id'], ondelete='SET NULL'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_pdf_jobs_id'), 'pdf_jobs', ['id'], unique=False)
+    op.create_index(op.f('ix_pdf_jobs_preventivo_id'), 'pdf_jobs', ['preventivo_id'], unique=False)
+    op.create_index('ix_pdf_jobs_stato_created_at', 'pdf_jobs', ['stato', 'created_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_pdf_jobs_stato_created_at', table_name='pdf_jobs')
+    op.drop_index(op.f('ix_pdf_jobs_preventivo_id'), table_name='pdf_jobs')
+    op.drop_index(op.f('ix_pdf_jobs_id'), table_name='pdf_jobs')
+    op.drop_table('pdf_jobs')
@@ -0,0 +1,55 @@
+"""add preventivi summary columns
+
+Revision ID: 7c1d8e2a9f35
+Revises: 3f9a2c7e1b4d
+Create Date: 2025-06-04 09:31:17.204558
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c1d8e2a9f35'
+down_revision: Union[str, None] = '3f9a2c7e1b4d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('preventivi', sa.Column('nome_cliente', sa.String(length=500), nullable=True))
+    op.add_column('preventivi', sa.Column('valore_totale_lordo', sa.Numeric(precision=14, scale=2), nullable=True))
+    op.add_column('preventivi', sa.Column('data_emissione', sa.Date(), nullable=True))
+    op.add_column('preventivi', sa.Column('data_scadenza', sa.Date(), nullable=True))
+
+    # Backfill dai documenti JSONB esistenti
+    op.execute("""
+        UPDATE preventivi SET
+            nome_cliente = left(dati_preventivo #>> '{cliente_destinatario,nome_cliente}', 500),
+            valore_totale_lordo = CASE
+                WHEN jsonb_typeof(dati_preventivo #> '{dettagli_totali,totale_generale_lordo}') = 'number'
+                THEN (dati_preventivo #>> '{dettagli_totali,totale_generale_lordo}')::numeric(14, 2)
+            END,
+            data_emissione = CASE
+                WHEN dati_preventivo #>> '{metadati_preventivo,data_emissione}' ~ '^\\d{4}-\\d{2}-\\d{2}'
+                THEN left(dati_preventivo #>> '{metadati_preventivo,data_emissione}', 10)::date
+            END,
+            data_scadenza = CASE
+                WHEN dati_preventivo #>> '{metadati_preventivo,data_scadenza}' ~ '^\\d{4}-\\d{2}-\\d{2}'
+                THEN left(dati_preventivo #>> '{metadati_preventivo,data_scadenza}', 10)::date
+            END
+    """)
+
+    op.create_index('ix_preventivi_user_stato_updated_at', 'preventivi', ['user_id', 'stato_record', 'updated_at'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_preventivi_user_stato_updated_at', table_name='preventivi')
+    op.drop_column('preventivi', 'data_scadenza')
+    op.drop_column('preventivi', 'data_emissione')
+    op.drop_column('preventivi', 'valore_totale_lordo')
+    op.drop_column('preventivi', 'nome_cliente')
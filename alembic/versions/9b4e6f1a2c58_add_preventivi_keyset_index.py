@@ -0,0 +1,32 @@
+"""add preventivi keyset index
+
+Revision ID: 9b4e6f1a2c58
+Revises: 7c1d8e2a9f35
+Create Date: 2025-06-05 10:12:44.381920
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b4e6f1a2c58'
+down_revision: Union[str, None] = '7c1d8e2a9f35'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # La paginazione keyset ordina per (updated_at DESC, id DESC): l'indice ascendente
+    # (updated_at, id), letto all'indietro, restituisce esattamente quell'ordine
+    op.drop_index('ix_preventivi_user_stato_updated_at', table_name='preventivi')
+    op.create_index('ix_preventivi_user_stato_updated_at_id', 'preventivi', ['user_id', 'stato_record', 'updated_at', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_preventivi_user_stato_updated_at_id', table_name='preventivi')
+    op.create_index('ix_preventivi_user_stato_updated_at', 'preventivi', ['user_id', 'stato_record', 'updated_at'], unique=False)
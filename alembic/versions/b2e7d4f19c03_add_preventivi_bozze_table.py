@@ -0,0 +1,42 @@
+"""add preventivi_bozze table
+
+Revision ID: b2e7d4f19c03
+Revises: f41c7b9d2e68
+Create Date: 2025-06-09 16:03:18.274519
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b2e7d4f19c03'
+down_revision: Union[str, None] = 'f41c7b9d2e68'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('preventivi_bozze',
+    sa.Column('preventivo_id', sa.UUID(), nullable=False),
+    sa.Column('user_id', sa.UUID(), nullable=False),
+    sa.Column('dati_preventivo', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('hash_bozza', sa.String(length=64), nullable=True),
+    sa.Column('scadenza', sa.DateTime(), nullable=True),
+    sa.Column('hash_salvato', sa.String(length=64), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['preventivo_id'], ['preventivi.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('preventivo_id')
+    )
+    op.create_index(op.f('ix_preventivi_bozze_scadenza'), 'preventivi_bozze', ['scadenza'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_preventivi_bozze_scadenza'), table_name='preventivi_bozze')
+    op.drop_table('preventivi_bozze')
@@ -0,0 +1,69 @@
+"""add preventivi search and sort indexes
+
+Revision ID: d5a3c81f7e20
+Revises: 9b4e6f1a2c58
+Create Date: 2025-06-06 15:47:02.915334
+
+"""
+import logging
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5a3c81f7e20'
+down_revision: Union[str, None] = '9b4e6f1a2c58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Configurato da alembic.ini insieme ai log delle migrazioni
+logger = logging.getLogger("alembic.runtime.migration")
+
+
+# Stessa espressione di TESTO_RICERCA_PREVENTIVO in app/services/preventivo_service.py
+TESTO_RICERCA = (
+    "(numero_preventivo || E'\\n' || coalesce(nome_documento, '') || E'\\n' "
+    "|| oggetto_preventivo || E'\\n' || coalesce(nome_cliente, ''))"
+)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Ordinamenti della dashboard (ORDINAMENTI_PREVENTIVI): gli ordinamenti decrescenti
+    # usano (espressione DESC, id DESC), quindi leggono lo stesso indice all'indietro
+    op.create_index('ix_preventivi_user_stato_created_at_id', 'preventivi', ['user_id', 'stato_record', 'created_at', 'id'], unique=False)
+    op.create_index('ix_preventivi_user_stato_numero_id', 'preventivi', ['user_id', 'stato_record', 'numero_preventivo', 'id'], unique=False)
+    op.create_index(
+        'ix_preventivi_user_stato_cliente_id', 'preventivi',
+        ['user_id', 'stato_record', sa.text("coalesce(nome_cliente, '')"), 'id'], unique=False
+    )
+    op.create_index(
+        'ix_preventivi_user_stato_valore_id', 'preventivi',
+        ['user_id', 'stato_record', sa.text('coalesce(valore_totale_lordo, 0)'), 'id'], unique=False
+    )
+    # Filtro per intervallo di date di emissione
+    op.create_index('ix_preventivi_user_stato_data_emissione', 'preventivi', ['user_id', 'stato_record', 'data_emissione'], unique=False)
+
+    # Ricerca "contiene" (ILIKE '%termine%') con indice trigram, se l'estensione è installabile
+    bind = op.get_bind()
+    pg_trgm_disponibile = bind.execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar()
+    if pg_trgm_disponibile:
+        op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        op.execute(f"CREATE INDEX ix_preventivi_testo_ricerca_trgm ON preventivi USING gin ({TESTO_RICERCA} gin_trgm_ops)")
+    else:
+        # La ricerca funziona comunque, scorrendo i preventivi dell'utente
+        logger.warning("Estensione pg_trgm non disponibile, la ricerca dei preventivi non sarà indicizzata")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP INDEX IF EXISTS ix_preventivi_testo_ricerca_trgm")
+    op.drop_index('ix_preventivi_user_stato_data_emissione', table_name='preventivi')
+    op.drop_index('ix_preventivi_user_stato_valore_id', table_name='preventivi')
+    op.drop_index('ix_preventivi_user_stato_cliente_id', table_name='preventivi')
+    op.drop_index('ix_preventivi_user_stato_numero_id', table_name='preventivi')
+    op.drop_index('ix_preventivi_user_stato_created_at_id', table_name='preventivi')
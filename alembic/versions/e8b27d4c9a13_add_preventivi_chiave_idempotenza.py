@@ -0,0 +1,50 @@
+"""add preventivi chiave_idempotenza
+
+Revision ID: e8b27d4c9a13
+Revises: d5a3c81f7e20
+Create Date: 2025-06-07 11:20:36.448107
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8b27d4c9a13'
+down_revision: Union[str, None] = 'd5a3c81f7e20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('preventivi', sa.Column('chiave_idempotenza', sa.String(length=255), nullable=True))
+
+    # Backfill da metadati_preventivo.id_preventivo. L'UUID nullo (usato finora dal form
+    # per tutti i documenti) non identifica nulla e viene ignorato; se più preventivi
+    # condividono lo stesso id, la chiave va solo al più recente
+    op.execute("""
+        UPDATE preventivi p SET chiave_idempotenza = d.chiave
+          FROM (
+              SELECT id,
+                     dati_preventivo #>> '{metadati_preventivo,id_preventivo}' AS chiave,
+                     row_number() OVER (
+                         PARTITION BY user_id, dati_preventivo #>> '{metadati_preventivo,id_preventivo}'
+                         ORDER BY updated_at DESC NULLS LAST, id
+                     ) AS posizione
+                FROM preventivi
+               WHERE dati_preventivo #>> '{metadati_preventivo,id_preventivo}' IS NOT NULL
+                 AND dati_preventivo #>> '{metadati_preventivo,id_preventivo}' <> '00000000-0000-0000-0000-000000000000'
+          ) d
+         WHERE p.id = d.id AND d.posizione = 1
+    """)
+
+    op.create_unique_constraint('uq_preventivi_user_chiave_idempotenza', 'preventivi', ['user_id', 'chiave_idempotenza'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('uq_preventivi_user_chiave_idempotenza', 'preventivi', type_='unique')
+    op.drop_column('preventivi', 'chiave_idempotenza')
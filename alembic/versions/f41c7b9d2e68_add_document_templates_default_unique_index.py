@@ -0,0 +1,45 @@
+"""add document_templates default unique index
+
+Revision ID: f41c7b9d2e68
+Revises: e8b27d4c9a13
+Create Date: 2025-06-08 10:12:44.913205
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f41c7b9d2e68'
+down_revision: Union[str, None] = 'e8b27d4c9a13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Default duplicati creati da richieste concorrenti: resta default solo il più recente
+    op.execute("""
+        UPDATE document_templates t SET is_default = false
+          FROM (
+                SELECT id, row_number() OVER (
+                           PARTITION BY user_id, document_type
+                           ORDER BY updated_at DESC NULLS LAST, created_at DESC NULLS LAST
+                       ) AS posizione
+                  FROM document_templates
+                 WHERE is_default
+               ) d
+         WHERE t.id = d.id AND d.posizione > 1
+    """)
+
+    op.create_index(
+        'uq_document_templates_user_tipo_default', 'document_templates', ['user_id', 'document_type'],
+        unique=True, postgresql_where=sa.text('is_default')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('uq_document_templates_user_tipo_default', table_name='document_templates')
@@ -1,8 +1,20 @@
-from sqlalchemy import create_engine
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 import os
 from dotenv import load_dotenv
+from fastapi import Query
+
+from .services.metriche import registro_metriche
+
+# Setup logger
+logger = logging.getLogger(__name__)
 
 # Carica le variabili d'ambiente dal file .env
 load_dotenv()
@@ -13,6 +25,13 @@ load_dotenv()
 # e i test dovrebbero sempre girare su PostgreSQL.
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./preventivi_dev_fallback.db")
 
+# Replica in sola lettura (opzionale) per le liste, il caricamento dei preventivi da
+# visualizzare o esportare, le cartelle e i template: vedi SessioneLetture
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL", "")
+# Secondi dopo una scrittura di un utente in cui le sue letture restano sul primario
+# (read-your-writes): deve superare il ritardo di replica
+REPLICA_FINESTRA_SCRITTURA = float(os.getenv("REPLICA_FINESTRA_SCRITTURA", "5"))
+
 connect_args = {}
 # Argomenti specifici per SQLite
 if DATABASE_URL.startswith("sqlite"):
@@ -20,12 +39,241 @@ if DATABASE_URL.startswith("sqlite"):
     print("ATTENZIONE: Connessione a SQLite. I modelli sono ottimizzati per PostgreSQL.")
     print("           Questa modalità è per sviluppo rapido, non per testing completo o produzione.")
 
+# Pool di connessioni (PostgreSQL; SQLite usa quello di default). Ogni worker uvicorn ha i suoi pool,
+# uno per l'engine sincrono e uno per quello async: al massimo
+# worker × 2 × (DB_POOL_SIZE + DB_MAX_OVERFLOW) connessioni, da tenere sotto max_connections.
+# Con DATABASE_REPLICA_URL ogni worker apre sulla replica un altro pool delle stesse dimensioni
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Secondi di attesa di una connessione libera prima dell'errore
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Età massima di una connessione in secondi (-1 = nessun limite)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Verifica la connessione prima di usarla (scarta quelle chiuse dal server)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+# Soglie (secondi) dell'istogramma dell'attesa di una connessione
+SOGLIE_ATTESA_CONNESSIONE = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+
+class MetrichePool:
+    """
+    Contatori di un pool di connessioni: attesa per ottenere una connessione (con istogramma),
+    connessioni aperte, di cui oltre DB_POOL_SIZE (overflow), e attese finite in timeout.
+    L'attesa viene misurata dal pool (vedi _pool_misurato), il resto dagli eventi del pool.
+    """
+
+    def __init__(self, nome: str):
+        self.nome = nome
+        self.engine = None
+        self._lock = threading.Lock()
+        self.attese = 0
+        self.attesa_totale = 0.0
+        self.attesa_massima = 0.0
+        self.attese_per_soglia = [0] * len(SOGLIE_ATTESA_CONNESSIONE)
+        self.timeout = 0
+        self.connessioni_aperte = 0
+        self.overflow = 0
+        self._aperte_ora = 0
+
+    def collega(self, engine) -> None:
+        """Registra gli eventi sul pool dell'engine (restano registrati anche dopo dispose())"""
+        self.engine = engine
+        event.listen(engine, "connect", self._connessione_aperta)
+        event.listen(engine, "close", self._connessione_chiusa)
+        event.listen(engine, "close_detached", self._connessione_chiusa)
+
+    def registra_attesa(self, secondi: float) -> None:
+        with self._lock:
+            self.attese += 1
+            self.attesa_totale += secondi
+            self.attesa_massima = max(self.attesa_massima, secondi)
+            for indice, soglia in enumerate(SOGLIE_ATTESA_CONNESSIONE):
+                if secondi <= soglia:
+                    self.attese_per_soglia[indice] += 1
+
+    def registra_timeout(self) -> None:
+        with self._lock:
+            self.timeout += 1
+
+    def _connessione_aperta(self, dbapi_connection, connection_record) -> None:
+        pool = self.engine.pool
+        with self._lock:
+            self.connessioni_aperte += 1
+            self._aperte_ora += 1
+            if isinstance(pool, QueuePool) and self._aperte_ora > pool.size():
+                self.overflow += 1
+
+    def _connessione_chiusa(self, dbapi_connection, *args) -> None:
+        with self._lock:
+            self._aperte_ora = max(self._aperte_ora - 1, 0)
+
+    def contatori(self) -> Dict[str, Any]:
+        stato = {}
+        pool = self.engine.pool if self.engine is not None else None
+        if isinstance(pool, QueuePool):
+            stato = {
+                "dimensione": pool.size(),
+                "in_uso": pool.checkedout(),
+                "libere": pool.checkedin(),
+                "in_overflow": max(pool.overflow(), 0),
+            }
+        with self._lock:
+            return {
+                **stato,
+                "attese": self.attese,
+                "attesa_totale_secondi": round(self.attesa_totale, 6),
+                "attesa_massima_secondi": round(self.attesa_massima, 6),
+                "attese_per_soglia": dict(zip(map(str, SOGLIE_ATTESA_CONNESSIONE), self.attese_per_soglia)),
+                "timeout": self.timeout,
+                "connessioni_aperte": self.connessioni_aperte,
+                "overflow": self.overflow,
+            }
+
+
+def _pool_misurato(classe_pool, metriche: MetrichePool):
+    """Classe di pool che misura il tempo per ottenere una connessione (attesa di una libera e apertura)"""
+
+    class PoolMisurato(classe_pool):
+        def _do_get(self):
+            inizio = time.perf_counter()
+            try:
+                return super()._do_get()
+            except exc.TimeoutError:
+                metriche.registra_timeout()
+                raise
+            finally:
+                metriche.registra_attesa(time.perf_counter() - inizio)
+
+    return PoolMisurato
+
+
+def _opzioni_pool(classe_pool, metriche: MetrichePool) -> Dict[str, Any]:
+    if DATABASE_URL.startswith("sqlite"):
+        return {}
+    return {
+        "poolclass": _pool_misurato(classe_pool, metriche),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+metriche_pool_sincrono = MetrichePool("sincrono")
+metriche_pool_replica = MetrichePool("replica")
+metriche_pool_async = MetrichePool("async")
+
+# Thread per le route sincrone e per il lavoro bloccante delle route async (sessione DB, composizione, Jinja2).
+# Ogni thread usa al massimo una connessione: di default sono tanti quante le connessioni del pool
+# sincrono, così le richieste in più attendono un thread invece di andare in timeout sul pool
+THREADPOOL_MAX_WORKERS = int(os.getenv("THREADPOOL_MAX_WORKERS", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+
 # `echo=False` è consigliato per produzione, True per debug SQL in dev.
-engine = create_engine(DATABASE_URL, echo=False, connect_args=connect_args)
+engine = create_engine(DATABASE_URL, echo=False, connect_args=connect_args, **_opzioni_pool(QueuePool, metriche_pool_sincrono))
+metriche_pool_sincrono.collega(engine)
 
 # Configurazione della sessione
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+replica_engine = None
+if DATABASE_REPLICA_URL:
+    replica_engine = create_engine(
+        DATABASE_REPLICA_URL, echo=False,
+        connect_args={"check_same_thread": False} if DATABASE_REPLICA_URL.startswith("sqlite") else {},
+        **_opzioni_pool(QueuePool, metriche_pool_replica)
+    )
+    metriche_pool_replica.collega(replica_engine)
+
+
+class RegistroScritture:
+    """
+    Ultima scrittura di ogni utente, per tenere le sue letture sul primario finché la replica
+    potrebbe non averla ancora ricevuta. Il registro è per processo: con più worker
+    la garanzia vale per le richieste servite dallo stesso worker.
+    """
+
+    def __init__(self, finestra: float = REPLICA_FINESTRA_SCRITTURA):
+        self.finestra = finestra
+        self._scadenze: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def segna(self, user_id) -> None:
+        """Da chiamare dopo ogni scrittura dei dati dell'utente"""
+        if user_id is None:
+            return
+        adesso = time.monotonic()
+        with self._lock:
+            self._scadenze[str(user_id)] = adesso + self.finestra
+            if len(self._scadenze) > 10000:
+                # Pulizia occasionale delle voci scadute
+                self._scadenze = {chiave: scadenza for chiave, scadenza in self._scadenze.items() if scadenza > adesso}
+
+    def recente(self, user_id) -> bool:
+        """True se l'utente ha scritto da meno di `finestra` secondi"""
+        with self._lock:
+            scadenza = self._scadenze.get(str(user_id))
+        return scadenza is not None and scadenza > time.monotonic()
+
+
+# Istanza condivisa dall'applicazione
+registro_scritture = RegistroScritture()
+
+
+class SessioneLetture(Session):
+    """
+    Sessione per gli endpoint di lettura: le query vanno alla replica, mentre flush,
+    INSERT/UPDATE/DELETE e SELECT ... FOR UPDATE vanno al primario. Dopo la prima scrittura
+    (o se l'utente ha scritto di recente) tutta la sessione resta sul primario.
+    Senza replica è una normale sessione sul primario.
+    """
+
+    def __init__(self, *args, replica=None, user_id: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replica = replica
+        self.user_id = user_id
+        self.solo_primario = replica is None or registro_scritture.recente(user_id)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self.solo_primario and (
+            self._flushing
+            or getattr(clause, "is_dml", False)
+            or getattr(clause, "_for_update_arg", None) is not None
+        ):
+            self.solo_primario = True
+            registro_scritture.segna(self.user_id)
+        if self.solo_primario:
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        return self.replica
+
+
+SessionLetture = sessionmaker(class_=SessioneLetture, autocommit=False, autoflush=False, bind=engine, replica=replica_engine)
+
+# Stesso database con un driver asyncio, per i servizi async (AsyncPreventivoService, ...).
+# Se non indicato viene ricavato da DATABASE_URL (asyncpg per PostgreSQL, aiosqlite per SQLite)
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or (
+    DATABASE_URL
+    .replace("postgresql+psycopg2://", "postgresql+asyncpg://", 1)
+    .replace("postgresql://", "postgresql+asyncpg://", 1)
+    .replace("sqlite://", "sqlite+aiosqlite://", 1)
+)
+
+# L'estensione asyncio di SQLAlchemy richiede greenlet e il driver async:
+# senza, l'applicazione funziona con i soli servizi sincroni
+try:
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=False, **_opzioni_pool(AsyncAdaptedQueuePool, metriche_pool_async))
+    metriche_pool_async.collega(async_engine.sync_engine)
+    # expire_on_commit=False: gli oggetti restano leggibili dopo il commit senza altro I/O
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    ASYNC_DB_AVAILABLE = True
+except ImportError as e:
+    async_engine = None
+    AsyncSessionLocal = None
+    ASYNC_DB_AVAILABLE = False
+    logger.warning(f"Accesso async al database non disponibile ({e}): restano i soli servizi sincroni")
+
 # Base per i modelli
 Base = declarative_base()
 
@@ -35,4 +283,67 @@ def get_db():
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close() 
+
+# Dependency per ottenere la sessione di lettura (replica, se configurata) per i dati dell'utente
+def get_db_lettura(user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente")):
+    db = SessionLetture(user_id=user_id)
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Dependency per ottenere la sessione async del database
+async def get_async_db():
+    if not ASYNC_DB_AVAILABLE:
+        raise RuntimeError("Accesso async al database non disponibile: installare sqlalchemy[asyncio] e il driver async")
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def in_parallelo(*operazioni):
+    """
+    Esegue in parallelo le operazioni (funzioni async che ricevono una AsyncSession),
+    ognuna con una propria sessione: una AsyncSession non esegue query concorrenti.
+    Restituisce i risultati nello stesso ordine.
+    """
+    if not ASYNC_DB_AVAILABLE:
+        raise RuntimeError("Accesso async al database non disponibile: installare sqlalchemy[asyncio] e il driver async")
+
+    async def esegui(operazione):
+        async with AsyncSessionLocal() as db:
+            return await operazione(db)
+
+    return await asyncio.gather(*(esegui(operazione) for operazione in operazioni))
+
+def metriche_pool() -> Dict[str, Any]:
+    """Stato e contatori dei pool di connessioni di questo processo (ogni worker ha i suoi)"""
+    pool = {"sincrono": metriche_pool_sincrono.contatori()}
+    if replica_engine is not None:
+        pool["replica"] = metriche_pool_replica.contatori()
+    if ASYNC_DB_AVAILABLE:
+        pool["async"] = metriche_pool_async.contatori()
+    return {"pid": os.getpid(), "pool": pool}
+
+
+def _raccogli_metriche_pool():
+    """Contatori dei pool di connessioni per /metrics (etichetta pool: sincrono, replica, async)"""
+    pool = metriche_pool()["pool"]
+    connessioni, attese, timeout = [], [], []
+    for nome, contatori in pool.items():
+        for stato in ("in_uso", "libere", "in_overflow"):
+            if stato in contatori:
+                connessioni.append(("db_pool_connections", {"pool": nome, "state": stato}, contatori[stato]))
+        for soglia, cumulato in contatori["attese_per_soglia"].items():
+            attese.append(("db_pool_checkout_wait_seconds_bucket", {"pool": nome, "le": soglia}, cumulato))
+        attese.append(("db_pool_checkout_wait_seconds_bucket", {"pool": nome, "le": "+Inf"}, contatori["attese"]))
+        attese.append(("db_pool_checkout_wait_seconds_sum", {"pool": nome}, contatori["attesa_totale_secondi"]))
+        attese.append(("db_pool_checkout_wait_seconds_count", {"pool": nome}, contatori["attese"]))
+        timeout.append(("db_pool_checkout_timeouts_total", {"pool": nome}, contatori["timeout"]))
+    return [
+        ("db_pool_connections", "gauge", "Connessioni del pool per stato", connessioni),
+        ("db_pool_checkout_wait_seconds", "histogram", "Attesa per ottenere una connessione dal pool", attese),
+        ("db_pool_checkout_timeouts_total", "counter", "Richieste di connessione scadute per pool esaurito", timeout),
+    ]
+
+
+registro_metriche.aggiungi_raccolta(_raccogli_metriche_pool)
@@ -1,7 +1,6 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON, Boolean
+from sqlalchemy import Column, Integer, String, Text, Date, DateTime, ForeignKey, JSON, Boolean, LargeBinary, Index, Numeric, UniqueConstraint, func, literal_column
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import UUID, JSONB
-from sqlalchemy.ext.hybrid import hybrid_property
 import uuid
 from datetime import datetime
 from .database import Base
@@ -65,6 +64,8 @@ class Preventivo(Base):
     nome_documento = Column(String(500), nullable=True)  # Nome interno del documento per organizzazione
     oggetto_preventivo = Column(String(500), nullable=False)
     stato_preventivo = Column(String(50), default="bozza")  # bozza, inviato, accettato, rifiutato, scaduto
+    # Chiave del salvataggio idempotente: header Idempotency-Key o metadati_preventivo.id_preventivo
+    chiave_idempotenza = Column(String(255), nullable=True)
     
     # Riferimento al template utilizzato (opzionale per backward compatibility)
     template_id = Column(UUID(as_uuid=True), ForeignKey("document_templates.id"), nullable=True)
@@ -75,6 +76,13 @@ class Preventivo(Base):
     # Usa JSONB per performance e capacità di query avanzate su PostgreSQL
     dati_preventivo = Column(JSONB, nullable=False)
     
+    # Campi di riepilogo copiati da dati_preventivo a ogni salvataggio:
+    # le liste li leggono senza caricare il documento JSONB
+    nome_cliente = Column(String(500), nullable=True)
+    valore_totale_lordo = Column(Numeric(14, 2), nullable=True)
+    data_emissione = Column(Date, nullable=True)
+    data_scadenza = Column(Date, nullable=True)
+    
     # Campi per la gestione del cestino
     stato_record = Column(String(50), default="attivo", index=True)  # es: "attivo", "cestinato"
     cestinato_il = Column(DateTime, nullable=True, index=True)
@@ -88,17 +96,19 @@ class Preventivo(Base):
     template = relationship("DocumentTemplate", back_populates="documents")
     cartella = relationship("Cartella", back_populates="preventivi")
 
-    @hybrid_property
-    def nome_cliente(self):
-        if self.dati_preventivo and isinstance(self.dati_preventivo, dict):
-            return self.dati_preventivo.get('cliente_destinatario', {}).get('nome_cliente')
-        return None
-
-    @hybrid_property
-    def valore_totale_lordo(self):
-        if self.dati_preventivo and isinstance(self.dati_preventivo, dict):
-            return self.dati_preventivo.get('dettagli_totali', {}).get('totale_generale_lordo')
-        return None
+    __table_args__ = (
+        # Un solo preventivo per chiave: i salvataggi ripetuti aggiornano lo stesso record
+        UniqueConstraint("user_id", "chiave_idempotenza", name="uq_preventivi_user_chiave_idempotenza"),
+        # Ordinamenti della dashboard (paginazione keyset). Gli ordinamenti decrescenti usano
+        # anche l'id decrescente, quindi ogni indice serve entrambe le direzioni letto all'indietro
+        Index("ix_preventivi_user_stato_updated_at_id", "user_id", "stato_record", "updated_at", "id"),
+        # Altri ordinamenti e filtri della dashboard (l'indice trigram per la ricerca è creato dalla migrazione)
+        Index("ix_preventivi_user_stato_created_at_id", "user_id", "stato_record", "created_at", "id"),
+        Index("ix_preventivi_user_stato_numero_id", "user_id", "stato_record", "numero_preventivo", "id"),
+        Index("ix_preventivi_user_stato_cliente_id", "user_id", "stato_record", func.coalesce(nome_cliente, literal_column("''")), "id"),
+        Index("ix_preventivi_user_stato_valore_id", "user_id", "stato_record", func.coalesce(valore_totale_lordo, literal_column("0")), "id"),
+        Index("ix_preventivi_user_stato_data_emissione", "user_id", "stato_record", "data_emissione"),
+    )
 
 class DocumentTemplate(Base):
     __tablename__ = "document_templates"
@@ -133,6 +143,14 @@ class DocumentTemplate(Base):
     # Relazioni
     user = relationship("User", back_populates="document_templates")
     documents = relationship("Preventivo", back_populates="template")
+    
+    __table_args__ = (
+        # Un solo template di default per utente e tipo documento (anche con richieste concorrenti)
+        Index(
+            "uq_document_templates_user_tipo_default", "user_id", "document_type",
+            unique=True, postgresql_where=is_default, sqlite_where=is_default
+        ),
+    )
 
 class UserPreferences(Base):
     __tablename__ = "user_preferences"
@@ -186,4 +204,47 @@ class Cartella(Base):
     preventivi = relationship("Preventivo", back_populates="cartella")
     
     # Auto-relazione per gerarchia
-    figli = relationship("Cartella", backref="parent", remote_side=[id]) 
\ No newline at end of file
+    figli = relationship("Cartella", backref="parent", remote_side=[id]) 
+
+class PdfJob(Base):
+    __tablename__ = "pdf_jobs"
+    
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4, index=True)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
+    preventivo_id = Column(UUID(as_uuid=True), ForeignKey("preventivi.id", ondelete="CASCADE"), nullable=False, index=True)
+    template_id = Column(UUID(as_uuid=True), ForeignKey("document_templates.id", ondelete="SET NULL"), nullable=True)
+    
+    # Stato del job: queued, running, done, failed
+    stato = Column(String(20), nullable=False, default="queued")
+    tentativi = Column(Integer, nullable=False, default=0)
+    errore = Column(Text, nullable=True)
+    
+    # Risultato (salvato nel DB così qualsiasi istanza dell'app può servire il download)
+    nome_file = Column(String(255), nullable=True)
+    pdf = Column(LargeBinary, nullable=True)
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    
+    # I worker prelevano i job in ordine di creazione filtrando per stato
+    __table_args__ = (
+        Index("ix_pdf_jobs_stato_created_at", "stato", "created_at"),
+    )
+
+class BozzaPreventivo(Base):
+    __tablename__ = "preventivi_bozze"
+    
+    # Tabella di appoggio del salvataggio automatico: una riga per preventivo, condivisa da tutte le istanze
+    preventivo_id = Column(UUID(as_uuid=True), ForeignKey("preventivi.id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)  # Autore della bozza
+    
+    # Bozza in attesa (NULL se non ce n'è) e momento in cui va scritta nel preventivo
+    dati_preventivo = Column(JSONB(none_as_null=True), nullable=True)
+    hash_bozza = Column(String(64), nullable=True)
+    scadenza = Column(DateTime, nullable=True, index=True)
+    
+    # Hash dell'ultimo contenuto salvato nel preventivo: le bozze identiche non vengono scritte
+    hash_salvato = Column(String(64), nullable=True)
+    
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
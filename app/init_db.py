@@ -7,6 +7,7 @@ import uuid
 from datetime import datetime, date
 from .database import SessionLocal, engine
 from .db_models import Base, User, Azienda, Preventivo
+from .services.preventivo_service import PreventivoService
 
 def init_db():
     """Inizializza il database con le tabelle e dati di esempio"""
@@ -140,7 +141,8 @@ def init_db():
             numero_preventivo="2024/001",
             oggetto_preventivo="Sviluppo sito web aziendale",
             stato_preventivo="bozza",
-            dati_preventivo=preventivo_data
+            dati_preventivo=preventivo_data,
+            **PreventivoService.colonne_riepilogo(preventivo_data)
         )
         db.add(preventivo)
         
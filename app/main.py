@@ -1,26 +1,39 @@
-from fastapi import FastAPI, Request, Depends, HTTPException, Query, status
-from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi import FastAPI, Request, Depends, Header, HTTPException, Query, status
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
+from anyio import to_thread
 from pathlib import Path
 from sqlalchemy.orm import Session
 # from uuid import UUID # Rimuoviamo l'import UUID
 from typing import List, Optional
 
-from .models import PreventivoMasterModel, DocumentTemplateCreate, DocumentTemplateUpdate, DocumentTemplateResponse, PreventivoListItem, CartellaCreate, CartellaUpdate, CartellaResponse, CartellaSpostamento, PreventivoListItemConCartella
+from .models import PreventivoMasterModel, DocumentTemplateCreate, DocumentTemplateUpdate, DocumentTemplateResponse, PreventivoListItem, CartellaCreate, CartellaUpdate, CartellaResponse, CartellaSpostamento, PreventivoListItemConCartella, PdfJobResponse, EsportazionePdfRichiesta, RigaPreventivo, RigaPreventivoModifica, RigaPreventivoRisposta, RigheOrdinamento, TotaliPreventivoRisposta, StatistichePreventivi, DatiDashboard
 from .services.preventivo_calculator import calcola_totali_preventivo
-from .services.preventivo_service import PreventivoService
-from .services.document_template_service import DocumentTemplateService
-from .services.cartella_service import CartellaService
+from .services.preventivo_service import PreventivoService, AsyncPreventivoService, ORDINAMENTI_PREVENTIVI, PreventivoCestinatoError
+from .services.document_template_service import DocumentTemplateService, AsyncDocumentTemplateService
+from .services.cartella_service import CartellaService, AsyncCartellaService
 # Scommento ora che WeasyPrint funziona correttamente
-from .services.pdf_export_service import PDFExportService
-from .database import get_db, engine, Base
+from .services.pdf_export_service import PDFExportService, WEASYPRINT_AVAILABLE
+from .services.pdf_render_pool import pdf_render_pool
+from .services.pdf_job_service import PdfJobService, PdfJobWorker, PDF_JOB_WORKER_ENABLED
+from .services.pdf_batch_service import PDFBatchExportService
+from .services.righe_preventivo_service import RighePreventivoService
+from .services.statistiche_service import StatisticheService
+from .services.retention_service import RetentionSweeper, RETENTION_SWEEPER_ENABLED
+from .services.autosave_service import AutosaveService, autosave_buffer
+from .services.ingestione_preventivi import leggi_anteprima, leggi_documento
+from .services.ambiente_jinja import ambiente_jinja, precompila_template
+from .services.metriche import registro_metriche, richieste_http, durata_richieste_http, richieste_http_in_corso
+from .database import get_db, get_db_lettura, engine, async_engine, Base, THREADPOOL_MAX_WORKERS, ASYNC_DB_AVAILABLE, in_parallelo, metriche_pool
 from .db_models import Preventivo
 
 # Modelli Pydantic per la lista preventivi
 # Dovrebbero stare in models.py, ma per rapidità li metto qui temporaneamente
-from pydantic import BaseModel
-from datetime import datetime as dt_datetime # Alias per evitare conflitto
+from pydantic import BaseModel, ValidationError
+from datetime import date, datetime as dt_datetime # Alias per evitare conflitto
 import uuid
+import time
 
 # Crea le tabelle nel database (per ora facciamo così, in futuro useremo Alembic)
 # Commento perché ora usiamo Alembic per le migrazioni
@@ -35,15 +48,76 @@ app = FastAPI(title="App Preventivi Modulari")
 # Configurazione dei template Jinja2
 # Assicurati che la directory 'templates' sia al livello corretto rispetto a BASE_DIR
 # In questo caso, se main.py è in app/, e templates è in app/templates/
-templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
+# L'Environment è lo stesso usato dal rendering dei PDF
+templates = Jinja2Templates(env=ambiente_jinja(BASE_DIR / "templates"))
 
 # Configurazione del servizio PDF - Ora abilitato
 # Rimuoviamo l'istanza globale, la creeremo on-demand con la sessione DB
 # pdf_service = PDFExportService(BASE_DIR / "templates")
 
+# Worker della coda dei job PDF asincroni (tabella pdf_jobs)
+pdf_job_worker = PdfJobWorker(BASE_DIR / "templates")
+
+# Pulizia periodica: periodo di conservazione e scadenza del cestino
+retention_sweeper = RetentionSweeper()
+
+
+@app.middleware("http")
+async def misura_richieste(request: Request, call_next):
+    """
+    Conta le richieste e ne misura la durata per route e codice di stato (esportate su /metrics).
+    La route è il template del percorso (es. /preventivi/{preventivo_id}), non l'URL,
+    così il numero di serie resta limitato; le richieste senza route sono raggruppate.
+    """
+    inizio = time.perf_counter()
+    richieste_http_in_corso.incrementa()
+    codice_stato = 500
+    try:
+        response = await call_next(request)
+        codice_stato = response.status_code
+        return response
+    finally:
+        richieste_http_in_corso.decrementa()
+        route = getattr(request.scope.get("route"), "path", None) or "non_trovata"
+        etichette = {"method": request.method, "route": route, "status": str(codice_stato)}
+        richieste_http.incrementa(**etichette)
+        durata_richieste_http.osserva(time.perf_counter() - inizio, **etichette)
+
+
+@app.on_event("startup")
+async def avvia_servizi_background():
+    """
+    Avvia il pool di processi per il rendering PDF, così i worker sono pronti
+    (con WeasyPrint già importato) prima della prima richiesta,
+    i consumatori della coda dei job PDF, la pulizia periodica dei preventivi
+    e la scrittura delle bozze del salvataggio automatico.
+    I template Jinja2 vengono compilati subito.
+    """
+    # Le route sincrone (def) e il lavoro bloccante delle route async girano in questo threadpool
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_MAX_WORKERS
+    precompila_template(templates.env)
+    if WEASYPRINT_AVAILABLE:
+        pdf_render_pool.avvia()
+    if PDF_JOB_WORKER_ENABLED:
+        pdf_job_worker.avvia()
+    if RETENTION_SWEEPER_ENABLED:
+        retention_sweeper.avvia()
+    autosave_buffer.avvia()
+
+
+@app.on_event("shutdown")
+async def arresta_servizi_background():
+    # Prima di tutto: le bozze in attesa vanno scritte prima dello spegnimento
+    await autosave_buffer.arresta()
+    await retention_sweeper.arresta()
+    await pdf_job_worker.arresta()
+    pdf_render_pool.arresta()
+    if async_engine is not None:
+        await async_engine.dispose()
+
 
 @app.get("/", response_class=HTMLResponse)
-async def dashboard(request: Request):
+def dashboard(request: Request):
     """
     Dashboard principale con lista preventivi
     """
@@ -51,7 +125,7 @@ async def dashboard(request: Request):
 
 
 @app.get("/test_simple", response_class=HTMLResponse)
-async def test_simple(request: Request):
+def test_simple(request: Request):
     """
     Pagina di test semplificata per debug interazioni
     """
@@ -59,7 +133,7 @@ async def test_simple(request: Request):
 
 
 @app.get("/preventivo/nuovo", response_class=HTMLResponse)
-async def nuovo_preventivo(
+def nuovo_preventivo(
     request: Request,
     template_id: Optional[str] = Query(None, description="ID del template da utilizzare")
 ):
@@ -74,7 +148,7 @@ async def nuovo_preventivo(
 
 
 @app.get("/preventivo/{preventivo_id}/modifica", response_class=HTMLResponse)
-async def modifica_preventivo(request: Request, preventivo_id: str):
+def modifica_preventivo(request: Request, preventivo_id: str):
     """
     Form per modificare un preventivo esistente
     """
@@ -85,7 +159,7 @@ async def modifica_preventivo(request: Request, preventivo_id: str):
 
 
 @app.post("/preventivo/visualizza", response_class=HTMLResponse)
-async def visualizza_preventivo(
+def visualizza_preventivo(
     request: Request, 
     preventivo_data: PreventivoMasterModel,
     template_id: Optional[str] = Query(None, description="ID del template da utilizzare"),
@@ -105,18 +179,9 @@ async def visualizza_preventivo(
     
     # Se viene specificato un template_id, utilizza quello, altrimenti usa il template di default
     template_service = DocumentTemplateService(db)
-    
-    if template_id:
-        # Recupera il template specifico
-        template = template_service.get_template_by_id(template_id, user_id)
-        if not template:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template non trovato")
-    else:
-        # Utilizza il template di default per l'utente
-        template = template_service.get_default_template(user_id, "preventivo")
-        if not template:
-            # Se non esiste un template di default, creane uno
-            template = template_service.create_default_template_for_user(user_id)
+    template = template_service.risolvi_template_preventivo(user_id, template_id=template_id)
+    if not template:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template non trovato")
     
     # Componi i dati del documento secondo la configurazione del template
     composed_data = template_service.compose_document_from_template(template, preventivo_dict)
@@ -130,34 +195,37 @@ async def visualizza_preventivo(
 @app.post("/preventivo/salva", status_code=status.HTTP_201_CREATED)
 async def salva_preventivo_endpoint(
     request: Request, # Rinominato per chiarezza, non più salva_preventivo
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key", max_length=255, description="Chiave del documento per i reinvii"),
     db: Session = Depends(get_db)
 ):
     """
     Salva un nuovo preventivo nel database.
     Accetta i dati in formato JSON nel body della richiesta.
+    Il salvataggio è idempotente: un nuovo invio con la stessa chiave (header
+    Idempotency-Key o metadati_preventivo.id_preventivo) aggiorna lo stesso preventivo.
+    Se la chiave appartiene a un preventivo nel cestino la risposta è 409 Conflict.
     """
     try:
-        # Leggi il body della richiesta
-        body = await request.json()
+        # Valida il body con Pydantic e calcola i totali prima di salvare
+        documento = await leggi_documento(request)
         
         # Estrai user_id dai dati - Uso UUID reale dell'utente di test
-        user_id = body.pop("user_id", "da2cb935-e023-40dd-9703-d918f1066b24")  # UUID dell'utente di test
-        
-        # Valida i dati con Pydantic
-        preventivo_data = PreventivoMasterModel(**body)
+        user_id = documento.user_id or "da2cb935-e023-40dd-9703-d918f1066b24"  # UUID dell'utente di test
         
-        # Calcola i totali prima di salvare
-        calcola_totali_preventivo(preventivo_data)
-        
-        # Utilizza il servizio per salvare il preventivo
-        preventivo_service = PreventivoService(db)
-        db_preventivo = preventivo_service.salva_preventivo(preventivo_data, user_id)
+        # Utilizza il servizio per salvare il preventivo (nel threadpool: la sessione è sincrona)
+        def salva():
+            preventivo_service = PreventivoService(db)
+            db_preventivo = preventivo_service.salva_preventivo(documento.preventivo, user_id, idempotency_key, documento.json)
+            autosave_buffer.segna_salvato(db, db_preventivo.id, documento.json)
+            return {
+                "message": "Preventivo salvato con successo",
+                "preventivo_id": str(db_preventivo.id),
+                "numero_preventivo": db_preventivo.numero_preventivo
+            }
         
-        return {
-            "message": "Preventivo salvato con successo",
-            "preventivo_id": str(db_preventivo.id),
-            "numero_preventivo": db_preventivo.numero_preventivo
-        }
+        return await run_in_threadpool(salva)
+    except PreventivoCestinatoError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Errore nel salvataggio: {str(e)}")
 
@@ -174,46 +242,84 @@ async def aggiorna_preventivo_endpoint(
     Accetta i dati in formato JSON nel body della richiesta.
     """
     try:
-        # Leggi il body della richiesta
-        body = await request.json()
-        
-        # Rimuovi user_id dai dati se presente (lo passiamo come parametro)
-        body.pop("user_id", None)
-        
-        # Valida i dati con Pydantic
-        preventivo_data = PreventivoMasterModel(**body)
-        
-        # Calcola i totali prima di salvare
-        calcola_totali_preventivo(preventivo_data)
+        # Valida il body con Pydantic e calcola i totali prima di salvare
+        # (l'eventuale user_id nel body viene ignorato: lo passiamo come parametro)
+        documento = await leggi_documento(request)
         
-        # Utilizza il servizio per aggiornare il preventivo
-        preventivo_service = PreventivoService(db)
-        db_preventivo = preventivo_service.aggiorna_preventivo(preventivo_id, preventivo_data, user_id)
-        
-        if not db_preventivo:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo non trovato o non modificabile")
+        # Utilizza il servizio per aggiornare il preventivo (nel threadpool: la sessione è sincrona).
+        # Il salvataggio esplicito rende superata l'eventuale bozza del salvataggio automatico:
+        # viene scartata solo se l'aggiornamento riesce
+        def aggiorna():
+            with autosave_buffer.salvataggio_esplicito(db, preventivo_id, user_id, documento.json):
+                preventivo_service = PreventivoService(db)
+                db_preventivo = preventivo_service.aggiorna_preventivo(preventivo_id, documento.preventivo, user_id, documento.json)
+                
+                if not db_preventivo:
+                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo non trovato o non modificabile")
+            
+            return {
+                "message": "Preventivo aggiornato con successo",
+                "preventivo_id": str(db_preventivo.id),
+                "numero_preventivo": db_preventivo.numero_preventivo
+            }
         
-        return {
-            "message": "Preventivo aggiornato con successo",
-            "preventivo_id": str(db_preventivo.id),
-            "numero_preventivo": db_preventivo.numero_preventivo
-        }
+        return await run_in_threadpool(aggiorna)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Errore nell'aggiornamento: {str(e)}")
 
+# Endpoint per il salvataggio automatico dall'editor (scrittura differita)
+@app.post("/preventivo/{preventivo_id}/autosave", status_code=status.HTTP_202_ACCEPTED)
+async def autosave_preventivo_endpoint(
+    preventivo_id: str,
+    request: Request,
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    db: Session = Depends(get_db)
+):
+    """
+    Registra la bozza di un preventivo esistente senza scriverla subito.
+    Le bozze ravvicinate vengono unite e scritte una volta per intervallo
+    (UserPreferences.auto_save_interval); se il contenuto non è cambiato
+    rispetto all'ultimo salvataggio non viene scritto nulla.
+    Le bozze sono nella tabella preventivi_bozze: qualsiasi worker le serve
+    (GET /preventivo/{id}) e le scrive, anche dopo un riavvio.
+    """
+    try:
+        documento = await leggi_documento(request)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Errore nel salvataggio automatico: {str(e)}")
+    
+    esito = await run_in_threadpool(AutosaveService(db).registra, preventivo_id, user_id, documento.preventivo, documento.json)
+    if esito is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo non trovato o non modificabile")
+    return esito
+
 # Endpoint per caricare un preventivo (dati completi per modifica)
 @app.get("/preventivo/{preventivo_id}", response_model=PreventivoMasterModel)
-async def carica_preventivo_endpoint(
+def carica_preventivo_endpoint(
     preventivo_id: str,  # Rinominato per chiarezza
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),  # UUID dell'utente di test
-    db: Session = Depends(get_db)
+    valida: bool = Query(False, description="Valida il documento con PreventivoMasterModel invece di restituire il JSON salvato"),
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Carica i dati completi di un preventivo attivo dal database per la modifica.
+    Se c'è una bozza del salvataggio automatico non ancora scritta, restituisce quella.
+    Di default restituisce il JSON salvato (già validato al salvataggio) senza
+    ricostruire il modello; con valida=true il documento viene validato e normalizzato.
     """
+    bozza = autosave_buffer.bozza(db, preventivo_id, user_id)
+    if bozza is not None:
+        return bozza
+    
     preventivo_service = PreventivoService(db)
+    if not valida:
+        preventivo_json = preventivo_service.carica_preventivo_json(preventivo_id, user_id, solo_attivi=True)
+        if preventivo_json is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo attivo non trovato")
+        return Response(content=preventivo_json, media_type="application/json")
+    
     # Carica solo preventivi attivi per la modifica
     preventivo_data = preventivo_service.carica_preventivo(preventivo_id, user_id, solo_attivi=True)
     
@@ -222,14 +328,109 @@ async def carica_preventivo_endpoint(
     
     return preventivo_data
 
+# ============================================
+# ENDPOINTS RIGHE PREVENTIVO
+# ============================================
+
+@app.post("/preventivo/{preventivo_id}/righe", response_model=RigaPreventivoRisposta, status_code=status.HTTP_201_CREATED)
+def aggiungi_riga_preventivo(
+    preventivo_id: str,
+    riga: RigaPreventivo,
+    posizione: Optional[int] = Query(None, ge=0, description="Posizione della nuova riga (da 0); in coda se omessa"),
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    db: Session = Depends(get_db)
+):
+    """
+    Aggiunge una riga a un preventivo attivo.
+    Restituisce solo la riga salvata e i nuovi totali.
+    """
+    try:
+        risultato = RighePreventivoService(db).aggiungi_riga(preventivo_id, user_id, riga, posizione)
+    except IndexError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    if not risultato:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo attivo non trovato")
+    
+    indice, riga_salvata, totali = risultato
+    return RigaPreventivoRisposta(indice=indice, riga=riga_salvata, dettagli_totali=totali)
+
+@app.put("/preventivo/{preventivo_id}/righe/ordine", response_model=TotaliPreventivoRisposta)
+def riordina_righe_preventivo(
+    preventivo_id: str,
+    ordinamento: RigheOrdinamento,
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    db: Session = Depends(get_db)
+):
+    """
+    Riordina le righe di un preventivo attivo.
+    `ordine` elenca gli indici attuali delle righe nella nuova sequenza.
+    """
+    try:
+        risultato = RighePreventivoService(db).riordina_righe(preventivo_id, user_id, ordinamento.ordine)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    if not risultato:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo attivo non trovato")
+    
+    numero_righe, totali = risultato
+    return TotaliPreventivoRisposta(numero_righe=numero_righe, dettagli_totali=totali)
+
+@app.patch("/preventivo/{preventivo_id}/righe/{indice}", response_model=RigaPreventivoRisposta)
+def modifica_riga_preventivo(
+    preventivo_id: str,
+    indice: int,
+    modifiche: RigaPreventivoModifica,
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    db: Session = Depends(get_db)
+):
+    """
+    Modifica i campi inviati di una riga (indice da 0) di un preventivo attivo.
+    Restituisce solo la riga aggiornata e i nuovi totali.
+    """
+    try:
+        risultato = RighePreventivoService(db).aggiorna_riga(preventivo_id, user_id, indice, modifiche.model_dump(exclude_unset=True))
+    except IndexError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except ValidationError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e.errors(include_url=False))
+    
+    if not risultato:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo attivo non trovato")
+    
+    indice, riga_salvata, totali = risultato
+    return RigaPreventivoRisposta(indice=indice, riga=riga_salvata, dettagli_totali=totali)
+
+@app.delete("/preventivo/{preventivo_id}/righe/{indice}", response_model=TotaliPreventivoRisposta)
+def elimina_riga_preventivo(
+    preventivo_id: str,
+    indice: int,
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    db: Session = Depends(get_db)
+):
+    """
+    Elimina una riga (indice da 0) di un preventivo attivo e restituisce i nuovi totali.
+    """
+    try:
+        risultato = RighePreventivoService(db).elimina_riga(preventivo_id, user_id, indice)
+    except IndexError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    
+    if not risultato:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo attivo non trovato")
+    
+    numero_righe, totali = risultato
+    return TotaliPreventivoRisposta(numero_righe=numero_righe, dettagli_totali=totali)
+
 # Endpoint per visualizzare un preventivo caricato dal database (HTML)
 @app.get("/preventivo/{preventivo_id}/visualizza", response_class=HTMLResponse)
-async def visualizza_preventivo_salvato(
+def visualizza_preventivo_salvato(
     request: Request,
     preventivo_id: str, 
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"), 
     template_id: Optional[str] = Query(None, description="ID del template da utilizzare (opzionale)"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Carica un preventivo attivo dal database e lo visualizza utilizzando il template specificato o quello di default.
@@ -241,35 +442,20 @@ async def visualizza_preventivo_salvato(
     if not preventivo_data:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo attivo non trovato")
     
-    # Ricalcola i totali (per sicurezza)
-    calcola_totali_preventivo(preventivo_data)
-    
+    # I totali sono già calcolati da carica_preventivo: il modello può essere condiviso
+    # con altre richieste tramite la cache, quindi non va ricalcolato né modificato
     # Converti il modello Pydantic in un dizionario
     preventivo_dict = preventivo_data.model_dump()
     
-    # Gestione template
+    # Gestione template: quello specificato, altrimenti quello del preventivo o il default
     template_service = DocumentTemplateService(db)
-    
-    if template_id:
-        # Utilizza il template specificato
-        template = template_service.get_template_by_id(template_id, user_id)
-        if not template:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template non trovato")
-    else:
-        # Se il preventivo ha un template associato, usalo, altrimenti usa il default
-        if preventivo_data.metadati_preventivo and preventivo_data.metadati_preventivo.template_id:
-            template_id_from_preventivo = preventivo_data.metadati_preventivo.template_id
-            template = template_service.get_template_by_id(template_id_from_preventivo, user_id)
-            if not template:
-                # Se il template non esiste più, usa il default
-                template = template_service.get_default_template(user_id, "preventivo")
-                if not template:
-                    template = template_service.create_default_template_for_user(user_id)
-        else:
-            # Utilizza il template di default
-            template = template_service.get_default_template(user_id, "preventivo")
-            if not template:
-                template = template_service.create_default_template_for_user(user_id)
+    template = template_service.risolvi_template_preventivo(
+        user_id,
+        template_id=template_id,
+        template_id_preventivo=preventivo_data.metadati_preventivo.template_id
+    )
+    if not template:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template non trovato")
     
     # Componi i dati del documento secondo la configurazione del template
     composed_data = template_service.compose_document_from_template(template, preventivo_dict)
@@ -279,39 +465,99 @@ async def visualizza_preventivo_salvato(
         {"request": request, **composed_data}
     )
 
+def _imposta_cursore_successivo(response: Response, prossimo_cursore: Optional[str]) -> None:
+    """Paginazione keyset: il cursore della pagina successiva viaggia nell'header X-Next-Cursor"""
+    if prossimo_cursore:
+        response.headers["X-Next-Cursor"] = prossimo_cursore
+
+# Endpoint con i dati iniziali della dashboard (sessioni async, query in parallelo)
+@app.get("/dashboard/dati", response_model=DatiDashboard)
+async def dati_dashboard(
+    response: Response,
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    limit: int = Query(100, ge=1, le=500, description="Numero di preventivi della prima pagina")
+):
+    """
+    Cartelle, prima pagina dei preventivi attivi e template dell'utente in una sola richiesta.
+    Le tre letture sono indipendenti: vengono eseguite in parallelo sul loop,
+    ognuna con la propria sessione async.
+    """
+    if not ASYNC_DB_AVAILABLE:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Accesso async al database non disponibile")
+    
+    cartelle, (preventivi, prossimo_cursore), templates_utente = await in_parallelo(
+        lambda db: AsyncCartellaService(db).lista_cartelle(user_id),
+        lambda db: AsyncPreventivoService(db).lista_preventivi_con_cartelle(user_id, limit=limit),
+        lambda db: AsyncDocumentTemplateService(db).templates_utente(user_id, "preventivo")
+    )
+    _imposta_cursore_successivo(response, prossimo_cursore)
+    return DatiDashboard(
+        cartelle=cartelle,
+        preventivi=preventivi,
+        templates=[template.risposta for template in templates_utente]
+    )
+
 # Endpoint per elencare i preventivi ATTIVI di un utente
 @app.get("/preventivi/attivi", response_model=List[PreventivoListItem])
-async def lista_preventivi_attivi_endpoint(
+def lista_preventivi_attivi_endpoint(
+    response: Response,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
-    skip: int = Query(0, ge=0),
+    skip: int = Query(0, ge=0, description="Paginazione a offset (compatibilità); ignorato se è presente cursor"),
     limit: int = Query(100, ge=1, le=500),
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = Query(None, description="Cursore della pagina successiva (header X-Next-Cursor)"),
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Restituisce la lista dei preventivi ATTIVI per un utente con paginazione.
+    Se ci sono altri elementi, l'header X-Next-Cursor contiene il cursore da
+    passare come `cursor` per ottenere la pagina successiva.
     """
     preventivo_service = PreventivoService(db)
-    preventivi_attivi = preventivo_service.lista_preventivi_attivi(user_id, skip, limit)
+    try:
+        preventivi_attivi, prossimo_cursore = preventivo_service.lista_preventivi_attivi(user_id, skip, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    _imposta_cursore_successivo(response, prossimo_cursore)
     return preventivi_attivi # Pydantic si occuperà della serializzazione
 
 # Endpoint per elencare i preventivi CESTINATI di un utente
 @app.get("/preventivi/cestinati", response_model=List[PreventivoListItem])
-async def lista_preventivi_cestinati_endpoint(
+def lista_preventivi_cestinati_endpoint(
+    response: Response,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
-    skip: int = Query(0, ge=0),
+    skip: int = Query(0, ge=0, description="Paginazione a offset (compatibilità); ignorato se è presente cursor"),
     limit: int = Query(100, ge=1, le=500),
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = Query(None, description="Cursore della pagina successiva (header X-Next-Cursor)"),
+    db: Session = Depends(get_db_lettura)
 ):
     """
-    Restituisce la lista dei preventivi CESTINATI per un utente con paginazione.
+    Restituisce la lista dei preventivi CESTINATI per un utente con paginazione
+    (cursore della pagina successiva nell'header X-Next-Cursor).
     """
     preventivo_service = PreventivoService(db)
-    preventivi_cestinati = preventivo_service.lista_preventivi_cestinati(user_id, skip, limit)
+    try:
+        preventivi_cestinati, prossimo_cursore = preventivo_service.lista_preventivi_cestinati(user_id, skip, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    _imposta_cursore_successivo(response, prossimo_cursore)
     return preventivi_cestinati
 
+# Endpoint per le statistiche della dashboard
+@app.get("/preventivi/statistiche", response_model=StatistichePreventivi)
+def statistiche_preventivi_endpoint(
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    stato_record: str = Query("attivo", description="Stato del record: attivo, cestinato"),
+    db: Session = Depends(get_db)
+):
+    """
+    Numero e valore complessivo dei preventivi per stato, per cartella e per mese,
+    calcolati nel database su tutti i preventivi dell'utente.
+    """
+    return StatisticheService(db).calcola_statistiche(user_id, stato_record)
+
 # Endpoint per CESTINARE un preventivo (soft delete)
 @app.post("/preventivo/{preventivo_id}/cestina", status_code=status.HTTP_200_OK)
-async def cestina_preventivo_endpoint(
+def cestina_preventivo_endpoint(
     preventivo_id: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     db: Session = Depends(get_db)
@@ -324,7 +570,7 @@ async def cestina_preventivo_endpoint(
 
 # Endpoint per RIPRISTINARE un preventivo dal cestino
 @app.post("/preventivo/{preventivo_id}/ripristina", status_code=status.HTTP_200_OK)
-async def ripristina_preventivo_endpoint(
+def ripristina_preventivo_endpoint(
     preventivo_id: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     db: Session = Depends(get_db)
@@ -337,7 +583,7 @@ async def ripristina_preventivo_endpoint(
 
 # Endpoint per ELIMINARE DEFINITIVAMENTE un preventivo
 @app.delete("/preventivo/{preventivo_id}/definitivo", status_code=status.HTTP_200_OK)
-async def elimina_definitivamente_preventivo_endpoint(
+def elimina_definitivamente_preventivo_endpoint(
     preventivo_id: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     db: Session = Depends(get_db)
@@ -350,7 +596,7 @@ async def elimina_definitivamente_preventivo_endpoint(
 
 # Endpoint per SVUOTARE IL CESTINO dei preventivi scaduti per l'utente
 @app.post("/preventivi/cestino/svuota_scaduti", status_code=status.HTTP_200_OK)
-async def svuota_cestino_utente_endpoint(
+def svuota_cestino_utente_endpoint(
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     giorni_scadenza: int = Query(30, description="Numero di giorni dopo i quali un preventivo cestinato è considerato scaduto"),
     db: Session = Depends(get_db)
@@ -361,7 +607,7 @@ async def svuota_cestino_utente_endpoint(
 
 # Endpoint per SVUOTARE TUTTO IL CESTINO per l'utente
 @app.post("/preventivi/cestino/svuota_tutto", status_code=status.HTTP_200_OK)
-async def svuota_tutto_cestino_utente_endpoint(
+def svuota_tutto_cestino_utente_endpoint(
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     db: Session = Depends(get_db)
 ):
@@ -388,12 +634,10 @@ async def genera_pdf_preventivo(preventivo_data: PreventivoMasterModel, db: Sess
         # TODO: Ottenere user_id dai dati del preventivo o da un token JWT
         # Per ora usiamo l'user_id di default.
         user_id_per_default_template = "da2cb935-e023-40dd-9703-d918f1066b24" 
-        default_template = template_service.get_default_template(user_id_per_default_template, "preventivo")
-        if not default_template:
-            default_template = template_service.create_default_template_for_user(user_id_per_default_template)
+        default_template = await run_in_threadpool(template_service.risolvi_template_preventivo, user_id_per_default_template)
 
-        # Genera il PDF usando il servizio con il template di default
-        pdf_content = pdf_service_local.genera_pdf_preventivo_con_template(preventivo_data, default_template)
+        # Genera il PDF nel pool di rendering usando il template di default
+        pdf_content = await pdf_service_local.genera_pdf_preventivo_con_template_async(preventivo_data, default_template)
         
         # Crea il nome del file PDF
         numero_preventivo = preventivo_data.metadati_preventivo.numero_preventivo or "preventivo"
@@ -406,6 +650,8 @@ async def genera_pdf_preventivo(preventivo_data: PreventivoMasterModel, db: Sess
                 "Content-Disposition": f"attachment; filename={filename}"
             }
         )
+    except TimeoutError as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=f"Errore nella generazione del PDF: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Errore nella generazione del PDF: {str(e)}")
 
@@ -415,7 +661,7 @@ async def scarica_pdf_preventivo(
     preventivo_id: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),  # Aggiorno con UUID reale
     template_id: Optional[str] = Query(None, description="ID del template da utilizzare (opzionale)"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Scarica il PDF di un preventivo salvato nel database.
@@ -423,7 +669,7 @@ async def scarica_pdf_preventivo(
     try:
         # Carica il preventivo dal database (solo attivi di default)
         preventivo_service = PreventivoService(db)
-        preventivo_data = preventivo_service.carica_preventivo(preventivo_id, user_id, solo_attivi=True)
+        preventivo_data = await run_in_threadpool(preventivo_service.carica_preventivo, preventivo_id, user_id, solo_attivi=True)
         
         if not preventivo_data:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo attivo non trovato")
@@ -432,29 +678,18 @@ async def scarica_pdf_preventivo(
         pdf_service_local = PDFExportService(BASE_DIR / "templates", db=db)
         template_service = DocumentTemplateService(db)
         
-        if template_id:
-            # Utilizza il template specificato nel parametro
-            template = template_service.get_template_by_id(template_id, user_id)
-            if not template:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template non trovato")
-        else:
-            # Se il preventivo ha un template associato, usalo, altrimenti usa il default
-            if preventivo_data.metadati_preventivo and preventivo_data.metadati_preventivo.template_id:
-                template_id_from_preventivo = preventivo_data.metadati_preventivo.template_id
-                template = template_service.get_template_by_id(template_id_from_preventivo, user_id)
-                if not template:
-                    # Se il template non esiste più, usa il default
-                    template = template_service.get_default_template(user_id, "preventivo")
-                    if not template:
-                        template = template_service.create_default_template_for_user(user_id)
-            else:
-                # Utilizza il template di default
-                template = template_service.get_default_template(user_id, "preventivo")
-                if not template:
-                    template = template_service.create_default_template_for_user(user_id)
+        # Template specificato nel parametro, altrimenti quello del preventivo o il default
+        template = await run_in_threadpool(
+            template_service.risolvi_template_preventivo,
+            user_id,
+            template_id=template_id,
+            template_id_preventivo=preventivo_data.metadati_preventivo.template_id
+        )
+        if not template:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template non trovato")
         
-        # Genera il PDF usando il template corretto
-        pdf_content = pdf_service_local.genera_pdf_preventivo_con_template(preventivo_data, template)
+        # Genera il PDF nel pool di rendering usando il template corretto
+        pdf_content = await pdf_service_local.genera_pdf_preventivo_con_template_async(preventivo_data, template, preventivo_id=preventivo_id)
         
         # Crea il nome del file PDF
         numero_preventivo = preventivo_data.metadati_preventivo.numero_preventivo or preventivo_id
@@ -469,76 +704,164 @@ async def scarica_pdf_preventivo(
         )
     except HTTPException:
         raise
+    except TimeoutError as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=f"Errore nella generazione del PDF: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Errore nella generazione del PDF: {str(e)}")
 
+# Endpoint per export PDF di più preventivi in un archivio ZIP
+@app.post("/preventivi/pdf/zip", response_class=StreamingResponse)
+def esporta_pdf_zip(
+    richiesta: EsportazionePdfRichiesta,
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    db: Session = Depends(get_db)
+):
+    """
+    Esporta in un archivio ZIP i PDF dei preventivi di una cartella o di una lista di ID.
+    I PDF vengono generati in parallelo e l'archivio viene inviato man mano che sono pronti.
+    """
+    if bool(richiesta.cartella_id) == bool(richiesta.preventivo_ids):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Specificare cartella_id oppure preventivo_ids")
+    if not WEASYPRINT_AVAILABLE:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Export PDF non disponibile: WeasyPrint non è installato correttamente")
+    
+    try:
+        for valore in (richiesta.preventivo_ids or []) + [richiesta.cartella_id, richiesta.template_id]:
+            if valore:
+                uuid.UUID(valore)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="ID non valido")
+    
+    batch_service = PDFBatchExportService(BASE_DIR / "templates", db)
+    try:
+        documenti = batch_service.prepara_documenti(
+            user_id,
+            preventivo_ids=richiesta.preventivo_ids,
+            cartella_id=richiesta.cartella_id,
+            template_id=richiesta.template_id
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    if not documenti:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Nessun preventivo attivo da esportare")
+    
+    filename = f"preventivi_{dt_datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip"
+    return StreamingResponse(
+        batch_service.genera_zip(documenti),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}"
+        }
+    )
+
+# ============================================
+# ENDPOINTS JOB PDF ASINCRONI
+# ============================================
+
+def _job_pdf_response(job) -> PdfJobResponse:
+    """Converte un PdfJob del database nella risposta API"""
+    job_id = str(job.id)
+    return PdfJobResponse(
+        job_id=job_id,
+        preventivo_id=str(job.preventivo_id),
+        stato=job.stato,
+        errore=job.errore,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+        status_url=f"/pdf/jobs/{job_id}",
+        download_url=f"/pdf/jobs/{job_id}/download" if job.stato == "done" else None
+    )
+
+@app.post("/preventivo/{preventivo_id}/pdf/jobs", response_model=PdfJobResponse, status_code=status.HTTP_202_ACCEPTED)
+def crea_job_pdf_preventivo(
+    preventivo_id: str,
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    template_id: Optional[str] = Query(None, description="ID del template da utilizzare (opzionale)"),
+    db: Session = Depends(get_db)
+):
+    """
+    Accoda la generazione del PDF di un preventivo salvato e restituisce subito l'ID del job.
+    Lo stato si controlla con GET /pdf/jobs/{job_id}, il file si scarica da /pdf/jobs/{job_id}/download.
+    """
+    job_service = PdfJobService(db)
+    job = job_service.accoda_job(preventivo_id, user_id, template_id)
+    
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Preventivo attivo non trovato")
+    
+    pdf_job_worker.sveglia()
+    return _job_pdf_response(job)
+
+@app.get("/pdf/jobs/{job_id}", response_model=PdfJobResponse)
+def stato_job_pdf(
+    job_id: str,
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    db: Session = Depends(get_db)
+):
+    """
+    Restituisce lo stato di un job PDF: queued, running, done o failed.
+    """
+    job_service = PdfJobService(db)
+    job = job_service.ottieni_job(job_id, user_id)
+    
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job PDF non trovato")
+    
+    return _job_pdf_response(job)
+
+@app.get("/pdf/jobs/{job_id}/download", response_class=Response)
+def scarica_job_pdf(
+    job_id: str,
+    user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
+    db: Session = Depends(get_db)
+):
+    """
+    Scarica il PDF prodotto da un job completato.
+    """
+    job_service = PdfJobService(db)
+    job = job_service.ottieni_job(job_id, user_id, con_pdf=True)
+    
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job PDF non trovato")
+    if job.stato != "done":
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Il PDF non è disponibile: job in stato '{job.stato}'")
+    
+    return Response(
+        content=job.pdf,
+        media_type="application/pdf",
+        headers={
+            "Content-Disposition": f"attachment; filename={job.nome_file}"
+        }
+    )
+
 # ============================================
 # ENDPOINTS TEMPLATE DOCUMENTI
 # ============================================
 
 @app.get("/templates/composer", response_class=HTMLResponse)
-async def template_composer(request: Request):
+def template_composer(request: Request):
     """
     Pagina per la creazione e modifica di template documenti.
     """
     return templates.TemplateResponse("template_composer.html", {"request": request})
 
 @app.get("/templates", response_model=List[DocumentTemplateResponse]) # Aggiornato response_model
-async def lista_template_utente(
+def lista_template_utente(
     document_type: Optional[str] = Query(None, description="Filtra per tipo documento"),
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Restituisce la lista dei template dell'utente
     """
     template_service = DocumentTemplateService(db)
-    templates_db = template_service.get_user_templates(user_id, document_type)
-    
-    # Converte manualmente i template per renderli compatibili con DocumentTemplateResponse
-    result = []
-    for template in templates_db:
-        # Crea un dizionario con tutti i dati del template
-        template_dict = {
-            "id": str(template.id),
-            "user_id": str(template.user_id),
-            "name": template.name,
-            "description": template.description,
-            "document_type": template.document_type,
-            "page_format": template.page_format,
-            "page_orientation": template.page_orientation,
-            "margins": template.margins,
-            "custom_styles": template.custom_styles,
-            "is_default": template.is_default,
-            "is_public": template.is_public,
-            "version": template.version,
-            "created_at": template.created_at,
-            "updated_at": template.updated_at
-        }
-        
-        # Gestisci module_composition in modo speciale
-        if isinstance(template.module_composition, dict):
-            # Converti da dict a ModuleComposition
-            from .models import ModuleComposition, ModuleConfig
-            try:
-                modules = []
-                for module_dict in template.module_composition.get("modules", []):
-                    modules.append(ModuleConfig(**module_dict))
-                template_dict["module_composition"] = ModuleComposition(modules=modules)
-            except Exception as e:
-                print(f"Errore nella conversione di module_composition per template {template.id}: {e}")
-                # Fallback: crea una composizione vuota
-                template_dict["module_composition"] = ModuleComposition(modules=[])
-        else:
-            template_dict["module_composition"] = template.module_composition
-        
-        # Crea l'oggetto DocumentTemplateResponse dal dizionario
-        result.append(DocumentTemplateResponse(**template_dict))
-    
-    return result
+    # Risposte già costruite dalla cache dei template
+    return [template.risposta for template in template_service.templates_utente(user_id, document_type)]
 
 @app.post("/templates", response_class=JSONResponse, status_code=status.HTTP_201_CREATED)
-async def crea_template(
+def crea_template(
     template_data: DocumentTemplateCreate,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     db: Session = Depends(get_db)
@@ -572,58 +895,24 @@ async def crea_template(
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Errore nella creazione del template: {str(e)}")
 
 @app.get("/templates/{template_id}", response_model=DocumentTemplateResponse)
-async def ottieni_template(
+def ottieni_template(
     template_id: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Recupera un template specifico
     """
     template_service = DocumentTemplateService(db)
-    template = template_service.get_template_by_id(template_id, user_id)
+    template = template_service.template_per_id(template_id, user_id)
     
     if not template:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Template non trovato")
     
-    # Converti manualmente il template per renderlo compatibile con DocumentTemplateResponse
-    template_dict = {
-        "id": str(template.id),
-        "user_id": str(template.user_id),
-        "name": template.name,
-        "description": template.description,
-        "document_type": template.document_type,
-        "page_format": template.page_format,
-        "page_orientation": template.page_orientation,
-        "margins": template.margins,
-        "custom_styles": template.custom_styles,
-        "is_default": template.is_default,
-        "is_public": template.is_public,
-        "version": template.version,
-        "created_at": template.created_at,
-        "updated_at": template.updated_at
-    }
-    
-    # Gestisci module_composition in modo speciale
-    if isinstance(template.module_composition, dict):
-        # Converti da dict a ModuleComposition
-        from .models import ModuleComposition, ModuleConfig
-        try:
-            modules = []
-            for module_dict in template.module_composition.get("modules", []):
-                modules.append(ModuleConfig(**module_dict))
-            template_dict["module_composition"] = ModuleComposition(modules=modules)
-        except Exception as e:
-            print(f"Errore nella conversione di module_composition per template {template.id}: {e}")
-            # Fallback: crea una composizione vuota
-            template_dict["module_composition"] = ModuleComposition(modules=[])
-    else:
-        template_dict["module_composition"] = template.module_composition
-    
-    return DocumentTemplateResponse(**template_dict)
+    return template.risposta
 
 @app.put("/templates/{template_id}", response_class=JSONResponse)
-async def aggiorna_template(
+def aggiorna_template(
     template_id: str,
     template_data: DocumentTemplateUpdate,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
@@ -663,7 +952,7 @@ async def aggiorna_template(
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Errore nell'aggiornamento del template: {str(e)}")
 
 @app.delete("/templates/{template_id}", response_class=JSONResponse, status_code=status.HTTP_200_OK)
-async def elimina_template(
+def elimina_template(
     template_id: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     db: Session = Depends(get_db)
@@ -681,59 +970,22 @@ async def elimina_template(
     return {"message": "Template eliminato con successo"}
 
 @app.get("/templates/default/{document_type}", response_model=DocumentTemplateResponse) # Aggiornato response_model
-async def ottieni_template_default(
+def ottieni_template_default(
     document_type: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Recupera il template di default per un tipo di documento
     """
     template_service = DocumentTemplateService(db)
-    template = template_service.get_default_template(user_id, document_type)
-    
-    if not template:
-        # Se non esiste un template default, crea uno di default
-        template = template_service.create_default_template_for_user(user_id)
+    # Se non esiste un template default, usa (creandolo se serve) quello dei preventivi
+    template = template_service.template_default(user_id, document_type) or template_service.risolvi_template_preventivo(user_id)
     
-    # Converti manualmente il template per renderlo compatibile con DocumentTemplateResponse
-    template_dict = {
-        "id": str(template.id),
-        "user_id": str(template.user_id),
-        "name": template.name,
-        "description": template.description,
-        "document_type": template.document_type,
-        "page_format": template.page_format,
-        "page_orientation": template.page_orientation,
-        "margins": template.margins,
-        "custom_styles": template.custom_styles,
-        "is_default": template.is_default,
-        "is_public": template.is_public,
-        "version": template.version,
-        "created_at": template.created_at,
-        "updated_at": template.updated_at
-    }
-    
-    # Gestisci module_composition in modo speciale
-    if isinstance(template.module_composition, dict):
-        # Converti da dict a ModuleComposition
-        from .models import ModuleComposition, ModuleConfig
-        try:
-            modules = []
-            for module_dict in template.module_composition.get("modules", []):
-                modules.append(ModuleConfig(**module_dict))
-            template_dict["module_composition"] = ModuleComposition(modules=modules)
-        except Exception as e:
-            print(f"Errore nella conversione di module_composition per template {template.id}: {e}")
-            # Fallback: crea una composizione vuota
-            template_dict["module_composition"] = ModuleComposition(modules=[])
-    else:
-        template_dict["module_composition"] = template.module_composition
-    
-    return DocumentTemplateResponse(**template_dict)
+    return template.risposta
 
 @app.post("/templates/validate", response_class=JSONResponse)
-async def valida_composizione_moduli(
+def valida_composizione_moduli(
     module_composition: dict,
     db: Session = Depends(get_db)
 ):
@@ -755,6 +1007,42 @@ async def valida_composizione_moduli(
             "warnings": []
         }
 
+def _renderizza_anteprima(request: Request, db: Session, preventivo_data: PreventivoMasterModel, template_config: dict):
+    """Composizione e rendering dell'anteprima (sincroni: eseguiti nel threadpool)"""
+    # Converti il modello Pydantic in un dizionario
+    preventivo_dict = preventivo_data.model_dump()
+    
+    # Usa il DocumentTemplateService per comporre i dati usando la configurazione fornita
+    template_service = DocumentTemplateService(db)
+    
+    # Crea un oggetto template-like dalla configurazione
+    # from .models import ModuleComposition, DocumentTemplateResponse # ModuleComposition non serve qui
+    # from datetime import datetime # Non serve qui
+    
+    # Simula un template con la configurazione fornita
+    mock_template = type('MockTemplate', (), {
+        'id': 'preview',
+        'name': template_config.get('name', 'Preview Template'),
+        'description': template_config.get('description', ''),
+        'document_type': template_config.get('document_type', 'preventivo'),
+        'module_composition': template_config.get('module_composition', {"modules": []}),
+        'page_format': template_config.get('page_format', 'A4'),
+        'page_orientation': template_config.get('page_orientation', 'portrait'),
+        'margins': template_config.get('margins', {"top": 1.2, "bottom": 1.2, "left": 0.8, "right": 0.8}),
+        'custom_styles': template_config.get('custom_styles', ''),
+        'is_default': False,
+        'is_public': False,
+        'version': 1
+    })()
+    
+    # Componi i dati del documento secondo la configurazione del template
+    composed_data = template_service.compose_document_from_template(mock_template, preventivo_dict)
+    
+    return templates.TemplateResponse(
+        "preventivo/preventivo_unificato.html", 
+        {"request": request, **composed_data}
+    )
+
 @app.post("/preventivo/preview", response_class=HTMLResponse)
 async def anteprima_preventivo_con_template(
     request: Request,
@@ -769,50 +1057,10 @@ async def anteprima_preventivo_con_template(
     - template_config: configurazione del template (non salvato)
     """
     try:
-        # Leggi il body della richiesta
-        body = await request.json()
-        
-        # Estrai i dati del preventivo e la configurazione del template
-        preventivo_data = PreventivoMasterModel(**body["preventivo_data"])
-        template_config = body["template_config"]
-        
-        # Calcola i totali
-        calcola_totali_preventivo(preventivo_data)
-        
-        # Converti il modello Pydantic in un dizionario
-        preventivo_dict = preventivo_data.model_dump()
-        
-        # Usa il DocumentTemplateService per comporre i dati usando la configurazione fornita
-        template_service = DocumentTemplateService(db)
-        
-        # Crea un oggetto template-like dalla configurazione
-        # from .models import ModuleComposition, DocumentTemplateResponse # ModuleComposition non serve qui
-        # from datetime import datetime # Non serve qui
-        
-        # Simula un template con la configurazione fornita
-        mock_template = type('MockTemplate', (), {
-            'id': 'preview',
-            'name': template_config.get('name', 'Preview Template'),
-            'description': template_config.get('description', ''),
-            'document_type': template_config.get('document_type', 'preventivo'),
-            'module_composition': template_config.get('module_composition', {"modules": []}),
-            'page_format': template_config.get('page_format', 'A4'),
-            'page_orientation': template_config.get('page_orientation', 'portrait'),
-            'margins': template_config.get('margins', {"top": 1.2, "bottom": 1.2, "left": 0.8, "right": 0.8}),
-            'custom_styles': template_config.get('custom_styles', ''),
-            'is_default': False,
-            'is_public': False,
-            'version': 1
-        })()
-        
-        # Componi i dati del documento secondo la configurazione del template
-        composed_data = template_service.compose_document_from_template(mock_template, preventivo_dict)
-        
-        return templates.TemplateResponse(
-            "preventivo/preventivo_unificato.html", 
-            {"request": request, **composed_data}
-        )
-        
+        # Estrai i dati del preventivo e la configurazione del template,
+        # validati direttamente dal body, e calcola i totali
+        preventivo_data, template_config = await leggi_anteprima(request)
+        return await run_in_threadpool(_renderizza_anteprima, request, db, preventivo_data, template_config)
     except Exception as e:
         # In caso di errore, restituisci un HTML con l'errore
         error_html = f"""
@@ -823,6 +1071,21 @@ async def anteprima_preventivo_con_template(
         """
         return HTMLResponse(content=error_html, status_code=status.HTTP_400_BAD_REQUEST)
 
+# Metriche interne: pool di connessioni del processo (per dimensionarli rispetto a max_connections)
+@app.get("/interno/metriche/db", include_in_schema=False)
+def metriche_database():
+    """
+    Stato dei pool di connessioni di questo worker: connessioni in uso e libere,
+    attese per ottenere una connessione (istogramma in secondi), overflow e timeout.
+    """
+    return metriche_pool()
+
+# Metriche in formato Prometheus: richieste HTTP, rendering PDF, cache, calcolo totali e pool DB
+@app.get("/metrics", include_in_schema=False)
+def metriche_prometheus():
+    """Metriche di questo worker nel formato testuale di Prometheus"""
+    return Response(content=registro_metriche.esporta(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Esempio di come potresti avviare l'app con Uvicorn da riga di comando:
 # uvicorn app.main:app --reload
 # (assicurati di essere nella directory principale del progetto, non dentro 'app/')
@@ -832,9 +1095,9 @@ async def anteprima_preventivo_con_template(
 # ================================
 
 @app.get("/cartelle", response_model=List[CartellaResponse])
-async def lista_cartelle(
+def lista_cartelle(
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Restituisce tutte le cartelle dell'utente con conteggio preventivi
@@ -843,7 +1106,7 @@ async def lista_cartelle(
     return cartella_service.lista_cartelle(user_id, includi_conteggi=True)
 
 @app.post("/cartelle", response_class=JSONResponse, status_code=status.HTTP_201_CREATED)
-async def crea_cartella(
+def crea_cartella(
     cartella_data: CartellaCreate,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     db: Session = Depends(get_db)
@@ -866,10 +1129,10 @@ async def crea_cartella(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Errore nella creazione della cartella: {str(e)}")
 
 @app.get("/cartelle/{cartella_id}", response_model=CartellaResponse)
-async def ottieni_cartella(
+def ottieni_cartella(
     cartella_id: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Ottiene una cartella specifica
@@ -890,7 +1153,7 @@ async def ottieni_cartella(
     return cartella_response
 
 @app.put("/cartelle/{cartella_id}", response_class=JSONResponse)
-async def aggiorna_cartella(
+def aggiorna_cartella(
     cartella_id: str,
     cartella_data: CartellaUpdate,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
@@ -919,7 +1182,7 @@ async def aggiorna_cartella(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Errore nell'aggiornamento della cartella: {str(e)}")
 
 @app.delete("/cartelle/{cartella_id}", response_class=JSONResponse, status_code=status.HTTP_200_OK)
-async def elimina_cartella(
+def elimina_cartella(
     cartella_id: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     sposta_preventivi_a: Optional[str] = Query(None, description="ID della cartella di destinazione per i preventivi"),
@@ -945,7 +1208,7 @@ async def elimina_cartella(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Errore nell'eliminazione della cartella: {str(e)}")
 
 @app.post("/cartelle/sposta-preventivi", response_class=JSONResponse)
-async def sposta_preventivi_in_cartella(
+def sposta_preventivi_in_cartella(
     spostamento: CartellaSpostamento,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     db: Session = Depends(get_db)
@@ -968,13 +1231,20 @@ async def sposta_preventivi_in_cartella(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Errore nello spostamento dei preventivi: {str(e)}")
 
 @app.get("/cartelle/{cartella_id}/preventivi", response_model=List[PreventivoListItemConCartella])
-async def lista_preventivi_cartella(
+def lista_preventivi_cartella(
     cartella_id: str,
+    response: Response,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     stato_record: str = Query("attivo", description="Stato del record: attivo, cestinato"),
-    skip: int = Query(0, ge=0),
+    search: Optional[str] = Query(None, description="Ricerca su numero, nome documento, oggetto e cliente"),
+    stato: Optional[str] = Query(None, description="Stato del preventivo (bozza, inviato, approvato, ...)"),
+    data_da: Optional[date] = Query(None, description="Data di emissione minima (inclusa)"),
+    data_a: Optional[date] = Query(None, description="Data di emissione massima (inclusa)"),
+    sort: str = Query("updated_at_desc", description="Ordinamento: " + ", ".join(ORDINAMENTI_PREVENTIVI)),
+    skip: int = Query(0, ge=0, description="Paginazione a offset (compatibilità); ignorato se è presente cursor"),
     limit: int = Query(100, ge=1, le=500),
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = Query(None, description="Cursore della pagina successiva (header X-Next-Cursor)"),
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Restituisce tutti i preventivi di una cartella specifica
@@ -986,37 +1256,67 @@ async def lista_preventivi_cartella(
     if cartella_id.lower() == 'none':
         cartella_id = 'none'
     
-    return preventivo_service.lista_preventivi_con_cartelle(
-        user_id=user_id, 
-        stato_record=stato_record, 
-        cartella_id=cartella_id, 
-        skip=skip, 
-        limit=limit
-    )
+    try:
+        preventivi, prossimo_cursore = preventivo_service.lista_preventivi_con_cartelle(
+            user_id=user_id, 
+            stato_record=stato_record, 
+            cartella_id=cartella_id, 
+            skip=skip, 
+            limit=limit,
+            cursore=cursor,
+            ricerca=search,
+            stato_preventivo=stato,
+            data_da=data_da,
+            data_a=data_a,
+            ordinamento=sort
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    _imposta_cursore_successivo(response, prossimo_cursore)
+    return preventivi
 
 @app.get("/preventivi/con-cartelle", response_model=List[PreventivoListItemConCartella])
-async def lista_preventivi_con_cartelle(
+def lista_preventivi_con_cartelle(
+    response: Response,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     stato_record: str = Query("attivo", description="Stato del record: attivo, cestinato"),
     cartella_id: Optional[str] = Query(None, description="ID della cartella (opzionale)"),
-    skip: int = Query(0, ge=0),
+    search: Optional[str] = Query(None, description="Ricerca su numero, nome documento, oggetto e cliente"),
+    stato: Optional[str] = Query(None, description="Stato del preventivo (bozza, inviato, approvato, ...)"),
+    data_da: Optional[date] = Query(None, description="Data di emissione minima (inclusa)"),
+    data_a: Optional[date] = Query(None, description="Data di emissione massima (inclusa)"),
+    sort: str = Query("updated_at_desc", description="Ordinamento: " + ", ".join(ORDINAMENTI_PREVENTIVI)),
+    skip: int = Query(0, ge=0, description="Paginazione a offset (compatibilità); ignorato se è presente cursor"),
     limit: int = Query(100, ge=1, le=500),
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = Query(None, description="Cursore della pagina successiva (header X-Next-Cursor)"),
+    db: Session = Depends(get_db_lettura)
 ):
     """
     Restituisce tutti i preventivi con informazioni sulle cartelle
+    (cursore della pagina successiva nell'header X-Next-Cursor)
     """
     preventivo_service = PreventivoService(db)
-    return preventivo_service.lista_preventivi_con_cartelle(
-        user_id=user_id, 
-        stato_record=stato_record, 
-        cartella_id=cartella_id, 
-        skip=skip, 
-        limit=limit
-    )
+    try:
+        preventivi, prossimo_cursore = preventivo_service.lista_preventivi_con_cartelle(
+            user_id=user_id, 
+            stato_record=stato_record, 
+            cartella_id=cartella_id, 
+            skip=skip, 
+            limit=limit,
+            cursore=cursor,
+            ricerca=search,
+            stato_preventivo=stato,
+            data_da=data_da,
+            data_a=data_a,
+            ordinamento=sort
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    _imposta_cursore_successivo(response, prossimo_cursore)
+    return preventivi
 
 @app.post("/preventivo/{preventivo_id}/sposta-cartella", response_class=JSONResponse)
-async def sposta_preventivo_in_cartella(
+def sposta_preventivo_in_cartella(
     preventivo_id: str,
     user_id: str = Query(default="da2cb935-e023-40dd-9703-d918f1066b24", description="ID dell'utente"),
     cartella_id: Optional[str] = Query(None, description="ID della cartella di destinazione (None per rimuovere)"),
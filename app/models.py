@@ -97,6 +97,8 @@ class PreventivoListItem(BaseModel):
     stato_record: Optional[str] = None # Lo stato del record (attivo, cestinato)
     nome_cliente: Optional[str] = None
     valore_totale_lordo: Optional[float] = None
+    data_emissione: Optional[datetime.date] = None
+    data_scadenza: Optional[datetime.date] = None
     created_at: datetime.datetime
     updated_at: datetime.datetime
     cestinato_il: Optional[datetime.datetime] = None
@@ -242,6 +244,8 @@ class PreventivoListItemConCartella(BaseModel):
     stato_preventivo: str
     nome_cliente: Optional[str] = None
     valore_totale_lordo: Optional[float] = None
+    data_emissione: Optional[datetime.date] = None
+    data_scadenza: Optional[datetime.date] = None
     created_at: datetime.datetime
     updated_at: datetime.datetime
     stato_record: str
@@ -251,4 +255,85 @@ class PreventivoListItemConCartella(BaseModel):
     cartella_colore: Optional[str] = None
     
     class Config:
-        from_attributes = True 
\ No newline at end of file
+        from_attributes = True 
+
+# ================================
+# MODELLI JOB PDF ASINCRONI
+# ================================
+
+class PdfJobResponse(BaseModel):
+    job_id: str
+    preventivo_id: str
+    stato: Literal["queued", "running", "done", "failed"]
+    errore: Optional[str] = None
+    created_at: datetime.datetime
+    started_at: Optional[datetime.datetime] = None
+    finished_at: Optional[datetime.datetime] = None
+    status_url: str
+    download_url: Optional[str] = Field(None, description="Disponibile quando il job è in stato 'done'")
+
+class EsportazionePdfRichiesta(BaseModel):
+    cartella_id: Optional[str] = Field(None, description="Esporta tutti i preventivi attivi della cartella")
+    preventivo_ids: Optional[List[str]] = Field(None, description="Esporta i preventivi indicati (alternativo a cartella_id)")
+    template_id: Optional[str] = Field(None, description="Template da usare per tutti i documenti (opzionale)")
+
+# ================================
+# MODELLI RIGHE PREVENTIVO
+# ================================
+
+class RigaPreventivoModifica(BaseModel):
+    """Modifica parziale di una riga: vengono aggiornati solo i campi inviati"""
+    codice_articolo: Optional[str] = None
+    descrizione: Optional[str] = None
+    unita_misura: Optional[str] = None
+    quantita: Optional[float] = None
+    prezzo_unitario_netto: Optional[float] = None
+    percentuale_iva: Optional[float] = None
+    sconto_riga_percentuale: Optional[float] = None
+    note_riga: Optional[str] = None
+
+class RigaPreventivoRisposta(BaseModel):
+    indice: int = Field(..., description="Posizione della riga (da 0)")
+    riga: RigaPreventivo
+    dettagli_totali: SezioneTotali
+
+class RigheOrdinamento(BaseModel):
+    ordine: List[int] = Field(..., description="Indici attuali delle righe nel nuovo ordine")
+
+class TotaliPreventivoRisposta(BaseModel):
+    numero_righe: int
+    dettagli_totali: SezioneTotali
+
+# ================================
+# MODELLI STATISTICHE DASHBOARD
+# ================================
+
+class StatisticaGruppo(BaseModel):
+    numero_preventivi: int
+    valore_totale_lordo: float = Field(0.0, description="Somma dei totali lordi (i preventivi senza totale contano 0)")
+
+class StatisticaStato(StatisticaGruppo):
+    stato_preventivo: Optional[str] = None
+
+class StatisticaCartella(StatisticaGruppo):
+    cartella_id: Optional[str] = Field(None, description="None per i preventivi senza cartella")
+    cartella_nome: Optional[str] = None
+    cartella_colore: Optional[str] = None
+
+class StatisticaMese(StatisticaGruppo):
+    anno: int
+    mese: int
+
+class StatistichePreventivi(BaseModel):
+    stato_record: str
+    numero_preventivi: int
+    valore_totale_lordo: float
+    per_stato: List[StatisticaStato]
+    per_cartella: List[StatisticaCartella]
+    per_mese: List[StatisticaMese] = Field(..., description="Per mese della data di emissione (o di creazione se assente)")
+
+class DatiDashboard(BaseModel):
+    """Dati iniziali della dashboard, caricati con una sola richiesta"""
+    cartelle: List[CartellaResponse]
+    preventivi: List[PreventivoListItemConCartella] = Field(..., description="Prima pagina dei preventivi attivi (cursore successivo nell'header X-Next-Cursor)")
+    templates: List[DocumentTemplateResponse]
@@ -0,0 +1,62 @@
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, TemplateError
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# Directory dei template dell'applicazione (app/templates)
+TEMPLATES_DIR = Path(__file__).resolve().parent.parent / "templates"
+
+# Ricontrolla a ogni richiesta se i file dei template sono cambiati (solo in sviluppo)
+JINJA_AUTO_RELOAD = os.getenv("JINJA_AUTO_RELOAD", "false").lower() == "true"
+# Directory della cache del bytecode compilato, condivisa tra i processi e i riavvii.
+# Vuota = directory temporanea di default di Jinja2
+JINJA_BYTECODE_CACHE_DIR = os.getenv("JINJA_BYTECODE_CACHE_DIR", "")
+
+_ambienti: Dict[str, Environment] = {}
+_lock = threading.Lock()
+
+
+def ambiente_jinja(templates_dir: Optional[Path] = None) -> Environment:
+    """
+    Restituisce l'Environment Jinja2 condiviso per la directory indicata (default: app/templates),
+    creandolo alla prima richiesta. Lo usano sia le pagine HTML sia il rendering dei PDF,
+    così ogni template viene compilato una sola volta per processo.
+    """
+    chiave = str(Path(templates_dir or TEMPLATES_DIR).resolve())
+    with _lock:
+        env = _ambienti.get(chiave)
+        if env is None:
+            if JINJA_BYTECODE_CACHE_DIR:
+                os.makedirs(JINJA_BYTECODE_CACHE_DIR, exist_ok=True)
+            env = Environment(
+                loader=FileSystemLoader(chiave),
+                # Come Jinja2Templates: i template proteggono con |safe il solo contenuto già HTML/CSS
+                autoescape=True,
+                auto_reload=JINJA_AUTO_RELOAD,
+                bytecode_cache=FileSystemBytecodeCache(JINJA_BYTECODE_CACHE_DIR or None),
+            )
+            _ambienti[chiave] = env
+        return env
+
+
+def precompila_template(env: Optional[Environment] = None) -> int:
+    """
+    Compila tutti i template .html dell'ambiente (da chiamare all'avvio), così la prima
+    richiesta non paga la compilazione. Restituisce il numero di template caricati.
+    """
+    env = env or ambiente_jinja()
+    caricati = 0
+    for nome in env.list_templates(extensions=["html"]):
+        try:
+            env.get_template(nome)
+            caricati += 1
+        except TemplateError as e:
+            logger.error(f"❌ Errore nella compilazione del template {nome}: {e}")
+    logger.info(f"✅ {caricati} template Jinja2 precompilati")
+    return caricati
@@ -0,0 +1,298 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, Optional
+
+from sqlalchemy import case, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from ..database import SessionLocal, registro_scritture
+from ..db_models import BozzaPreventivo, Preventivo, UserPreferences
+from ..models import PreventivoMasterModel
+from .preventivo_service import PreventivoService
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# Configurazione del salvataggio automatico (sovrascrivibile da variabili d'ambiente)
+AUTOSAVE_INTERVALLO_DEFAULT = float(os.getenv("AUTOSAVE_INTERVALLO_DEFAULT", "30"))  # se l'utente non ha preferenze
+AUTOSAVE_CONTROLLO_INTERVALLO = float(os.getenv("AUTOSAVE_CONTROLLO_INTERVALLO", "1"))  # frequenza dei controlli delle scadenze
+
+
+class AutosaveBuffer:
+    """
+    Buffer write-behind per il salvataggio automatico dall'editor.
+    L'ultima bozza di ogni preventivo è tenuta nella tabella di appoggio preventivi_bozze
+    e scritta nel preventivo una sola volta per intervallo: le modifiche ravvicinate
+    vengono unite in un'unica scrittura. Il primo salvataggio automatico di una serie
+    fissa la scadenza, i successivi sostituiscono solo il contenuto. Se il contenuto
+    coincide con l'ultimo salvato la scrittura viene saltata.
+    Le bozze sono condivise da tutte le istanze dell'app, che le servono e le scrivono,
+    e sopravvivono a un riavvio; un salvataggio esplicito le rende superate.
+    Una bozza appartiene all'utente che l'ha registrata: le bozze di altri utenti
+    per lo stesso documento vengono rifiutate.
+    Le scritture di uno stesso documento (bozze, salvataggi espliciti, modifiche delle
+    righe) sono serializzate dal lock sulla riga della sua bozza.
+    """
+
+    def __init__(self, intervallo_controllo: float = AUTOSAVE_CONTROLLO_INTERVALLO):
+        self.intervallo_controllo = intervallo_controllo
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def hash_contenuto(dati_json: Dict[str, Any]) -> str:
+        contenuto = json.dumps(dati_json, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(contenuto.encode("utf-8")).hexdigest()
+
+    def in_attesa(self, db: Session, preventivo_id: str, user_id: str) -> bool:
+        """True se c'è una bozza in attesa del documento registrata da questo utente"""
+        return db.query(BozzaPreventivo.preventivo_id).filter(
+            BozzaPreventivo.preventivo_id == preventivo_id,
+            BozzaPreventivo.user_id == user_id,
+            BozzaPreventivo.dati_preventivo.isnot(None)
+        ).first() is not None
+
+    def registra(self, db: Session, preventivo_id: str, user_id: str, dati_json: Dict[str, Any], intervallo: float) -> Optional[float]:
+        """
+        Registra l'ultima versione del documento con un'unica upsert sulla sua bozza.
+        Restituisce i secondi mancanti alla scrittura, o None se il contenuto
+        coincide con quello già salvato (nessuna scrittura necessaria).
+
+        Raises:
+            PermissionError: Se il documento ha una bozza in attesa di un altro utente
+        """
+        adesso = datetime.utcnow()
+        insert = pg_insert if db.get_bind().dialect.name == "postgresql" else sqlite_insert
+        inserimento = insert(BozzaPreventivo).values(
+            preventivo_id=preventivo_id,
+            user_id=user_id,
+            dati_preventivo=dati_json,
+            hash_bozza=self.hash_contenuto(dati_json),
+            scadenza=adesso + timedelta(seconds=intervallo),
+            updated_at=adesso
+        )
+        # Tornati al contenuto salvato: la bozza eventualmente in attesa non serve più
+        invariato = BozzaPreventivo.hash_salvato == inserimento.excluded.hash_bozza
+        istruzione = inserimento.on_conflict_do_update(
+            index_elements=[BozzaPreventivo.preventivo_id],
+            set_={
+                "user_id": inserimento.excluded.user_id,
+                "dati_preventivo": case((invariato, None), else_=inserimento.excluded.dati_preventivo),
+                "hash_bozza": case((invariato, None), else_=inserimento.excluded.hash_bozza),
+                # La prima bozza di una serie fissa la scadenza, le successive sostituiscono solo il contenuto
+                "scadenza": case((invariato, None), else_=func.coalesce(BozzaPreventivo.scadenza, inserimento.excluded.scadenza)),
+                "updated_at": adesso,
+            },
+            where=or_(BozzaPreventivo.dati_preventivo.is_(None), BozzaPreventivo.user_id == inserimento.excluded.user_id)
+        ).returning(BozzaPreventivo.scadenza)
+
+        bozza = db.execute(istruzione).first()
+        db.commit()
+        if bozza is None:
+            raise PermissionError(f"Il preventivo {preventivo_id} ha una bozza in attesa di un altro utente")
+        registro_scritture.segna(user_id)
+        if bozza.scadenza is None:
+            return None
+        return max((bozza.scadenza - adesso).total_seconds(), 0.0)
+
+    def bozza(self, db: Session, preventivo_id: str, user_id: str) -> Optional[PreventivoMasterModel]:
+        """Ultima versione non ancora scritta del documento, se presente"""
+        dati = db.query(BozzaPreventivo.dati_preventivo).filter(
+            BozzaPreventivo.preventivo_id == preventivo_id,
+            BozzaPreventivo.user_id == user_id,
+            BozzaPreventivo.dati_preventivo.isnot(None)
+        ).scalar()
+        return PreventivoMasterModel.model_validate(dati) if dati is not None else None
+
+    @contextmanager
+    def salvataggio_esplicito(self, db: Session, preventivo_id: str, user_id: str, dati_json: Dict[str, Any]) -> Iterator[None]:
+        """
+        Da usare attorno al salvataggio esplicito del documento completo, con la stessa sessione.
+        Blocca la bozza del documento (attendendo l'eventuale scrittura in corso su qualsiasi
+        istanza), la scarta se è dell'utente e registra l'hash del nuovo contenuto: le modifiche
+        vengono confermate dal commit del salvataggio, così nessuna bozza può sovrascriverlo.
+        Se il salvataggio fallisce, ad esempio perché il preventivo non è dell'utente,
+        la bozza resta in attesa.
+        """
+        bozza = self._blocca(db, preventivo_id)
+        if bozza is not None:
+            if bozza.dati_preventivo is not None and str(bozza.user_id) == str(user_id):
+                self._scarta(bozza)
+            bozza.hash_salvato = self.hash_contenuto(dati_json)
+        try:
+            yield
+        except BaseException:
+            db.rollback()
+            raise
+
+    @contextmanager
+    def modifica_diretta(self, preventivo_id: str, user_id: str, db: Session) -> Iterator[None]:
+        """
+        Da usare attorno alle modifiche che non passano dal documento completo (es. le righe).
+        L'eventuale bozza dell'utente viene scritta subito con la sessione indicata:
+        la modifica si applica sopra di essa invece di essere sovrascritta dalla bozza più tardi.
+        """
+        bozza = self._blocca(db, preventivo_id)
+        if bozza is not None and bozza.dati_preventivo is not None and str(bozza.user_id) == str(user_id):
+            try:
+                self._scrivi_bozza(db, bozza)
+            except Exception:
+                db.rollback()
+                raise
+        else:
+            db.rollback()  # Rilascia il lock: non c'è niente da scrivere
+        yield
+        if bozza is not None:
+            # Il contenuto salvato è cambiato: l'ultimo hash noto non è più valido
+            db.execute(update(BozzaPreventivo).where(BozzaPreventivo.preventivo_id == preventivo_id).values(hash_salvato=None))
+            db.commit()
+
+    def segna_salvato(self, db: Session, preventivo_id: str, dati_json: Dict[str, Any]) -> None:
+        """Registra il contenuto appena salvato, per saltare i salvataggi automatici identici"""
+        db.execute(update(BozzaPreventivo).where(BozzaPreventivo.preventivo_id == preventivo_id).values(
+            hash_salvato=self.hash_contenuto(dati_json)
+        ))
+        db.commit()
+
+    def svuota(self, tutte: bool = False) -> int:
+        """Scrive le bozze scadute (o tutte). Restituisce il numero di preventivi aggiornati."""
+        condizioni = [BozzaPreventivo.dati_preventivo.isnot(None)]
+        if not tutte:
+            condizioni.append(BozzaPreventivo.scadenza <= datetime.utcnow())
+
+        scritte = 0
+        db = SessionLocal()
+        try:
+            da_scrivere = db.scalars(select(BozzaPreventivo.preventivo_id).where(*condizioni).order_by(BozzaPreventivo.scadenza)).all()
+            for preventivo_id in da_scrivere:
+                # Le bozze già scritte, scartate o in scrittura su un'altra istanza vengono saltate
+                bozza = db.scalars(
+                    select(BozzaPreventivo).where(BozzaPreventivo.preventivo_id == preventivo_id, *condizioni)
+                    .with_for_update(skip_locked=True)
+                ).first()
+                if bozza is None:
+                    continue
+                try:
+                    if self._scrivi_bozza(db, bozza):
+                        scritte += 1
+                except Exception as e:
+                    db.rollback()
+                    logger.error(f"Errore nel salvataggio automatico del preventivo {preventivo_id}: {e}")
+                    self._rimanda(db, preventivo_id)
+        finally:
+            db.close()
+        return scritte
+
+    @staticmethod
+    def _blocca(db: Session, preventivo_id: str) -> Optional[BozzaPreventivo]:
+        return db.scalars(
+            select(BozzaPreventivo).where(BozzaPreventivo.preventivo_id == preventivo_id).with_for_update(),
+            execution_options={"populate_existing": True}
+        ).first()
+
+    @staticmethod
+    def _scarta(bozza: BozzaPreventivo) -> None:
+        bozza.dati_preventivo = bozza.hash_bozza = bozza.scadenza = None
+
+    def _scrivi_bozza(self, db: Session, bozza: BozzaPreventivo) -> bool:
+        """
+        Scrive la bozza (con la sua riga già bloccata) nel preventivo; la bozza viene tolta
+        dalla tabella nello stesso commit. False se il preventivo non è modificabile
+        """
+        preventivo_id, user_id, dati_json = str(bozza.preventivo_id), str(bozza.user_id), bozza.dati_preventivo
+        bozza.hash_salvato = bozza.hash_bozza
+        self._scarta(bozza)
+        db_preventivo = PreventivoService(db).aggiorna_preventivo(
+            preventivo_id, PreventivoMasterModel.model_validate(dati_json), user_id, dati_json
+        )
+        if db_preventivo is None:
+            db.commit()  # La bozza di un preventivo non più modificabile non serve
+            logger.warning(f"Salvataggio automatico ignorato: preventivo {preventivo_id} non trovato o non attivo")
+            return False
+        return True
+
+    @staticmethod
+    def _rimanda(db: Session, preventivo_id) -> None:
+        """Riprova più tardi; il contenuto resta quello più recente registrato"""
+        db.execute(update(BozzaPreventivo).where(
+            BozzaPreventivo.preventivo_id == preventivo_id,
+            BozzaPreventivo.dati_preventivo.isnot(None)
+        ).values(scadenza=datetime.utcnow() + timedelta(seconds=AUTOSAVE_INTERVALLO_DEFAULT)))
+        db.commit()
+
+    def avvia(self) -> None:
+        if self._task:
+            return
+        self._task = asyncio.create_task(self._ciclo())
+        logger.info("Salvataggio automatico dei preventivi avviato")
+
+    async def arresta(self) -> None:
+        """Ferma il ciclo e scrive tutte le bozze ancora in attesa"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        scritte = await asyncio.to_thread(self.svuota, True)
+        if scritte:
+            logger.info(f"Salvataggio automatico: {scritte} bozze scritte allo spegnimento")
+
+    async def _ciclo(self) -> None:
+        while True:
+            try:
+                # Le scritture sono sincrone: vengono eseguite in un thread per non bloccare il loop
+                await asyncio.to_thread(self.svuota)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Errore nel salvataggio automatico dei preventivi: {e}")
+            await asyncio.sleep(self.intervallo_controllo)
+
+
+# Istanza condivisa dall'applicazione
+autosave_buffer = AutosaveBuffer()
+
+
+class AutosaveService:
+    """Accoda i salvataggi automatici dell'editor nel buffer condiviso"""
+
+    def __init__(self, db: Session, buffer: AutosaveBuffer = autosave_buffer):
+        self.db = db
+        self.buffer = buffer
+
+    def registra(self, preventivo_id: str, user_id: str, preventivo_data: PreventivoMasterModel, preventivo_json: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Registra la bozza del preventivo. Restituisce None se il preventivo attivo non esiste.
+        Il preventivo e le preferenze vengono letti solo per la prima bozza di ogni serie di
+        modifiche dello stesso utente: per gli altri la proprietà del preventivo viene sempre verificata.
+        """
+        intervallo = AUTOSAVE_INTERVALLO_DEFAULT
+        if not self.buffer.in_attesa(self.db, preventivo_id, user_id):
+            esiste = self.db.query(Preventivo.id).filter(
+                Preventivo.id == preventivo_id,
+                Preventivo.user_id == user_id,
+                Preventivo.stato_record == "attivo"
+            ).first()
+            if not esiste:
+                return None
+            preferenza = self.db.query(UserPreferences.auto_save_interval).filter(
+                UserPreferences.user_id == user_id
+            ).scalar()
+            if preferenza and preferenza > 0:
+                intervallo = float(preferenza)
+
+        if preventivo_json is None:
+            preventivo_json = preventivo_data.model_dump(mode="json")
+        try:
+            secondi = self.buffer.registra(self.db, preventivo_id, user_id, preventivo_json, intervallo)
+        except PermissionError as e:
+            logger.warning(str(e))
+            return None
+        if secondi is None:
+            return {"stato": "invariato", "salvataggio_tra_secondi": None}
+        return {"stato": "in_attesa", "salvataggio_tra_secondi": round(secondi, 1)}
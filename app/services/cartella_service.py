@@ -1,11 +1,63 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from typing import List, Optional
+from sqlalchemy import Select, func, select
+from typing import TYPE_CHECKING, List, Optional
 import uuid
 from datetime import datetime
 
+from ..database import registro_scritture
 from ..db_models import Cartella, Preventivo, User
 from ..models import CartellaCreate, CartellaUpdate, CartellaResponse, CartellaSpostamento
+from .statistiche_service import statistiche_cache
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+
+# Query condivise da CartellaService e AsyncCartellaService
+
+def _query_cartelle(user_id: str, includi_conteggi: bool) -> Select:
+    """Cartelle dell'utente; con i conteggi ogni riga ha anche numero_preventivi (attivi)"""
+    query = select(Cartella).where(Cartella.user_id == user_id)
+    
+    if includi_conteggi:
+        # Join con conteggio preventivi attivi
+        query = query.outerjoin(
+            Preventivo, 
+            (Preventivo.cartella_id == Cartella.id) & 
+            (Preventivo.stato_record == "attivo")
+        ).add_columns(
+            func.count(Preventivo.id).label('numero_preventivi')
+        ).group_by(Cartella.id)
+    
+    return query.order_by(Cartella.ordine, Cartella.nome)
+
+
+def _risposte_cartelle(righe: list, includi_conteggi: bool) -> List[CartellaResponse]:
+    """Converte le righe di _query_cartelle in CartellaResponse"""
+    return [
+        CartellaResponse(
+            id=str(riga.Cartella.id),
+            user_id=str(riga.Cartella.user_id),
+            nome=riga.Cartella.nome,
+            descrizione=riga.Cartella.descrizione,
+            colore=riga.Cartella.colore,
+            icona=riga.Cartella.icona,
+            parent_id=str(riga.Cartella.parent_id) if riga.Cartella.parent_id else None,
+            ordine=riga.Cartella.ordine,
+            created_at=riga.Cartella.created_at,
+            updated_at=riga.Cartella.updated_at,
+            numero_preventivi=(riga.numero_preventivi or 0) if includi_conteggi else 0
+        )
+        for riga in righe
+    ]
+
+
+def _query_cartella(cartella_id: str, user_id: str) -> Select:
+    return select(Cartella).where(
+        Cartella.id == cartella_id,
+        Cartella.user_id == user_id
+    )
+
 
 class CartellaService:
     
@@ -44,6 +96,7 @@ class CartellaService:
         self.db.add(db_cartella)
         self.db.commit()
         self.db.refresh(db_cartella)
+        registro_scritture.segna(user_id)
         
         return db_cartella
     
@@ -51,63 +104,14 @@ class CartellaService:
         """
         Restituisce tutte le cartelle dell'utente con conteggio preventivi.
         """
-        query = self.db.query(Cartella).filter(Cartella.user_id == user_id)
-        
-        if includi_conteggi:
-            # Join con conteggio preventivi attivi
-            query = query.outerjoin(
-                Preventivo, 
-                (Preventivo.cartella_id == Cartella.id) & 
-                (Preventivo.stato_record == "attivo")
-            ).add_columns(
-                func.count(Preventivo.id).label('numero_preventivi')
-            ).group_by(Cartella.id)
-        
-        cartelle = query.order_by(Cartella.ordine, Cartella.nome).all()
-        
-        if includi_conteggi:
-            return [
-                CartellaResponse(
-                    id=str(cartella.Cartella.id),
-                    user_id=str(cartella.Cartella.user_id),
-                    nome=cartella.Cartella.nome,
-                    descrizione=cartella.Cartella.descrizione,
-                    colore=cartella.Cartella.colore,
-                    icona=cartella.Cartella.icona,
-                    parent_id=str(cartella.Cartella.parent_id) if cartella.Cartella.parent_id else None,
-                    ordine=cartella.Cartella.ordine,
-                    created_at=cartella.Cartella.created_at,
-                    updated_at=cartella.Cartella.updated_at,
-                    numero_preventivi=cartella.numero_preventivi or 0
-                )
-                for cartella in cartelle
-            ]
-        else:
-            return [
-                CartellaResponse(
-                    id=str(cartella.id),
-                    user_id=str(cartella.user_id),
-                    nome=cartella.nome,
-                    descrizione=cartella.descrizione,
-                    colore=cartella.colore,
-                    icona=cartella.icona,
-                    parent_id=str(cartella.parent_id) if cartella.parent_id else None,
-                    ordine=cartella.ordine,
-                    created_at=cartella.created_at,
-                    updated_at=cartella.updated_at,
-                    numero_preventivi=0
-                )
-                for cartella in cartelle
-            ]
+        righe = self.db.execute(_query_cartelle(user_id, includi_conteggi)).all()
+        return _risposte_cartelle(righe, includi_conteggi)
     
     def ottieni_cartella(self, cartella_id: str, user_id: str) -> Optional[Cartella]:
         """
         Ottiene una cartella specifica dell'utente.
         """
-        return self.db.query(Cartella).filter(
-            Cartella.id == cartella_id,
-            Cartella.user_id == user_id
-        ).first()
+        return self.db.scalars(_query_cartella(cartella_id, user_id)).first()
     
     def aggiorna_cartella(self, cartella_id: str, cartella_data: CartellaUpdate, user_id: str) -> Optional[Cartella]:
         """
@@ -140,6 +144,9 @@ class CartellaService:
         
         self.db.commit()
         self.db.refresh(db_cartella)
+        registro_scritture.segna(user_id)
+        # Nome e colore compaiono nelle statistiche per cartella
+        statistiche_cache.invalida_utente(user_id)
         
         return db_cartella
     
@@ -176,6 +183,8 @@ class CartellaService:
         # Elimina la cartella
         self.db.delete(db_cartella)
         self.db.commit()
+        registro_scritture.segna(user_id)
+        statistiche_cache.invalida_utente(user_id)
         
         return True
     
@@ -209,6 +218,8 @@ class CartellaService:
         )
         
         self.db.commit()
+        registro_scritture.segna(user_id)
+        statistiche_cache.invalida_utente(user_id)
         return num_aggiornati
     
     def ottieni_preventivi_cartella(self, cartella_id: Optional[str], user_id: str, stato_record: str = "attivo") -> List[Preventivo]:
@@ -252,4 +263,20 @@ class CartellaService:
             
             current_id = str(parent.parent_id) if parent and parent.parent_id else None
         
-        return False 
\ No newline at end of file
+        return False
+
+
+class AsyncCartellaService:
+    """Letture di CartellaService su AsyncSession, con le stesse query. Le scritture restano in CartellaService."""
+    
+    def __init__(self, db: "AsyncSession"):
+        self.db = db
+    
+    async def lista_cartelle(self, user_id: str, includi_conteggi: bool = True) -> List[CartellaResponse]:
+        """Come CartellaService.lista_cartelle"""
+        righe = (await self.db.execute(_query_cartelle(user_id, includi_conteggi))).all()
+        return _risposte_cartelle(righe, includi_conteggi)
+    
+    async def ottieni_cartella(self, cartella_id: str, user_id: str) -> Optional[Cartella]:
+        """Come CartellaService.ottieni_cartella"""
+        return (await self.db.scalars(_query_cartella(cartella_id, user_id))).first()
@@ -1,8 +1,12 @@
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import Select, select
 from sqlalchemy.orm import Session
-from typing import List, Optional, Dict, Any
+from typing import TYPE_CHECKING, List, Optional, Dict, Any
 import uuid
 from datetime import datetime
 
+from ..database import registro_scritture
 from ..db_models import DocumentTemplate, User, UserPreferences
 from ..models import (
     DocumentTemplateCreate, 
@@ -11,6 +15,43 @@ from ..models import (
     ModuleComposition,
     ModuleConfig
 )
+from .pdf_cache import pdf_cache
+from .template_cache import TemplateInCache, template_cache
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+
+# Query condivise da DocumentTemplateService e AsyncDocumentTemplateService
+
+def _query_templates_utente(user_id: str, document_type: Optional[str] = None) -> Select:
+    query = select(DocumentTemplate).where(DocumentTemplate.user_id == user_id)
+    
+    if document_type:
+        query = query.where(DocumentTemplate.document_type == document_type)
+        
+    return query.order_by(DocumentTemplate.is_default.desc(), DocumentTemplate.created_at.desc())
+
+
+def _query_versioni_templates(user_id: str) -> Select:
+    """Solo (id, version) dei template dell'utente: basta a verificare la cache"""
+    return select(DocumentTemplate.id, DocumentTemplate.version).where(DocumentTemplate.user_id == user_id)
+
+
+def _query_template(template_id: str, user_id: str) -> Select:
+    return select(DocumentTemplate).where(
+        DocumentTemplate.id == template_id,
+        DocumentTemplate.user_id == user_id
+    )
+
+
+def _query_template_default(user_id: str, document_type: str) -> Select:
+    return select(DocumentTemplate).where(
+        DocumentTemplate.user_id == user_id,
+        DocumentTemplate.document_type == document_type,
+        DocumentTemplate.is_default == True
+    )
+
 
 class DocumentTemplateService:
     """Servizio per gestire template documenti personalizzabili"""
@@ -102,24 +143,18 @@ class DocumentTemplateService:
         self.db.add(db_template)
         self.db.commit()
         self.db.refresh(db_template)
+        template_cache.invalida_utente(user_id)
+        registro_scritture.segna(user_id)
         
         return db_template
     
     def get_user_templates(self, user_id: str, document_type: Optional[str] = None) -> List[DocumentTemplate]:
         """Recupera template utente, opzionalmente filtrati per tipo documento"""
-        query = self.db.query(DocumentTemplate).filter(DocumentTemplate.user_id == user_id)
-        
-        if document_type:
-            query = query.filter(DocumentTemplate.document_type == document_type)
-            
-        return query.order_by(DocumentTemplate.is_default.desc(), DocumentTemplate.created_at.desc()).all()
+        return list(self.db.scalars(_query_templates_utente(user_id, document_type)))
     
     def get_template_by_id(self, template_id: str, user_id: str) -> Optional[DocumentTemplate]:
         """Recupera un template specifico dell'utente"""
-        return self.db.query(DocumentTemplate).filter(
-            DocumentTemplate.id == template_id,
-            DocumentTemplate.user_id == user_id
-        ).first()
+        return self.db.scalars(_query_template(template_id, user_id)).first()
     
     def update_template(self, template_id: str, user_id: str, update_data: DocumentTemplateUpdate) -> Optional[DocumentTemplate]:
         """Aggiorna un template esistente"""
@@ -141,11 +176,17 @@ class DocumentTemplateService:
         for field, value in update_dict.items():
             setattr(db_template, field, value)
         
+        # Ogni modifica genera una nuova versione: le chiavi di cache dei PDF la includono
+        db_template.version = (db_template.version or 1) + 1
         db_template.updated_at = datetime.utcnow()
         
         self.db.commit()
         self.db.refresh(db_template)
         
+        pdf_cache.invalida_template(template_id)
+        template_cache.invalida_utente(user_id)
+        registro_scritture.segna(user_id)
+        
         return db_template
     
     def delete_template(self, template_id: str, user_id: str) -> bool:
@@ -159,19 +200,45 @@ class DocumentTemplateService:
         
         self.db.delete(db_template)
         self.db.commit()
+        pdf_cache.invalida_template(template_id)
+        template_cache.invalida_utente(user_id)
+        registro_scritture.segna(user_id)
         
         return True
     
     def get_default_template(self, user_id: str, document_type: str = "preventivo") -> Optional[DocumentTemplate]:
         """Recupera il template di default per un tipo di documento"""
-        return self.db.query(DocumentTemplate).filter(
-            DocumentTemplate.user_id == user_id,
-            DocumentTemplate.document_type == document_type,
-            DocumentTemplate.is_default == True
-        ).first()
+        return self.db.scalars(_query_template_default(user_id, document_type)).first()
+    
+    def templates_utente(self, user_id: str, document_type: Optional[str] = None) -> List[TemplateInCache]:
+        """
+        Template dell'utente dalla cache (stesso ordine di get_user_templates).
+        Con la cache valida legge solo le versioni dei template; altrimenti li legge tutti con una query.
+        """
+        templates = template_cache.leggi(user_id, self.db.execute(_query_versioni_templates(user_id)).all())
+        if templates is None:
+            generazione = template_cache.generazione(user_id)
+            templates = [TemplateInCache.da_db(t) for t in self.get_user_templates(user_id)]
+            template_cache.salva(user_id, generazione, templates)
+        if document_type:
+            return [t for t in templates if t.document_type == document_type]
+        return templates
+    
+    def template_per_id(self, template_id: str, user_id: str) -> Optional[TemplateInCache]:
+        """Come get_template_by_id, dalla cache: per il rendering, non per le modifiche"""
+        return next((t for t in self.templates_utente(user_id) if str(t.id) == str(template_id)), None)
+    
+    def template_default(self, user_id: str, document_type: str = "preventivo") -> Optional[TemplateInCache]:
+        """Come get_default_template, dalla cache"""
+        return next((t for t in self.templates_utente(user_id, document_type) if t.is_default), None)
     
     def create_default_template_for_user(self, user_id: str) -> DocumentTemplate:
-        """Crea il template di default per un nuovo utente"""
+        """
+        Crea il template di default per un utente che non ne ha uno e lo restituisce.
+        L'inserimento usa ON CONFLICT DO NOTHING sull'indice unico parziale
+        (user_id, document_type) WHERE is_default: con richieste concorrenti ne viene
+        creato uno solo e tutte ricevono quello.
+        """
         default_template = DocumentTemplateCreate(
             name="Preventivo Standard A4 Verticale",
             description="Template di default che replica il comportamento standard del sistema",
@@ -184,8 +251,49 @@ class DocumentTemplateService:
             is_public=False
         )
         
-        return self.create_template(user_id, default_template)
-    
+        adesso = datetime.utcnow()
+        insert = pg_insert if self.db.get_bind().dialect.name == "postgresql" else sqlite_insert
+        risultato = self.db.execute(
+            insert(DocumentTemplate).values(
+                id=uuid.uuid4(),
+                user_id=user_id,
+                version=1,
+                created_at=adesso,
+                updated_at=adesso,
+                **default_template.model_dump(mode="json")
+            ).on_conflict_do_nothing(
+                index_elements=[DocumentTemplate.user_id, DocumentTemplate.document_type],
+                index_where=DocumentTemplate.is_default
+            )
+        )
+        self.db.commit()
+        if risultato.rowcount:
+            template_cache.invalida_utente(user_id)
+            registro_scritture.segna(user_id)
+        
+        return self.get_default_template(user_id, default_template.document_type)
+
+    def risolvi_template_preventivo(self, user_id: str, template_id: Optional[str] = None, template_id_preventivo: Optional[str] = None) -> Optional[TemplateInCache]:
+        """
+        Risolve il template da usare per renderizzare un preventivo (anteprima, PDF, visualizzazione):
+        1. il template richiesto esplicitamente (None se non esiste)
+        2. il template associato al preventivo, se esiste ancora
+        3. il template di default dell'utente, creato una sola volta se manca
+        I template vengono dalla cache: con la cache valida legge solo le loro versioni.
+        """
+        if template_id:
+            return self.template_per_id(template_id, user_id)
+
+        if template_id_preventivo:
+            template = self.template_per_id(template_id_preventivo, user_id)
+            if template:
+                return template
+
+        template = self.template_default(user_id, "preventivo")
+        if not template:
+            template = TemplateInCache.da_db(self.create_default_template_for_user(user_id))
+        return template
+
     def compose_document_from_template(self, template: DocumentTemplate, document_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         Genera la struttura dati per renderizzare un documento usando un template specifico.
@@ -264,8 +372,8 @@ class DocumentTemplateService:
             DocumentTemplate.document_type == document_type,
             DocumentTemplate.is_default == True
         ).update({DocumentTemplate.is_default: False})
-        
-        self.db.commit()
+        # Il commit è quello del chiamante: tolto il vecchio default e impostato il nuovo
+        # nella stessa transazione, l'indice unico dei default resta sempre rispettato
     
     def _convert_template_for_response(self, template: DocumentTemplate) -> DocumentTemplate:
         """Converte un template dal database per renderlo compatibile con DocumentTemplateResponse"""
@@ -285,4 +393,46 @@ class DocumentTemplateService:
                 # Fallback: crea una composizione vuota
                 template.module_composition = ModuleComposition(modules=[])
         
-        return template 
\ No newline at end of file
+        return template
+
+
+class AsyncDocumentTemplateService:
+    """
+    Letture di DocumentTemplateService su AsyncSession, con le stesse query e la stessa cache
+    dei template. Le scritture (compresa la creazione del template di default) restano
+    in DocumentTemplateService.
+    """
+    
+    def __init__(self, db: "AsyncSession"):
+        self.db = db
+    
+    async def get_user_templates(self, user_id: str, document_type: Optional[str] = None) -> List[DocumentTemplate]:
+        """Come DocumentTemplateService.get_user_templates"""
+        return list(await self.db.scalars(_query_templates_utente(user_id, document_type)))
+    
+    async def get_template_by_id(self, template_id: str, user_id: str) -> Optional[DocumentTemplate]:
+        """Come DocumentTemplateService.get_template_by_id"""
+        return (await self.db.scalars(_query_template(template_id, user_id))).first()
+    
+    async def get_default_template(self, user_id: str, document_type: str = "preventivo") -> Optional[DocumentTemplate]:
+        """Come DocumentTemplateService.get_default_template"""
+        return (await self.db.scalars(_query_template_default(user_id, document_type))).first()
+    
+    async def templates_utente(self, user_id: str, document_type: Optional[str] = None) -> List[TemplateInCache]:
+        """Come DocumentTemplateService.templates_utente"""
+        templates = template_cache.leggi(user_id, (await self.db.execute(_query_versioni_templates(user_id))).all())
+        if templates is None:
+            generazione = template_cache.generazione(user_id)
+            templates = [TemplateInCache.da_db(t) for t in await self.get_user_templates(user_id)]
+            template_cache.salva(user_id, generazione, templates)
+        if document_type:
+            return [t for t in templates if t.document_type == document_type]
+        return templates
+    
+    async def template_per_id(self, template_id: str, user_id: str) -> Optional[TemplateInCache]:
+        """Come DocumentTemplateService.template_per_id"""
+        return next((t for t in await self.templates_utente(user_id) if str(t.id) == str(template_id)), None)
+    
+    async def template_default(self, user_id: str, document_type: str = "preventivo") -> Optional[TemplateInCache]:
+        """Come DocumentTemplateService.template_default"""
+        return next((t for t in await self.templates_utente(user_id, document_type) if t.is_default), None)
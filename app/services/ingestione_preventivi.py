@@ -0,0 +1,76 @@
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
+
+from ..models import PreventivoMasterModel
+from .preventivo_calculator import calcola_totali_preventivo
+
+
+class _RichiestaPreventivo(PreventivoMasterModel):
+    # Il form invia user_id insieme al documento, ma non fa parte del documento
+    user_id: Optional[str] = Field(default=None, exclude=True)
+
+
+class _RichiestaAnteprima(BaseModel):
+    preventivo_data: PreventivoMasterModel
+    template_config: Dict[str, Any]
+
+
+class DocumentoRicevuto:
+    """
+    Documento letto dal body di una richiesta, con i totali già calcolati.
+    La serializzazione JSON (per il database, l'hash del salvataggio automatico, ...)
+    viene fatta una sola volta e riusata.
+    """
+
+    def __init__(self, preventivo: PreventivoMasterModel, user_id: Optional[str] = None):
+        self.preventivo = preventivo
+        self.user_id = user_id
+        self._json: Optional[Dict[str, Any]] = None
+
+    @property
+    def json(self) -> Dict[str, Any]:
+        if self._json is None:
+            self._json = self.preventivo.model_dump(mode="json")
+        return self._json
+
+
+async def leggi_documento(request: Request) -> DocumentoRicevuto:
+    """
+    Valida il body della richiesta (un PreventivoMasterModel, con user_id opzionale)
+    direttamente dai byte, senza passare da un dizionario Python, e calcola i totali.
+    Validazione e calcolo sono CPU-bound e proporzionali alle righe: girano nel
+    threadpool, il loop attende solo la lettura del body.
+
+    Raises:
+        ValidationError: Se il body non è JSON valido o non è un preventivo valido
+    """
+    corpo = await request.body()
+    return await run_in_threadpool(_valida_documento, corpo)
+
+
+async def leggi_anteprima(request: Request) -> Tuple[PreventivoMasterModel, Dict[str, Any]]:
+    """
+    Valida il body dell'anteprima del Template Composer ({preventivo_data, template_config})
+    e calcola i totali, nel threadpool come leggi_documento.
+    Restituisce il preventivo e la configurazione del template.
+
+    Raises:
+        ValidationError: Se il body non è valido
+    """
+    corpo = await request.body()
+    return await run_in_threadpool(_valida_anteprima, corpo)
+
+
+def _valida_documento(corpo: bytes) -> DocumentoRicevuto:
+    richiesta = _RichiestaPreventivo.model_validate_json(corpo)
+    calcola_totali_preventivo(richiesta)
+    return DocumentoRicevuto(richiesta, richiesta.user_id)
+
+
+def _valida_anteprima(corpo: bytes) -> Tuple[PreventivoMasterModel, Dict[str, Any]]:
+    richiesta = _RichiestaAnteprima.model_validate_json(corpo)
+    calcola_totali_preventivo(richiesta.preventivo_data)
+    return richiesta.preventivo_data, richiesta.template_config
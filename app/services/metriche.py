@@ -0,0 +1,193 @@
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Soglie (secondi) degli istogrammi di durata
+SOGLIE_DURATA_RICHIESTE = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SOGLIE_DURATA_RENDERING = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+SOGLIE_DURATA_CALCOLO = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+# Campione di una metrica raccolta al momento dell'esportazione: (nome, etichette, valore).
+# Il nome include l'eventuale suffisso (_bucket, _sum, _count per gli istogrammi)
+Campione = Tuple[str, Dict[str, str], float]
+
+
+def _formatta_valore(valore: float) -> str:
+    if math.isinf(valore):
+        return "+Inf" if valore > 0 else "-Inf"
+    if float(valore).is_integer():
+        return str(int(valore))
+    return repr(float(valore))
+
+
+def _formatta_etichette(etichette: Dict[str, str]) -> str:
+    if not etichette:
+        return ""
+    coppie = []
+    for nome, valore in etichette.items():
+        valore = str(valore).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        coppie.append(f'{nome}="{valore}"')
+    return "{" + ",".join(coppie) + "}"
+
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nome: str, descrizione: str, etichette: Sequence[str] = ()):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        self._lock = threading.Lock()
+
+    def _chiave(self, valori: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(valori[etichetta]) for etichetta in self.etichette)
+
+    def righe(self) -> List[str]:
+        return [f"# HELP {self.nome} {self.descrizione}", f"# TYPE {self.nome} {self.tipo}"] + self._campioni()
+
+    def _campioni(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Contatore(_Metrica):
+    """Valore che può solo crescere (richieste, PDF generati, ...)"""
+    tipo = "counter"
+
+    def __init__(self, nome: str, descrizione: str, etichette: Sequence[str] = ()):
+        super().__init__(nome, descrizione, etichette)
+        self._valori: Dict[Tuple[str, ...], float] = {}
+        if not self.etichette:
+            self._valori[()] = 0  # Esportato anche prima del primo incremento
+
+    def incrementa(self, quantita: float = 1, **etichette) -> None:
+        chiave = self._chiave(etichette)
+        with self._lock:
+            self._valori[chiave] = self._valori.get(chiave, 0) + quantita
+
+    def valore(self, **etichette) -> float:
+        with self._lock:
+            return self._valori.get(self._chiave(etichette), 0)
+
+    def _campioni(self) -> List[str]:
+        with self._lock:
+            valori = sorted(self._valori.items())
+        return [
+            f"{self.nome}{_formatta_etichette(dict(zip(self.etichette, chiave)))} {_formatta_valore(valore)}"
+            for chiave, valore in valori
+        ]
+
+
+class Indicatore(Contatore):
+    """Valore che sale e scende (richieste in corso, ...)"""
+    tipo = "gauge"
+
+    def decrementa(self, quantita: float = 1, **etichette) -> None:
+        self.incrementa(-quantita, **etichette)
+
+
+class Istogramma(_Metrica):
+    """Distribuzione di durate per soglie cumulative, con somma e conteggio"""
+    tipo = "histogram"
+
+    def __init__(self, nome: str, descrizione: str, etichette: Sequence[str] = (), soglie: Sequence[float] = SOGLIE_DURATA_RICHIESTE):
+        super().__init__(nome, descrizione, etichette)
+        self.soglie = tuple(sorted(soglie))
+        # chiave -> (conteggi per soglia, somma, conteggio)
+        self._serie: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def osserva(self, valore: float, **etichette) -> None:
+        chiave = self._chiave(etichette)
+        with self._lock:
+            conteggi, somma, conteggio = self._serie.get(chiave) or ([0] * len(self.soglie), 0.0, 0)
+            for indice, soglia in enumerate(self.soglie):
+                if valore <= soglia:
+                    conteggi[indice] += 1
+            self._serie[chiave] = (conteggi, somma + valore, conteggio + 1)
+
+    def conteggio(self, **etichette) -> int:
+        with self._lock:
+            serie = self._serie.get(self._chiave(etichette))
+            return serie[2] if serie else 0
+
+    def _campioni(self) -> List[str]:
+        with self._lock:
+            serie = sorted((chiave, (list(conteggi), somma, conteggio)) for chiave, (conteggi, somma, conteggio) in self._serie.items())
+        righe = []
+        for chiave, (conteggi, somma, conteggio) in serie:
+            etichette = dict(zip(self.etichette, chiave))
+            for soglia, cumulato in zip(self.soglie + (math.inf,), conteggi + [conteggio]):
+                righe.append(f"{self.nome}_bucket{_formatta_etichette({**etichette, 'le': _formatta_valore(soglia)})} {cumulato}")
+            righe.append(f"{self.nome}_sum{_formatta_etichette(etichette)} {_formatta_valore(somma)}")
+            righe.append(f"{self.nome}_count{_formatta_etichette(etichette)} {conteggio}")
+        return righe
+
+
+class RegistroMetriche:
+    """
+    Metriche del processo, esportate nel formato testuale di Prometheus (versione 0.0.4)
+    dall'endpoint /metrics. Ogni worker uvicorn ha le sue: Prometheus le raccoglie per istanza.
+    Oltre alle metriche aggiornate dal codice, all'esportazione vengono lette le "raccolte":
+    funzioni che restituiscono valori tenuti altrove (es. i contatori dei pool di connessioni).
+    """
+
+    def __init__(self):
+        self._metriche: List[_Metrica] = []
+        self._raccolte: List[Callable[[], Iterable[Tuple[str, str, str, List[Campione]]]]] = []
+        self._lock = threading.Lock()
+
+    def _registra(self, metrica):
+        with self._lock:
+            self._metriche.append(metrica)
+        return metrica
+
+    def contatore(self, nome: str, descrizione: str, etichette: Sequence[str] = ()) -> Contatore:
+        return self._registra(Contatore(nome, descrizione, etichette))
+
+    def indicatore(self, nome: str, descrizione: str, etichette: Sequence[str] = ()) -> Indicatore:
+        return self._registra(Indicatore(nome, descrizione, etichette))
+
+    def istogramma(self, nome: str, descrizione: str, etichette: Sequence[str] = (), soglie: Sequence[float] = SOGLIE_DURATA_RICHIESTE) -> Istogramma:
+        return self._registra(Istogramma(nome, descrizione, etichette, soglie))
+
+    def aggiungi_raccolta(self, raccolta: Callable[[], Iterable[Tuple[str, str, str, List[Campione]]]]) -> None:
+        """Registra una funzione che restituisce (nome, tipo, descrizione, campioni) per ogni metrica"""
+        with self._lock:
+            self._raccolte.append(raccolta)
+
+    def esporta(self) -> str:
+        with self._lock:
+            metriche, raccolte = list(self._metriche), list(self._raccolte)
+        righe = []
+        for metrica in metriche:
+            righe.extend(metrica.righe())
+        for raccolta in raccolte:
+            for nome, tipo, descrizione, campioni in raccolta():
+                righe.append(f"# HELP {nome} {descrizione}")
+                righe.append(f"# TYPE {nome} {tipo}")
+                righe.extend(
+                    f"{nome_campione}{_formatta_etichette(etichette)} {_formatta_valore(valore)}"
+                    for nome_campione, etichette, valore in campioni
+                )
+        return "\n".join(righe) + "\n"
+
+
+# Istanza condivisa dall'applicazione
+registro_metriche = RegistroMetriche()
+
+# Richieste HTTP (aggiornate dal middleware in main.py); route è il template del percorso
+richieste_http = registro_metriche.contatore(
+    "http_requests_total", "Richieste HTTP servite", ("method", "route", "status"))
+durata_richieste_http = registro_metriche.istogramma(
+    "http_request_duration_seconds", "Durata delle richieste HTTP fino all'invio degli header", ("method", "route", "status"))
+richieste_http_in_corso = registro_metriche.indicatore(
+    "http_requests_in_flight", "Richieste HTTP in corso")
+
+# Metriche di dominio
+pdf_generati = registro_metriche.contatore(
+    "preventivi_pdf_rendered_total", "PDF renderizzati con WeasyPrint, per esito", ("mode", "outcome"))
+durata_rendering_pdf = registro_metriche.istogramma(
+    "preventivi_pdf_render_seconds", "Durata del rendering PDF (per mode=pool compresa l'attesa di un worker libero)", ("mode",), SOGLIE_DURATA_RENDERING)
+richieste_cache = registro_metriche.contatore(
+    "preventivi_cache_requests_total", "Letture dalle cache in memoria e su disco", ("cache", "result"))
+durata_calcolo_totali = registro_metriche.istogramma(
+    "preventivi_calculator_seconds", "Durata del calcolo dei totali (per chiamata, anche su più preventivi)", (), SOGLIE_DURATA_CALCOLO)
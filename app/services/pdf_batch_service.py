@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import re
+import zipfile
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from ..models import PreventivoMasterModel
+from .document_template_service import DocumentTemplateService
+from .pdf_export_service import PDFExportService
+from .pdf_render_pool import PDF_RENDER_WORKERS
+from .preventivo_service import PreventivoService
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# PDF renderizzati contemporaneamente da un singolo export (e quindi tenuti in memoria al massimo)
+PDF_BATCH_CONCORRENZA = int(os.getenv("PDF_BATCH_CONCORRENZA", str(PDF_RENDER_WORKERS)))
+# Numero massimo di preventivi in un singolo archivio
+PDF_BATCH_MAX_DOCUMENTI = int(os.getenv("PDF_BATCH_MAX_DOCUMENTI", "500"))
+
+# Documento pronto per il rendering: (preventivo_id, nome_file, dati, template)
+DocumentoExport = Tuple[str, str, PreventivoMasterModel, object]
+
+
+class _FlussoZip:
+    """
+    Destinazione non posizionabile per zipfile: i byte scritti vengono accumulati
+    finché non sono prelevati con preleva(), così l'archivio viene inviato a pezzi
+    senza essere mai tenuto per intero in memoria.
+    """
+
+    def __init__(self):
+        self._parti: List[bytes] = []
+        self._posizione = 0
+
+    def write(self, dati: bytes) -> int:
+        self._parti.append(bytes(dati))
+        self._posizione += len(dati)
+        return len(dati)
+
+    def tell(self) -> int:
+        return self._posizione
+
+    def flush(self) -> None:
+        pass
+
+    def preleva(self) -> bytes:
+        dati = b"".join(self._parti)
+        self._parti = []
+        return dati
+
+
+class PDFBatchExportService:
+    """
+    Export di più preventivi in un unico archivio ZIP.
+    I dati e i template vengono caricati prima di iniziare lo streaming; i PDF sono
+    generati in parallelo nel pool di rendering e aggiunti all'archivio man mano
+    che vengono completati.
+    """
+
+    def __init__(self, templates_dir: Path, db: Session):
+        self.templates_dir = templates_dir
+        self.db = db
+
+    def prepara_documenti(self, user_id: str, preventivo_ids: Optional[List[str]] = None, cartella_id: Optional[str] = None, template_id: Optional[str] = None) -> List[DocumentoExport]:
+        """
+        Carica i preventivi da esportare e risolve il template di ciascuno
+        con le stesse regole del download singolo.
+
+        Raises:
+            ValueError: Se il template richiesto non esiste o ci sono troppi documenti
+        """
+        preventivi = PreventivoService(self.db).carica_preventivi_per_export(user_id, preventivo_ids=preventivo_ids, cartella_id=cartella_id)
+        if len(preventivi) > PDF_BATCH_MAX_DOCUMENTI:
+            raise ValueError(f"Troppi preventivi da esportare ({len(preventivi)}), massimo {PDF_BATCH_MAX_DOCUMENTI}")
+
+        template_service = DocumentTemplateService(self.db)
+        template_risolti: Dict[Optional[str], object] = {}
+        nomi_usati = set()
+        documenti = []
+
+        for preventivo_id, preventivo_data in preventivi:
+            # Molti preventivi condividono lo stesso template: lo risolviamo una volta sola
+            template_id_preventivo = preventivo_data.metadati_preventivo.template_id
+            chiave = template_id or template_id_preventivo
+            if chiave not in template_risolti:
+                template_risolti[chiave] = template_service.risolvi_template_preventivo(
+                    user_id,
+                    template_id=template_id,
+                    template_id_preventivo=template_id_preventivo
+                )
+            template = template_risolti[chiave]
+            if not template:
+                raise ValueError("Template non trovato")
+
+            numero_preventivo = preventivo_data.metadati_preventivo.numero_preventivo or preventivo_id
+            nome_file = self._nome_file_univoco(f"preventivo_{numero_preventivo}", nomi_usati)
+            documenti.append((preventivo_id, nome_file, preventivo_data, template))
+
+        return documenti
+
+    async def genera_zip(self, documenti: List[DocumentoExport], concorrenza: int = PDF_BATCH_CONCORRENZA) -> AsyncIterator[bytes]:
+        """
+        Genera l'archivio ZIP restituendo i byte a pezzi, uno per ogni PDF completato.
+        Al massimo `concorrenza` PDF sono in lavorazione contemporaneamente; i documenti
+        che non è stato possibile generare sono elencati in ERRORI.txt.
+        """
+        pdf_service = PDFExportService(self.templates_dir, db=self.db)
+        flusso = _FlussoZip()
+        errori = []
+        da_avviare = iter(documenti)
+        in_corso = {}
+
+        def avvia_prossimo() -> None:
+            documento = next(da_avviare, None)
+            if documento is not None:
+                preventivo_id, _, preventivo_data, template = documento
+                task = asyncio.create_task(
+                    pdf_service.genera_pdf_preventivo_con_template_async(preventivo_data, template, preventivo_id=preventivo_id)
+                )
+                in_corso[task] = documento
+
+        try:
+            # PDF già compressi: ZIP_STORED evita di ricomprimerli
+            with zipfile.ZipFile(flusso, mode="w", compression=zipfile.ZIP_STORED) as archivio:
+                for _ in range(max(1, concorrenza)):
+                    avvia_prossimo()
+
+                while in_corso:
+                    completati, _ = await asyncio.wait(in_corso, return_when=asyncio.FIRST_COMPLETED)
+                    for task in completati:
+                        _, nome_file, _, _ = in_corso.pop(task)
+                        avvia_prossimo()
+                        try:
+                            archivio.writestr(nome_file, task.result())
+                        except Exception as e:
+                            logger.error(f"Export ZIP: errore per {nome_file}: {e}")
+                            errori.append(f"{nome_file}: {e}")
+                    dati = flusso.preleva()
+                    if dati:
+                        yield dati
+
+                if errori:
+                    archivio.writestr("ERRORI.txt", "\n".join(errori) + "\n")
+            yield flusso.preleva()
+        finally:
+            # Client disconnesso: non lasciamo rendering orfani
+            for task in in_corso:
+                task.cancel()
+
+        logger.info(f"Export ZIP completato: {len(documenti) - len(errori)} PDF, {len(errori)} errori")
+
+    @staticmethod
+    def _nome_file_univoco(base: str, nomi_usati: set) -> str:
+        """Nome file sicuro per l'archivio, con suffisso se già presente"""
+        base = re.sub(r"[^\w.\-]+", "_", base).strip("._") or "preventivo"
+        nome = f"{base}.pdf"
+        contatore = 2
+        while nome in nomi_usati:
+            nome = f"{base}_{contatore}.pdf"
+            contatore += 1
+        nomi_usati.add(nome)
+        return nome
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from importlib import metadata
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set
+
+from ..models import PreventivoMasterModel
+from .ambiente_jinja import TEMPLATES_DIR
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# Configurazione della cache (sovrascrivibile da variabili d'ambiente)
+PDF_CACHE_DIR = Path(os.getenv("PDF_CACHE_DIR", str(Path(tempfile.gettempdir()) / "app-preventivi-pdf-cache")))
+# Dimensione massima complessiva dei PDF su disco. 0 = cache disabilitata
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Versione dell'applicazione (es. il commit del deploy), inclusa nella chiave delle voci
+APP_VERSION = os.getenv("APP_VERSION", "")
+
+# Sorgenti Python che determinano l'HTML del PDF, oltre ai template Jinja2
+_SORGENTI_RENDERING = ("pdf_export_service.py", "document_template_service.py", "preventivo_calculator.py", "../models.py")
+
+
+@lru_cache(maxsize=None)
+def impronta_rendering(templates_dir: Path = TEMPLATES_DIR) -> str:
+    """
+    Hash dei template Jinja2, del codice che compone l'HTML, della versione di WeasyPrint
+    e di APP_VERSION, calcolato una volta per processo. Fa parte della chiave delle voci:
+    dopo un deploy che cambia il layout i PDF generati prima non vengono più serviti.
+    """
+    impronta = hashlib.sha256()
+    sorgenti = sorted(Path(templates_dir).rglob("*"))
+    sorgenti += [Path(__file__).parent / nome for nome in _SORGENTI_RENDERING]
+    for percorso in sorgenti:
+        if percorso.is_file():
+            impronta.update(percorso.name.encode("utf-8"))
+            impronta.update(percorso.read_bytes())
+    try:
+        impronta.update(metadata.version("weasyprint").encode("utf-8"))
+    except metadata.PackageNotFoundError:
+        pass
+    impronta.update(APP_VERSION.encode("utf-8"))
+    return impronta.hexdigest()
+
+
+class PDFCache:
+    """
+    Cache su disco dei PDF generati, indirizzata per contenuto.
+
+    La chiave è l'hash dei dati del preventivo, di id e versione del template e
+    dell'impronta del rendering (file dei template, codice, APP_VERSION): se uno
+    cambia cambia anche la chiave, quindi una voce non può mai restituire un PDF
+    non aggiornato, anche dopo un riavvio. L'invalidazione esplicita (per preventivo
+    o per template) serve a liberare subito lo spazio occupato dalle voci superate;
+    i tag di ogni voce sono salvati accanto al PDF, così vale anche per le voci
+    scritte prima di un riavvio. Le voci oltre la dimensione massima vengono rimosse
+    in ordine LRU (per prime quelle con un'impronta superata, mai più lette).
+    """
+
+    def __init__(self, directory: Path = PDF_CACHE_DIR, max_bytes: int = PDF_CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._voci: "OrderedDict[str, int]" = OrderedDict()  # chiave -> dimensione, dalla meno recente
+        self._chiavi_per_tag: Dict[str, Set[str]] = {}
+        self._tag_per_chiave: Dict[str, Set[str]] = {}
+        self._dimensione_totale = 0
+        self._indice_caricato = False
+        self._lock = threading.Lock()
+
+    @property
+    def abilitata(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def calcola_chiave(preventivo_data: PreventivoMasterModel, template, impronta: Optional[str] = None) -> str:
+        """Hash SHA-256 dei dati del preventivo, dell'id e della versione del template e dell'impronta del rendering"""
+        payload = json.dumps(
+            {
+                "documento": preventivo_data.model_dump(mode="json"),
+                "template_id": str(template.id),
+                "template_version": template.version,
+                "rendering": impronta or impronta_rendering(),
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, chiave: str) -> Optional[bytes]:
+        """Restituisce il PDF in cache, o None se assente"""
+        if not self.abilitata:
+            return None
+
+        with self._lock:
+            self._carica_indice()
+            if chiave not in self._voci:
+                return None
+            self._voci.move_to_end(chiave)
+
+        percorso = self._percorso(chiave)
+        try:
+            pdf_bytes = percorso.read_bytes()
+            os.utime(percorso)  # Mantiene l'ordine LRU anche dopo un riavvio
+            return pdf_bytes
+        except OSError:
+            # Il file può essere stato rimosso da un altro processo che condivide la directory
+            with self._lock:
+                self._rimuovi(chiave, elimina_file=False)
+            return None
+
+    def put(self, chiave: str, pdf_bytes: bytes, tags: Iterable[str] = ()) -> None:
+        """Salva un PDF in cache associandolo ai tag usati per l'invalidazione"""
+        if not self.abilitata or len(pdf_bytes) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._carica_indice()
+            percorso = self._percorso(chiave)
+            # Scrittura atomica: un lettore concorrente non vede mai un file parziale
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as tmp_file:
+                tmp_file.write(pdf_bytes)
+            os.replace(tmp_file.name, percorso)
+            tags = set(tags) | self._tag_per_chiave.get(chiave, set())
+            if tags:
+                self._scrivi_tag(chiave, tags)
+
+            if chiave in self._voci:
+                self._dimensione_totale -= self._voci[chiave]
+            self._voci[chiave] = len(pdf_bytes)
+            self._voci.move_to_end(chiave)
+            self._dimensione_totale += len(pdf_bytes)
+
+            for tag in tags:
+                self._chiavi_per_tag.setdefault(tag, set()).add(chiave)
+                self._tag_per_chiave.setdefault(chiave, set()).add(tag)
+
+            # Evizione LRU fino a rientrare nel limite
+            while self._dimensione_totale > self.max_bytes and self._voci:
+                chiave_lru = next(iter(self._voci))
+                self._rimuovi(chiave_lru)
+
+    def invalida_preventivo(self, preventivo_id: str) -> int:
+        """Rimuove i PDF generati per un preventivo salvato"""
+        return self._invalida_tag(f"preventivo:{preventivo_id}")
+
+    def invalida_template(self, template_id: str) -> int:
+        """Rimuove i PDF generati con un template"""
+        return self._invalida_tag(f"template:{template_id}")
+
+    def svuota(self) -> None:
+        """Rimuove tutte le voci della cache"""
+        with self._lock:
+            self._carica_indice()
+            for chiave in list(self._voci):
+                self._rimuovi(chiave)
+
+    def stato(self) -> dict:
+        """Dimensione e occupazione della cache, per diagnostica"""
+        with self._lock:
+            return {
+                "enabled": self.abilitata,
+                "entries": len(self._voci),
+                "size_bytes": self._dimensione_totale,
+                "max_bytes": self.max_bytes,
+            }
+
+    @staticmethod
+    def tags_per(template, preventivo_id: Optional[str] = None) -> list:
+        """Tag di invalidazione per un PDF generato con un template (e, se salvato, per il suo preventivo)"""
+        tags = [f"template:{template.id}"]
+        if preventivo_id:
+            tags.append(f"preventivo:{preventivo_id}")
+        return tags
+
+    def _invalida_tag(self, tag: str) -> int:
+        if not self.abilitata:
+            return 0
+        with self._lock:
+            self._carica_indice()
+            chiavi = self._chiavi_per_tag.pop(tag, set())
+            for chiave in chiavi:
+                self._rimuovi(chiave)
+            return len(chiavi)
+
+    def _percorso(self, chiave: str) -> Path:
+        return self.directory / f"{chiave}.pdf"
+
+    def _percorso_tag(self, chiave: str) -> Path:
+        return self.directory / f"{chiave}.tags.json"
+
+    def _scrivi_tag(self, chiave: str, tags: Set[str]) -> None:
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, suffix=".tmp", delete=False) as tmp_file:
+            json.dump(sorted(tags), tmp_file)
+        os.replace(tmp_file.name, self._percorso_tag(chiave))
+
+    def _leggi_tag(self, chiave: str) -> Set[str]:
+        try:
+            return set(json.loads(self._percorso_tag(chiave).read_text()))
+        except (OSError, ValueError):
+            return set()
+
+    def _carica_indice(self) -> None:
+        """Ricostruisce l'indice LRU e i tag dai file presenti su disco (una sola volta per processo)"""
+        if self._indice_caricato:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        file_esistenti = []
+        for percorso in self.directory.glob("*.pdf"):
+            try:
+                stat = percorso.stat()
+            except OSError:
+                continue
+            file_esistenti.append((stat.st_mtime, percorso.stem, stat.st_size))
+        for _, chiave, dimensione in sorted(file_esistenti):
+            self._voci[chiave] = dimensione
+            self._dimensione_totale += dimensione
+            for tag in self._leggi_tag(chiave):
+                self._chiavi_per_tag.setdefault(tag, set()).add(chiave)
+                self._tag_per_chiave.setdefault(chiave, set()).add(tag)
+        self._indice_caricato = True
+        if file_esistenti:
+            logger.info(f"Cache PDF: {len(file_esistenti)} voci caricate da {self.directory}")
+
+    def _rimuovi(self, chiave: str, elimina_file: bool = True) -> None:
+        """Rimuove una voce dall'indice (e dal disco). Da chiamare con il lock acquisito"""
+        dimensione = self._voci.pop(chiave, None)
+        if dimensione is not None:
+            self._dimensione_totale -= dimensione
+        for tag in self._tag_per_chiave.pop(chiave, set()):
+            chiavi = self._chiavi_per_tag.get(tag)
+            if chiavi is not None:
+                chiavi.discard(chiave)
+                if not chiavi:
+                    del self._chiavi_per_tag[tag]
+        if elimina_file:
+            for percorso in (self._percorso(chiave), self._percorso_tag(chiave)):
+                try:
+                    percorso.unlink()
+                except FileNotFoundError:
+                    pass
+
+
+# Istanza condivisa dal processo API
+pdf_cache = PDFCache()
@@ -1,9 +1,10 @@
 from pathlib import Path
 import logging
 from typing import Optional, Union
-from jinja2 import Environment, FileSystemLoader
 import tempfile
+import time
 from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
 
 # Setup logger
 logger = logging.getLogger(__name__)
@@ -27,6 +28,10 @@ except Exception as e:
 
 from ..models import PreventivoMasterModel
 from ..services.preventivo_calculator import calcola_totali_preventivo
+from .pdf_render_pool import pdf_render_pool
+from .pdf_cache import pdf_cache
+from .ambiente_jinja import ambiente_jinja
+from .metriche import durata_rendering_pdf, pdf_generati, richieste_cache
 
 
 class PDFExportService:
@@ -40,11 +45,11 @@ class PDFExportService:
         Inizializza il servizio con la directory dei template
         
         Args:
-            templates_dir: Path alla directory contenente i template Jinja2
+            templates_dir: Path alla directory contenente i template Jinja2 (l'Environment è condiviso)
             db: SQLAlchemy Session opzionale, necessaria per usare DocumentTemplateService
         """
         self.templates_dir = templates_dir
-        self.env = Environment(loader=FileSystemLoader(str(templates_dir)))
+        self.env = ambiente_jinja(templates_dir)
         self.is_available = WEASYPRINT_AVAILABLE
         self.db = db
         
@@ -74,7 +79,7 @@ class PDFExportService:
         
         try:
             # Assicuriamoci che i totali siano calcolati
-            calcola_totali_preventivo(preventivo_data)
+            preventivo_data = self._con_totali_calcolati(preventivo_data)
             
             # Renderizza l'HTML usando il template unificato
             html_content = self._renderizza_html_pdf(preventivo_data)
@@ -127,11 +132,18 @@ class PDFExportService:
         Returns:
             bytes: PDF generato
         """
-        # Crea il documento HTML
-        html_doc = HTML(string=html_content)
-        
-        # Genera il PDF
-        pdf_bytes = html_doc.write_pdf()
+        inizio = time.perf_counter()
+        try:
+            # Crea il documento HTML
+            html_doc = HTML(string=html_content)
+            
+            # Genera il PDF
+            pdf_bytes = html_doc.write_pdf()
+        except Exception:
+            pdf_generati.incrementa(mode="inline", outcome="error")
+            raise
+        pdf_generati.incrementa(mode="inline", outcome="ok")
+        durata_rendering_pdf.osserva(time.perf_counter() - inizio, mode="inline")
         
         return pdf_bytes
     
@@ -171,6 +183,8 @@ class PDFExportService:
         return {
             "available": self.is_available,
             "weasyprint_installed": WEASYPRINT_AVAILABLE,
+            "render_pool": pdf_render_pool.stato(),
+            "cache": pdf_cache.stato(),
             "message": "✅ Export PDF disponibile" if self.is_available else 
                       "❌ Export PDF non disponibile - WeasyPrint non installato correttamente"
         }
@@ -198,11 +212,7 @@ class PDFExportService:
             )
         
         try:
-            # Assicuriamoci che i totali siano calcolati
-            calcola_totali_preventivo(preventivo_data)
-            
-            # Renderizza l'HTML usando il template specifico
-            html_content = self._renderizza_html_pdf_con_template(preventivo_data, template)
+            html_content = self._prepara_html_con_template(preventivo_data, template)
             
             # Genera il PDF usando SOLO l'HTML (il CSS è incorporato nel template)
             pdf_bytes = self._genera_pdf_da_html(html_content)
@@ -214,6 +224,85 @@ class PDFExportService:
             logger.error(f"❌ Errore nella generazione PDF con template: {e}")
             raise Exception(f"Errore nella generazione del PDF con template: {str(e)}")
     
+    async def genera_pdf_preventivo_con_template_async(self, preventivo_data: PreventivoMasterModel, template, preventivo_id: Optional[str] = None) -> bytes:
+        """
+        Come genera_pdf_preventivo_con_template, ma il rendering WeasyPrint avviene
+        nel pool di processi dedicato e la preparazione dell'HTML nel threadpool:
+        l'endpoint attende il risultato senza bloccare il loop.
+        Se lo stesso documento è già stato generato con la stessa versione del template,
+        il PDF viene restituito dalla cache senza ricalcolo né rendering.
+        
+        Args:
+            preventivo_data: Dati del preventivo validati
+            template: Template oggetto (dalla DocumentTemplateService)
+            preventivo_id: ID del preventivo salvato, se presente (per l'invalidazione della cache)
+            
+        Returns:
+            bytes: Contenuto del PDF
+            
+        Raises:
+            RuntimeError: Se WeasyPrint non è disponibile
+            TimeoutError: Se il rendering supera il timeout del pool
+            Exception: Altri errori di generazione PDF
+        """
+        if not self.is_available:
+            raise RuntimeError(
+                "❌ Export PDF non disponibile. "
+                "WeasyPrint non è installato correttamente. "
+                "Consulta la documentazione per l'installazione delle dipendenze di sistema."
+            )
+        
+        try:
+            # Hash del documento, composizione e Jinja2 nel threadpool: non bloccano il loop
+            chiave_cache = await run_in_threadpool(pdf_cache.calcola_chiave, preventivo_data, template)
+            pdf_bytes = pdf_cache.get(chiave_cache)
+            richieste_cache.incrementa(cache="pdf", result="hit" if pdf_bytes is not None else "miss")
+            if pdf_bytes is not None:
+                logger.debug(f"PDF servito dalla cache per preventivo {preventivo_data.metadati_preventivo.numero_preventivo}")
+                return pdf_bytes
+            
+            html_content = await run_in_threadpool(self._prepara_html_con_template, preventivo_data, template)
+            
+            pdf_bytes = await pdf_render_pool.render(html_content)
+            pdf_cache.put(chiave_cache, pdf_bytes, pdf_cache.tags_per(template, preventivo_id))
+            
+            logger.info(f"✅ PDF generato con successo per preventivo {preventivo_data.metadati_preventivo.numero_preventivo} con template {template.name}")
+            return pdf_bytes
+            
+        except TimeoutError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Errore nella generazione PDF con template: {e}")
+            raise Exception(f"Errore nella generazione del PDF con template: {str(e)}")
+    
+    def _prepara_html_con_template(self, preventivo_data: PreventivoMasterModel, template) -> str:
+        """
+        Calcola i totali e renderizza l'HTML da convertire in PDF
+        
+        Args:
+            preventivo_data: Dati del preventivo
+            template: Template da utilizzare
+            
+        Returns:
+            str: HTML renderizzato
+        """
+        # Assicuriamoci che i totali siano calcolati
+        preventivo_data = self._con_totali_calcolati(preventivo_data)
+        
+        # Renderizza l'HTML usando il template specifico
+        return self._renderizza_html_pdf_con_template(preventivo_data, template)
+    
+    @staticmethod
+    def _con_totali_calcolati(preventivo_data: PreventivoMasterModel) -> PreventivoMasterModel:
+        """
+        Copia del preventivo con i totali ricalcolati. Il modello ricevuto può essere quello
+        della cache dei preventivi, condiviso tra i thread, quindi non viene modificato;
+        la copia costa poco rispetto al rendering WeasyPrint.
+        """
+        preventivo_data = preventivo_data.model_copy(deep=True)
+        calcola_totali_preventivo(preventivo_data)
+        return preventivo_data
+    
     def _renderizza_html_pdf_con_template(self, preventivo_data: PreventivoMasterModel, template) -> str:
         """
         Renderizza l'HTML del preventivo usando un template specifico e il DocumentTemplateService
@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session, defer
+
+from ..database import SessionLocal
+from ..db_models import PdfJob, Preventivo
+from .document_template_service import DocumentTemplateService
+from .pdf_export_service import PDFExportService
+from .pdf_render_pool import PDF_RENDER_WORKERS
+from .preventivo_service import PreventivoService
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# Configurazione della coda (sovrascrivibile da variabili d'ambiente)
+PDF_JOB_WORKER_ENABLED = os.getenv("PDF_JOB_WORKER_ENABLED", "true").lower() == "true"
+# Job elaborati in parallelo da ogni istanza dell'app
+PDF_JOB_CONCORRENZA = int(os.getenv("PDF_JOB_CONCORRENZA", str(PDF_RENDER_WORKERS)))
+# Attesa (secondi) dopo aver trovato la coda vuota; raddoppia a ogni controllo a vuoto
+# fino a PDF_JOB_POLL_MAX_INTERVAL. I job accodati da questa istanza svegliano subito il worker
+PDF_JOB_POLL_INTERVAL = float(os.getenv("PDF_JOB_POLL_INTERVAL", "1.0"))
+PDF_JOB_POLL_MAX_INTERVAL = float(os.getenv("PDF_JOB_POLL_MAX_INTERVAL", "30"))
+# Ore dopo la conclusione (done/failed) in cui un job e il suo PDF vengono eliminati. 0 = mai
+PDF_JOB_TTL_ORE = float(os.getenv("PDF_JOB_TTL_ORE", "24"))
+PDF_JOB_PULIZIA_INTERVALLO = float(os.getenv("PDF_JOB_PULIZIA_INTERVALLO", "3600"))
+PDF_JOB_PULIZIA_BLOCCO = 500
+# Un job "running" da più di così viene considerato abbandonato (istanza terminata) e ripreso
+PDF_JOB_LEASE_SECONDS = int(os.getenv("PDF_JOB_LEASE_SECONDS", "300"))
+PDF_JOB_MAX_TENTATIVI = int(os.getenv("PDF_JOB_MAX_TENTATIVI", "3"))
+
+
+class PdfJobService:
+    """
+    Coda dei job di generazione PDF, salvata nella tabella pdf_jobs.
+    Più istanze dell'app condividono la coda senza broker esterni:
+    il prelievo usa SELECT ... FOR UPDATE SKIP LOCKED, quindi ogni job
+    viene assegnato a un solo worker.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def accoda_job(self, preventivo_id: str, user_id: str, template_id: Optional[str] = None) -> Optional[PdfJob]:
+        """
+        Accoda la generazione del PDF di un preventivo attivo.
+        Restituisce None se il preventivo non esiste.
+        """
+        esiste = self.db.query(Preventivo.id).filter(
+            Preventivo.id == preventivo_id,
+            Preventivo.user_id == user_id,
+            Preventivo.stato_record == "attivo"
+        ).first()
+        if not esiste:
+            return None
+
+        job = PdfJob(
+            user_id=user_id,
+            preventivo_id=preventivo_id,
+            template_id=template_id,
+            stato="queued",
+            tentativi=0
+        )
+        self.db.add(job)
+        self.db.commit()
+        self.db.refresh(job)
+        return job
+
+    def ottieni_job(self, job_id: str, user_id: str, con_pdf: bool = False) -> Optional[PdfJob]:
+        """Recupera un job dell'utente; il contenuto del PDF viene caricato solo se richiesto"""
+        query = self.db.query(PdfJob).filter(
+            PdfJob.id == job_id,
+            PdfJob.user_id == user_id
+        )
+        if not con_pdf:
+            query = query.options(defer(PdfJob.pdf))
+        return query.first()
+
+    def preleva_prossimo_job(self) -> Optional[PdfJob]:
+        """
+        Preleva il job più vecchio in coda (o abbandonato da un'istanza terminata)
+        e lo marca come "running". Le righe bloccate da altri worker vengono saltate.
+        """
+        while True:
+            lease_scaduto = datetime.utcnow() - timedelta(seconds=PDF_JOB_LEASE_SECONDS)
+            job = self.db.query(PdfJob).options(defer(PdfJob.pdf)).filter(
+                (PdfJob.stato == "queued") |
+                ((PdfJob.stato == "running") & (PdfJob.started_at < lease_scaduto))
+            ).order_by(PdfJob.created_at).with_for_update(skip_locked=True).first()
+
+            if not job:
+                self.db.rollback()  # Chiude la transazione aperta dal SELECT
+                return None
+
+            if job.tentativi >= PDF_JOB_MAX_TENTATIVI:
+                job.stato = "failed"
+                job.errore = f"Job abbandonato dopo {job.tentativi} tentativi"
+                job.finished_at = datetime.utcnow()
+                self.db.commit()
+                continue
+
+            job.stato = "running"
+            job.tentativi += 1
+            job.started_at = datetime.utcnow()
+            self.db.commit()
+            return job
+
+    def completa_job(self, job: PdfJob, pdf_bytes: bytes, nome_file: str) -> None:
+        job.stato = "done"
+        job.pdf = pdf_bytes
+        job.nome_file = nome_file
+        job.errore = None
+        job.finished_at = datetime.utcnow()
+        self.db.commit()
+
+    def fallisci_job(self, job: PdfJob, errore: str) -> None:
+        job.stato = "failed"
+        job.errore = errore
+        job.finished_at = datetime.utcnow()
+        self.db.commit()
+
+    def elimina_job_conclusi(self, ore: float = PDF_JOB_TTL_ORE, dimensione_blocco: int = PDF_JOB_PULIZIA_BLOCCO) -> int:
+        """
+        Elimina i job done/failed conclusi da più di `ore` ore, con i loro PDF, a blocchi
+        in transazioni brevi. Restituisce il numero di job eliminati.
+        """
+        cutoff = datetime.utcnow() - timedelta(hours=ore)
+        eliminati = 0
+        while True:
+            blocco = select(PdfJob.id).where(
+                PdfJob.stato.in_(("done", "failed")),
+                PdfJob.finished_at < cutoff
+            ).limit(dimensione_blocco).with_for_update(skip_locked=True)
+            risultato = self.db.execute(
+                delete(PdfJob)
+                .where(PdfJob.id.in_(blocco.scalar_subquery()))
+                .execution_options(synchronize_session=False)
+            )
+            self.db.commit()
+            eliminati += risultato.rowcount
+            if risultato.rowcount < dimensione_blocco:
+                return eliminati
+
+
+class PdfJobWorker:
+    """
+    Worker in-process che esegue i job della coda PDF.
+    Un solo ciclo per istanza controlla la coda quando c'è un consumatore libero
+    (al massimo PDF_JOB_CONCORRENZA job in parallelo, renderizzati nel pool di processi PDF).
+    Con la coda vuota l'intervallo tra i controlli cresce fino a PDF_JOB_POLL_MAX_INTERVAL,
+    così un'istanza inattiva interroga il database di rado; sveglia() fa controllare
+    subito la coda dopo un accodamento. Lo stesso worker elimina periodicamente i job
+    conclusi da più di PDF_JOB_TTL_ORE ore.
+    """
+
+    def __init__(
+        self,
+        templates_dir: Path,
+        concorrenza: int = PDF_JOB_CONCORRENZA,
+        intervallo_polling: float = PDF_JOB_POLL_INTERVAL,
+        intervallo_polling_massimo: float = PDF_JOB_POLL_MAX_INTERVAL,
+    ):
+        self.templates_dir = templates_dir
+        self.concorrenza = max(1, concorrenza)
+        self.intervallo_polling = intervallo_polling
+        self.intervallo_polling_massimo = max(intervallo_polling, intervallo_polling_massimo)
+        self._tasks: List[asyncio.Task] = []
+        self._in_corso: Set[asyncio.Task] = set()
+        self._sveglia: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def avvia(self) -> None:
+        if self._tasks:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._sveglia = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._ciclo())]
+        if PDF_JOB_TTL_ORE > 0:
+            self._tasks.append(asyncio.create_task(self._pulizia()))
+        logger.info(f"Worker job PDF avviato (fino a {self.concorrenza} job in parallelo)")
+
+    async def arresta(self) -> None:
+        for task in self._tasks + list(self._in_corso):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._in_corso, return_exceptions=True)
+        self._tasks = []
+        self._in_corso.clear()
+
+    def sveglia(self) -> None:
+        """Fa controllare subito la coda (thread-safe: gli endpoint sincroni girano nel threadpool)"""
+        if self._loop is not None and self._sveglia is not None:
+            self._loop.call_soon_threadsafe(self._sveglia.set)
+
+    async def _ciclo(self) -> None:
+        attesa = self.intervallo_polling
+        libero = asyncio.Semaphore(self.concorrenza)
+        while True:
+            await libero.acquire()
+            # Azzerata prima del prelievo: una sveglia arrivata durante la query non va persa
+            self._sveglia.clear()
+            try:
+                prelievo = await self._preleva()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Errore nel worker job PDF: {e}")
+                prelievo = None
+
+            if prelievo is not None:
+                attesa = self.intervallo_polling
+                task = asyncio.create_task(self._esegui_e_libera(*prelievo, libero))
+                self._in_corso.add(task)
+                task.add_done_callback(self._in_corso.discard)
+                continue
+
+            libero.release()
+            try:
+                await asyncio.wait_for(self._sveglia.wait(), attesa)
+                attesa = self.intervallo_polling
+            except asyncio.TimeoutError:
+                attesa = min(attesa * 2, self.intervallo_polling_massimo)
+
+    async def _pulizia(self) -> None:
+        while True:
+            try:
+                eliminati = await asyncio.to_thread(self._elimina_job_conclusi)
+                if eliminati:
+                    logger.info(f"Job PDF: {eliminati} job conclusi da più di {PDF_JOB_TTL_ORE:g} ore eliminati")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Errore nella pulizia dei job PDF: {e}")
+            await asyncio.sleep(PDF_JOB_PULIZIA_INTERVALLO)
+
+    @staticmethod
+    def _elimina_job_conclusi() -> int:
+        db = SessionLocal()
+        try:
+            return PdfJobService(db).elimina_job_conclusi()
+        finally:
+            db.close()
+
+    async def esegui_prossimo_job(self) -> bool:
+        """Esegue un job se presente in coda. Restituisce False se la coda è vuota"""
+        prelievo = await self._preleva()
+        if prelievo is None:
+            return False
+        await self._esegui(*prelievo)
+        return True
+
+    async def _preleva(self) -> Optional[Tuple[Session, PdfJob]]:
+        """Preleva il prossimo job con una sessione dedicata, che resta aperta fino alla sua esecuzione"""
+        db = SessionLocal()
+        try:
+            # Le query sono sincrone: vengono eseguite in un thread per non bloccare il loop
+            job = await asyncio.to_thread(PdfJobService(db).preleva_prossimo_job)
+        except BaseException:
+            db.close()
+            raise
+        if not job:
+            db.close()
+            return None
+        return db, job
+
+    async def _esegui_e_libera(self, db: Session, job: PdfJob, libero: asyncio.Semaphore) -> None:
+        try:
+            await self._esegui(db, job)
+        except Exception as e:
+            logger.error(f"Errore nel worker job PDF: {e}")
+        finally:
+            libero.release()
+
+    async def _esegui(self, db: Session, job: PdfJob) -> None:
+        try:
+            job_service = PdfJobService(db)
+            try:
+                preventivo_id, preventivo_data, template = await asyncio.to_thread(self._carica_dati_job, db, job)
+                pdf_service = PDFExportService(self.templates_dir, db=db)
+                pdf_bytes = await pdf_service.genera_pdf_preventivo_con_template_async(
+                    preventivo_data, template, preventivo_id=preventivo_id
+                )
+            except Exception as e:
+                logger.error(f"Job PDF {job.id} fallito: {e}")
+                await asyncio.to_thread(job_service.fallisci_job, job, str(e))
+                return
+
+            numero_preventivo = preventivo_data.metadati_preventivo.numero_preventivo or preventivo_id
+            await asyncio.to_thread(job_service.completa_job, job, pdf_bytes, f"preventivo_{numero_preventivo}.pdf")
+        finally:
+            db.close()
+
+    @staticmethod
+    def _carica_dati_job(db: Session, job: PdfJob):
+        """Carica il preventivo e risolve il template con le stesse regole del download sincrono"""
+        user_id = str(job.user_id)
+        preventivo_id = str(job.preventivo_id)
+        preventivo_data = PreventivoService(db).carica_preventivo(preventivo_id, user_id, solo_attivi=True)
+        if not preventivo_data:
+            raise ValueError("Preventivo attivo non trovato")
+
+        template = DocumentTemplateService(db).risolvi_template_preventivo(
+            user_id,
+            template_id=str(job.template_id) if job.template_id else None,
+            template_id_preventivo=preventivo_data.metadati_preventivo.template_id
+        )
+        if not template:
+            raise ValueError("Template non trovato")
+        return preventivo_id, preventivo_data, template
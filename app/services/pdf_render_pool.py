@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from .metriche import durata_rendering_pdf, pdf_generati
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# Configurazione del pool di rendering (sovrascrivibile da variabili d'ambiente)
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", str(os.cpu_count() or 2)))
+PDF_RENDER_TIMEOUT = float(os.getenv("PDF_RENDER_TIMEOUT", "60"))
+# Dopo quanti PDF un worker viene sostituito (limita la crescita di memoria di WeasyPrint). 0 = mai
+PDF_RENDER_MAX_TASKS_PER_CHILD = int(os.getenv("PDF_RENDER_MAX_TASKS_PER_CHILD", "200"))
+# "spawn" è sicuro anche con il loop asyncio e i thread di uvicorn già attivi nel processo padre
+PDF_RENDER_START_METHOD = os.getenv("PDF_RENDER_START_METHOD", "spawn")
+
+
+# ============================================
+# CODICE ESEGUITO NEI PROCESSI WORKER
+# ============================================
+
+# Classe HTML di WeasyPrint, importata una sola volta per processo dall'initializer
+_worker_html = None
+_worker_errore_import: Optional[str] = None
+
+
+def _inizializza_worker() -> None:
+    """Importa WeasyPrint all'avvio del worker, così ogni job trova la libreria già caricata"""
+    global _worker_html, _worker_errore_import
+    try:
+        from weasyprint import HTML
+        _worker_html = HTML
+    except Exception as e:
+        _worker_errore_import = str(e)
+
+
+def _riscalda_worker() -> int:
+    """Job vuoto usato per far partire subito tutti i processi del pool"""
+    return os.getpid()
+
+
+def _render_pdf(html_content: str) -> bytes:
+    """Converte l'HTML in PDF all'interno del processo worker"""
+    if _worker_html is None:
+        raise RuntimeError(f"WeasyPrint non disponibile nel worker PDF: {_worker_errore_import}")
+    return _worker_html(string=html_content).write_pdf()
+
+
+# ============================================
+# POOL (LATO PROCESSO API)
+# ============================================
+
+class PDFRenderPool:
+    """
+    Pool di processi dedicati al rendering WeasyPrint.
+    Il rendering HTML -> PDF è CPU-bound e blocca per centinaia di millisecondi:
+    eseguirlo in processi separati lascia libero il loop asyncio e scala con i core.
+
+    Un job bloccato o un worker terminato rendono inutilizzabile il pool, che va ricreato,
+    e con esso falliscono anche i rendering degli altri utenti in corso in quel momento.
+    Questi vengono ripetuti una volta: sul nuovo pool se il responsabile è noto (il job
+    andato in timeout), altrimenti (worker terminato) uno alla volta in un processo
+    isolato, così il documento che fa terminare il worker fallisce da solo.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = PDF_RENDER_WORKERS,
+        timeout: float = PDF_RENDER_TIMEOUT,
+        max_tasks_per_child: int = PDF_RENDER_MAX_TASKS_PER_CHILD,
+        funzione_render: Callable[[str], bytes] = _render_pdf,
+    ):
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.max_tasks_per_child = max_tasks_per_child
+        # Funzione eseguita nei worker (di modulo, per essere passata ai processi)
+        self.funzione_render = funzione_render
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        # Executor riciclati per il timeout di un loro job (il responsabile del guasto è noto)
+        self._riciclati_per_timeout: "weakref.WeakSet[ProcessPoolExecutor]" = weakref.WeakSet()
+        # Processo singolo per ripetere i job coinvolti nella terminazione di un worker
+        self._executor_isolato: Optional[ProcessPoolExecutor] = None
+        self._lock_isolato: Optional[asyncio.Lock] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._executor is not None
+
+    def avvia(self) -> ProcessPoolExecutor:
+        """Crea il pool (se non esiste) e pre-avvia tutti i worker"""
+        with self._lock:
+            if self._executor is not None:
+                return self._executor
+
+            self._executor = self._crea_executor(self.max_workers)
+            # Un job per worker: nessun worker è libero, quindi l'executor li avvia tutti subito
+            # e il primo PDF reale non paga l'avvio del processo e l'import di WeasyPrint
+            for _ in range(self.max_workers):
+                self._executor.submit(_riscalda_worker)
+
+            logger.info(f"Pool rendering PDF avviato con {self.max_workers} worker (timeout {self.timeout}s)")
+            return self._executor
+
+    def arresta(self, wait: bool = True) -> None:
+        """Ferma il pool; i job in coda vengono annullati"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            isolato, self._executor_isolato = self._executor_isolato, None
+        if isolato is not None:
+            isolato.shutdown(wait=wait, cancel_futures=True)
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+            logger.info("Pool rendering PDF arrestato")
+
+    async def render(self, html_content: str, timeout: Optional[float] = None) -> bytes:
+        """
+        Esegue il rendering di un documento HTML in un worker e ne attende il risultato.
+        Se il pool si guasta per colpa di un altro job, il rendering viene ripetuto una volta.
+
+        Raises:
+            TimeoutError: se il job supera il timeout (il pool viene riciclato)
+            RuntimeError: se il worker termina in modo anomalo anche con il job isolato
+                (è questo documento a farlo terminare)
+        """
+        timeout = timeout or self.timeout
+        inizio = time.perf_counter()
+
+        esito = "error"
+        try:
+            executor = self._executor or self.avvia()
+            try:
+                pdf_bytes = await self._esegui(executor, html_content, timeout)
+            except _PoolGuasto as e:
+                if executor in self._riciclati_per_timeout:
+                    logger.warning("Rendering PDF interrotto dal riciclo del pool, nuovo tentativo")
+                    pdf_bytes = await self._esegui(self._executor or self.avvia(), html_content, timeout)
+                else:
+                    logger.warning(f"Worker PDF terminato durante il rendering ({e}), nuovo tentativo isolato")
+                    pdf_bytes = await self._esegui_isolato(html_content, timeout)
+            esito = "ok"
+            return pdf_bytes
+        except TimeoutError:
+            esito = "timeout"
+            raise
+        except _PoolGuasto as e:
+            logger.error(f"Worker PDF terminato in modo anomalo: {e}")
+            raise RuntimeError("Worker PDF terminato in modo anomalo")
+        finally:
+            pdf_generati.incrementa(mode="pool", outcome=esito)
+            durata_rendering_pdf.osserva(time.perf_counter() - inizio, mode="pool")
+
+    def stato(self) -> dict:
+        """Configurazione e stato del pool, per diagnostica"""
+        return {
+            "running": self.is_running,
+            "workers": self.max_workers,
+            "timeout": self.timeout,
+            "max_tasks_per_child": self.max_tasks_per_child,
+        }
+
+    async def _esegui(self, executor: ProcessPoolExecutor, html_content: str, timeout: float) -> bytes:
+        """
+        Esegue un job sull'executor indicato.
+
+        Raises:
+            TimeoutError: se il job supera il timeout (l'executor viene riciclato)
+            _PoolGuasto: se l'executor si guasta o viene riciclato durante il job
+        """
+        try:
+            future = executor.submit(self.funzione_render, html_content)
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            # Un job bloccato occupa il worker indefinitamente: l'unico modo per
+            # liberarlo è terminare i processi e ricreare il pool
+            logger.error(f"Rendering PDF oltre il timeout di {timeout}s, riciclo del pool")
+            self._riciclati_per_timeout.add(executor)
+            self._ricicla(executor)
+            raise TimeoutError(f"Rendering PDF oltre il timeout di {timeout}s")
+        except (BrokenProcessPool, asyncio.CancelledError) as e:
+            if isinstance(e, asyncio.CancelledError) and asyncio.current_task().cancelling():
+                raise  # Richiesta annullata, non job annullato dal riciclo del pool
+            self._ricicla(executor)
+            raise _PoolGuasto(repr(e)) from e
+
+    async def _esegui_isolato(self, html_content: str, timeout: float) -> bytes:
+        """Esegue il job da solo in un processo dedicato: se il worker termina, la causa è questo job"""
+        if self._lock_isolato is None:
+            self._lock_isolato = asyncio.Lock()
+        async with self._lock_isolato:
+            with self._lock:
+                if self._executor_isolato is None:
+                    self._executor_isolato = self._crea_executor(1)
+                executor = self._executor_isolato
+            return await self._esegui(executor, html_content, timeout)
+
+    def _crea_executor(self, max_workers: int) -> ProcessPoolExecutor:
+        kwargs = {}
+        if self.max_tasks_per_child > 0:
+            kwargs["max_tasks_per_child"] = self.max_tasks_per_child
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context(PDF_RENDER_START_METHOD),
+            initializer=_inizializza_worker,
+            **kwargs
+        )
+
+    def _ricicla(self, executor: ProcessPoolExecutor) -> None:
+        """Termina i processi di un executor guasto; il prossimo render ne avvierà uno nuovo"""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+            if self._executor_isolato is executor:
+                self._executor_isolato = None
+        for processo in list((getattr(executor, "_processes", None) or {}).values()):
+            processo.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class _PoolGuasto(Exception):
+    """Il pool si è guastato (o è stato riciclato) mentre il job era in corso"""
+
+
+# Istanza condivisa dal processo API
+pdf_render_pool = PDFRenderPool()
@@ -0,0 +1,92 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from ..models import PreventivoMasterModel
+from .metriche import richieste_cache
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# Memoria massima stimata per i preventivi deserializzati (byte del JSON salvato). 0 = cache disabilitata
+PREVENTIVI_CACHE_MAX_BYTES = int(os.getenv("PREVENTIVI_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+class PreventiviCache:
+    """
+    Cache in memoria (per processo) dei PreventivoMasterModel già validati.
+
+    Una voce vale per la coppia (id, updated_at): il chiamante legge solo updated_at
+    dal database e la voce viene usata solo se coincide, quindi non può restituire
+    una versione superata. Per ogni preventivo si tiene solo l'ultima versione;
+    le scritture di PreventivoService la rimuovono subito per liberare memoria.
+    Oltre la dimensione massima le voci vengono rimosse in ordine LRU.
+
+    Le istanze restituite sono condivise tra le richieste: non vanno modificate.
+    """
+
+    def __init__(self, max_bytes: int = PREVENTIVI_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        # id -> (updated_at, modello, dimensione stimata), dal meno recente
+        self._voci: "OrderedDict[str, Tuple[datetime, PreventivoMasterModel, int]]" = OrderedDict()
+        self._dimensione_totale = 0
+        self._lock = threading.Lock()
+        self.hit = 0
+        self.miss = 0
+
+    @property
+    def abilitata(self) -> bool:
+        return self.max_bytes > 0
+
+    def leggi(self, preventivo_id, updated_at: datetime) -> Optional[PreventivoMasterModel]:
+        if not self.abilitata:
+            return None
+        chiave = str(preventivo_id)
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is None or voce[0] != updated_at:
+                self.miss += 1
+                richieste_cache.incrementa(cache="preventivi", result="miss")
+                return None
+            self._voci.move_to_end(chiave)
+            self.hit += 1
+            richieste_cache.incrementa(cache="preventivi", result="hit")
+            return voce[1]
+
+    def salva(self, preventivo_id, updated_at: datetime, preventivo: PreventivoMasterModel, dimensione: int) -> None:
+        if not self.abilitata or dimensione > self.max_bytes:
+            return
+        chiave = str(preventivo_id)
+        with self._lock:
+            self._rimuovi(chiave)
+            self._voci[chiave] = (updated_at, preventivo, dimensione)
+            self._dimensione_totale += dimensione
+            while self._dimensione_totale > self.max_bytes:
+                self._rimuovi(next(iter(self._voci)))
+
+    def invalida(self, *preventivo_ids) -> None:
+        """Da chiamare dopo ogni scrittura sui preventivi indicati"""
+        with self._lock:
+            for preventivo_id in preventivo_ids:
+                self._rimuovi(str(preventivo_id))
+
+    def contatori(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hit": self.hit,
+                "miss": self.miss,
+                "voci": len(self._voci),
+                "dimensione_byte": self._dimensione_totale,
+            }
+
+    def _rimuovi(self, chiave: str) -> None:
+        voce = self._voci.pop(chiave, None)
+        if voce is not None:
+            self._dimensione_totale -= voce[2]
+
+
+# Istanza condivisa dall'applicazione
+preventivi_cache = PreventiviCache()
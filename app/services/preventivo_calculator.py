@@ -1,64 +1,418 @@
-from typing import Dict, List
+import logging
+import math
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
 from app.models import PreventivoMasterModel, RigaPreventivo, SezioneTotali, RiepilogoIVA
 from decimal import Decimal, ROUND_HALF_UP
+from app.services.metriche import durata_calcolo_totali
+
+# Setup logger
+logger = logging.getLogger(__name__)
 
 # Helper per arrotondamento a 2 cifre decimali
 def round_decimal(value: float) -> float:
     return float(Decimal(str(value)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
 
-def calcola_totali_preventivo(preventivo: PreventivoMasterModel) -> None:
+
+def arrotonda_centesimi(valori) -> np.ndarray:
     """
-    Calcola i subtotali per ogni riga e i totali generali del preventivo.
-    Modifica l'oggetto PreventivoMasterModel in-place.
+    Versione vettoriale di round_decimal: restituisce i centesimi (int64).
+
+    round_decimal arrotonda la rappresentazione decimale più corta del float
+    (str(value)), quindi 1.005 diventa 1.01 anche se il valore binario è 1.00499...
+    Questo equivale a contare i punti di metà (2k+1)/200 il cui float è <= |valore|:
+    la stima floor(|v|*100 + 0.5) viene corretta di un centesimo confrontandola
+    con i float esatti dei punti di metà adiacenti.
+    """
+    valori = np.asarray(valori, dtype=np.float64)
+    assoluti = np.abs(valori)
+    centesimi = np.floor(assoluti * 100.0 + 0.5)
+    centesimi -= (centesimi > 0) & ((2.0 * centesimi - 1.0) / 200.0 > assoluti)
+    centesimi += (2.0 * centesimi + 1.0) / 200.0 <= assoluti
+    return np.copysign(centesimi, valori).astype(np.int64)
+
+
+def _arrotonda_centesimi_scalare(valore: float) -> int:
+    """Come arrotonda_centesimi, per un singolo valore senza passare da NumPy"""
+    assoluto = abs(valore)
+    centesimi = math.floor(assoluto * 100.0 + 0.5)
+    if centesimi > 0 and (2.0 * centesimi - 1.0) / 200.0 > assoluto:
+        centesimi -= 1
+    if (2.0 * centesimi + 1.0) / 200.0 <= assoluto:
+        centesimi += 1
+    return -centesimi if valore < 0 else centesimi
+
+
+@dataclass
+class TotaliBatch:
+    """
+    Risultato di calcola_totali_batch. Tutti gli importi sono in centesimi (int64).
+    Gli array per riga seguono l'ordine delle righe in input; quelli per documento
+    l'ordine dei documenti.
     """
-    
-    totale_sconti_complessivo = 0.0
-    riepilogo_iva_dict: Dict[float, Dict[str, float]] = {}
-
-    # 1. Calcola i totali per ogni riga
-    for indice, riga in enumerate(preventivo.corpo_preventivo.righe, start=1):
-        # Aggiungi numero di riga
-        riga.numero_riga = indice
-        
-        base_imponibile_riga_pre_sconto = round_decimal(riga.quantita * riga.prezzo_unitario_netto)
-        
-        importo_sconto_riga = 0.0
-        if riga.sconto_riga_percentuale is not None and riga.sconto_riga_percentuale > 0:
-            importo_sconto_riga = round_decimal(
-                base_imponibile_riga_pre_sconto * (riga.sconto_riga_percentuale / 100.0)
+    documento_riga: np.ndarray
+    sconto_riga: np.ndarray
+    netto_riga: np.ndarray
+    iva_riga: np.ndarray
+    lordo_riga: np.ndarray
+    totale_imponibile: np.ndarray
+    totale_sconti: np.ndarray
+    totale_iva: np.ndarray
+    totale_lordo: np.ndarray
+    # Per ogni documento: (aliquota, imponibile, iva) nell'ordine di prima comparsa dell'aliquota
+    riepilogo_iva: List[List[Tuple[float, int, int]]]
+
+
+def calcola_totali_batch(quantita, prezzo_unitario, sconto_percentuale, percentuale_iva, righe_per_documento: Sequence[int]) -> TotaliBatch:
+    """
+    Calcola subtotali di riga, totali e riepilogo IVA di molti documenti in una volta.
+    Le righe di tutti i documenti sono concatenate; righe_per_documento indica
+    quante righe appartengono a ciascun documento. Gli sconti None vanno passati come 0.
+
+    I risultati coincidono con il calcolo riga per riga con round_decimal:
+    gli arrotondamenti intermedi ripetono le stesse operazioni float, le somme
+    sono fatte in centesimi interi (esatte, mentre le somme float vengono
+    comunque riportate al centesimo da round_decimal).
+    """
+    quantita = np.asarray(quantita, dtype=np.float64)
+    prezzo_unitario = np.asarray(prezzo_unitario, dtype=np.float64)
+    sconto_percentuale = np.asarray(sconto_percentuale, dtype=np.float64)
+    percentuale_iva = np.asarray(percentuale_iva, dtype=np.float64)
+    righe_per_documento = np.asarray(righe_per_documento, dtype=np.int64)
+    numero_documenti = len(righe_per_documento)
+    documento_riga = np.repeat(np.arange(numero_documenti), righe_per_documento)
+
+    # 1. Importi di riga
+    base_riga = arrotonda_centesimi(quantita * prezzo_unitario)
+    sconto_riga = np.where(
+        sconto_percentuale > 0,
+        arrotonda_centesimi((base_riga / 100.0) * (sconto_percentuale / 100.0)),
+        0
+    )
+    netto_riga = base_riga - sconto_riga
+    iva_riga = arrotonda_centesimi((netto_riga / 100.0) * (percentuale_iva / 100.0))
+    lordo_riga = netto_riga + iva_riga
+
+    # 2. Totali per documento
+    def somma_per_documento(importi: np.ndarray) -> np.ndarray:
+        totali = np.zeros(numero_documenti, dtype=np.int64)
+        np.add.at(totali, documento_riga, importi)
+        return totali
+
+    totale_imponibile = somma_per_documento(netto_riga)
+    totale_sconti = somma_per_documento(sconto_riga)
+    totale_iva = somma_per_documento(iva_riga)
+
+    # 3. Riepilogo IVA: gruppi (documento, aliquota) ordinati per prima comparsa
+    riepilogo_iva: List[List[Tuple[float, int, int]]] = [[] for _ in range(numero_documenti)]
+    if len(documento_riga):
+        aliquote, codice_aliquota = np.unique(percentuale_iva, return_inverse=True)
+        chiave = documento_riga * len(aliquote) + codice_aliquota.reshape(-1)
+        chiavi, prima_riga, gruppo_riga = np.unique(chiave, return_index=True, return_inverse=True)
+        gruppo_riga = gruppo_riga.reshape(-1)
+        imponibile_gruppo = np.zeros(len(chiavi), dtype=np.int64)
+        iva_gruppo = np.zeros(len(chiavi), dtype=np.int64)
+        np.add.at(imponibile_gruppo, gruppo_riga, netto_riga)
+        np.add.at(iva_gruppo, gruppo_riga, iva_riga)
+
+        for gruppo in np.argsort(prima_riga, kind="stable").tolist():
+            documento, codice = divmod(int(chiavi[gruppo]), len(aliquote))
+            riepilogo_iva[documento].append(
+                (float(aliquote[codice]), int(imponibile_gruppo[gruppo]), int(iva_gruppo[gruppo]))
             )
-        
-        riga.subtotale_riga_netto = round_decimal(base_imponibile_riga_pre_sconto - importo_sconto_riga)
-        riga.importo_iva_riga = round_decimal(riga.subtotale_riga_netto * (riga.percentuale_iva / 100.0))
-        riga.subtotale_riga_lordo = round_decimal(riga.subtotale_riga_netto + riga.importo_iva_riga)
-        
-        totale_sconti_complessivo += importo_sconto_riga
-
-        # Aggiorna riepilogo IVA
-        aliquota = riga.percentuale_iva
-        if aliquota not in riepilogo_iva_dict:
-            riepilogo_iva_dict[aliquota] = {"imponibile": 0.0, "iva": 0.0}
-        
-        riepilogo_iva_dict[aliquota]["imponibile"] += riga.subtotale_riga_netto
-        riepilogo_iva_dict[aliquota]["iva"] += riga.importo_iva_riga
-
-    # 2. Calcola i totali generali del preventivo
-    totale_imponibile_netto_preventivo = sum(riga.subtotale_riga_netto for riga in preventivo.corpo_preventivo.righe if riga.subtotale_riga_netto is not None)
-    totale_iva_preventivo = sum(riga.importo_iva_riga for riga in preventivo.corpo_preventivo.righe if riga.importo_iva_riga is not None)
-    
-    preventivo.dettagli_totali.totale_imponibile_netto = round_decimal(totale_imponibile_netto_preventivo)
-    preventivo.dettagli_totali.totale_sconti = round_decimal(totale_sconti_complessivo) 
-    preventivo.dettagli_totali.totale_iva = round_decimal(totale_iva_preventivo)
-    preventivo.dettagli_totali.totale_generale_lordo = round_decimal(totale_imponibile_netto_preventivo + totale_iva_preventivo)
-
-    # Compila il riepilogo IVA
-    lista_riepilogo_iva: List[RiepilogoIVA] = []
-    for aliquota, valori in riepilogo_iva_dict.items():
-        lista_riepilogo_iva.append(
+
+    return TotaliBatch(
+        documento_riga=documento_riga,
+        sconto_riga=sconto_riga,
+        netto_riga=netto_riga,
+        iva_riga=iva_riga,
+        lordo_riga=lordo_riga,
+        totale_imponibile=totale_imponibile,
+        totale_sconti=totale_sconti,
+        totale_iva=totale_iva,
+        totale_lordo=totale_imponibile + totale_iva,
+        riepilogo_iva=riepilogo_iva
+    )
+
+
+def calcola_totali_preventivi(preventivi: Sequence[PreventivoMasterModel]) -> None:
+    """
+    Calcola i totali di più preventivi con un solo calcolo vettoriale.
+    Modifica gli oggetti PreventivoMasterModel in-place.
+    """
+    inizio = time.perf_counter()
+    righe: List[RigaPreventivo] = [riga for preventivo in preventivi for riga in preventivo.corpo_preventivo.righe]
+    totali = calcola_totali_batch(
+        [riga.quantita for riga in righe],
+        [riga.prezzo_unitario_netto for riga in righe],
+        [riga.sconto_riga_percentuale or 0 for riga in righe],
+        [riga.percentuale_iva for riga in righe],
+        [len(preventivo.corpo_preventivo.righe) for preventivo in preventivi]
+    )
+
+    # 1. Importi di riga (tolist evita la conversione elemento per elemento da NumPy)
+    righe_iter = iter(zip(righe, totali.netto_riga.tolist(), totali.iva_riga.tolist(), totali.lordo_riga.tolist()))
+    for preventivo in preventivi:
+        for indice in range(1, len(preventivo.corpo_preventivo.righe) + 1):
+            riga, netto, iva, lordo = next(righe_iter)
+            riga.numero_riga = indice
+            riga.subtotale_riga_netto = netto / 100
+            riga.importo_iva_riga = iva / 100
+            riga.subtotale_riga_lordo = lordo / 100
+
+    # 2. Totali generali e riepilogo IVA
+    for indice, preventivo in enumerate(preventivi):
+        dettagli = preventivo.dettagli_totali
+        dettagli.totale_imponibile_netto = int(totali.totale_imponibile[indice]) / 100
+        dettagli.totale_sconti = int(totali.totale_sconti[indice]) / 100
+        dettagli.totale_iva = int(totali.totale_iva[indice]) / 100
+        dettagli.totale_generale_lordo = int(totali.totale_lordo[indice]) / 100
+        dettagli.riepilogo_iva = [
             RiepilogoIVA(
                 aliquota_percentuale=aliquota,
-                imponibile_aliquota=round_decimal(valori["imponibile"]),
-                iva_aliquota=round_decimal(valori["iva"])
+                imponibile_aliquota=imponibile / 100,
+                iva_aliquota=iva / 100
             )
+            for aliquota, imponibile, iva in totali.riepilogo_iva[indice]
+        ]
+    durata_calcolo_totali.osserva(time.perf_counter() - inizio)
+
+
+def calcola_totali_preventivo(preventivo: PreventivoMasterModel) -> None:
+    """
+    Calcola i subtotali per ogni riga e i totali generali del preventivo.
+    Modifica l'oggetto PreventivoMasterModel in-place.
+    """
+    calcola_totali_preventivi([preventivo])
+
+
+def _valori_riga(riga: Any) -> Tuple[float, float, float, float]:
+    """Estrae (quantità, prezzo, sconto, aliquota) da una RigaPreventivo o dal suo dict JSON"""
+    if isinstance(riga, dict):
+        return (
+            riga.get("quantita", 1),
+            riga["prezzo_unitario_netto"],
+            riga.get("sconto_riga_percentuale") or 0,
+            riga.get("percentuale_iva", 22)
+        )
+    return riga.quantita, riga.prezzo_unitario_netto, riga.sconto_riga_percentuale or 0, riga.percentuale_iva
+
+
+class CalcolatoreTotaliIncrementale:
+    """
+    Totali di un preventivo mantenuti riga per riga.
+    Conserva gli importi di ogni riga (in centesimi) e i totali per aliquota IVA:
+    aggiungere, modificare o rimuovere una riga aggiorna i totali in tempo costante,
+    senza ricalcolare le altre righe. verifica() esegue il ricalcolo completo e
+    riallinea lo stato se trova differenze.
+
+    Con da_totali() lo stato parte dai totali già salvati e dalle sole aliquote
+    delle righe: gli importi di una riga esistente vengono ricalcolati dai suoi
+    valori precedenti, passati a aggiorna_riga/rimuovi_riga, solo quando servono.
+    """
+
+    def __init__(self, righe: Optional[Sequence[Any]] = None):
+        self._ricostruisci(list(righe or []))
+
+    @classmethod
+    def da_totali(cls, dettagli_totali: Dict[str, Any], aliquote_righe: Sequence[Optional[float]]) -> "CalcolatoreTotaliIncrementale":
+        """
+        Ricostruisce lo stato dai dettagli_totali salvati (dict JSON) e dalle aliquote
+        delle righe, senza leggere le righe.
+
+        Raises:
+            ValueError: Se i totali salvati sono incompleti o non coerenti con le aliquote
+        """
+        calcolatore = cls.__new__(cls)
+        calcolatore._aliquote = [float(22 if aliquota is None else aliquota) for aliquota in aliquote_righe]
+        calcolatore._importi = [None] * len(calcolatore._aliquote)
+
+        riepilogo = dettagli_totali.get("riepilogo_iva")
+        if riepilogo is None or dettagli_totali.get("totale_sconti") is None:
+            raise ValueError("Totali salvati incompleti")
+
+        def centesimi(valore: Any) -> int:
+            return _arrotonda_centesimi_scalare(float(valore))
+
+        calcolatore._totale_imponibile = centesimi(dettagli_totali["totale_imponibile_netto"])
+        calcolatore._totale_sconti = centesimi(dettagli_totali["totale_sconti"])
+        calcolatore._totale_iva = centesimi(dettagli_totali["totale_iva"])
+        conteggi: Dict[float, int] = {}
+        for aliquota in calcolatore._aliquote:
+            conteggi[aliquota] = conteggi.get(aliquota, 0) + 1
+        calcolatore._per_aliquota = {
+            float(voce["aliquota_percentuale"]): [centesimi(voce["imponibile_aliquota"]), centesimi(voce["iva_aliquota"]), 0]
+            for voce in riepilogo
+        }
+        if set(calcolatore._per_aliquota) != set(conteggi):
+            raise ValueError("Riepilogo IVA salvato non coerente con le righe")
+        for aliquota, numero in conteggi.items():
+            calcolatore._per_aliquota[aliquota][2] = numero
+        return calcolatore
+
+    def _ricostruisci(self, righe: List[Any]) -> None:
+        """Inizializza lo stato con un calcolo vettoriale completo"""
+        valori = [_valori_riga(riga) for riga in righe]
+        totali = calcola_totali_batch(
+            [v[0] for v in valori], [v[1] for v in valori],
+            [v[2] for v in valori], [v[3] for v in valori],
+            [len(valori)]
+        )
+        self._aliquote: List[float] = [float(v[3]) for v in valori]
+        # (sconto, netto, iva) di ogni riga; None se non ancora calcolati
+        self._importi: List[Optional[Tuple[int, int, int]]] = list(zip(
+            totali.sconto_riga.tolist(), totali.netto_riga.tolist(), totali.iva_riga.tolist()
+        ))
+        self._totale_imponibile = int(totali.totale_imponibile[0])
+        self._totale_sconti = int(totali.totale_sconti[0])
+        self._totale_iva = int(totali.totale_iva[0])
+        # aliquota -> [imponibile, iva, numero di righe]
+        self._per_aliquota: Dict[float, List[int]] = {}
+        for aliquota, (_, netto, iva) in zip(self._aliquote, self._importi):
+            voce = self._per_aliquota.setdefault(aliquota, [0, 0, 0])
+            voce[0] += netto
+            voce[1] += iva
+            voce[2] += 1
+
+    @staticmethod
+    def _calcola_riga(riga: Any) -> Tuple[float, Tuple[int, int, int]]:
+        """Aliquota e importi (sconto, netto, iva) di una riga, stesse operazioni di calcola_totali_batch"""
+        quantita, prezzo, sconto_percentuale, aliquota = _valori_riga(riga)
+        base = _arrotonda_centesimi_scalare(float(quantita) * float(prezzo))
+        sconto = 0
+        if sconto_percentuale > 0:
+            sconto = _arrotonda_centesimi_scalare((base / 100.0) * (float(sconto_percentuale) / 100.0))
+        netto = base - sconto
+        iva = _arrotonda_centesimi_scalare((netto / 100.0) * (float(aliquota) / 100.0))
+        return float(aliquota), (sconto, netto, iva)
+
+    def _accumula(self, aliquota: float, importi: Tuple[int, int, int], segno: int) -> None:
+        sconto, netto, iva = importi
+        self._totale_imponibile += segno * netto
+        self._totale_sconti += segno * sconto
+        self._totale_iva += segno * iva
+        voce = self._per_aliquota.setdefault(aliquota, [0, 0, 0])
+        voce[0] += segno * netto
+        voce[1] += segno * iva
+        voce[2] += segno
+        if voce[2] == 0:
+            del self._per_aliquota[aliquota]
+
+    def aggiungi_riga(self, riga: Any, posizione: Optional[int] = None) -> int:
+        """Aggiunge una riga (in coda o alla posizione indicata) e ne restituisce l'indice"""
+        if posizione is None:
+            posizione = len(self._aliquote)
+        if not 0 <= posizione <= len(self._aliquote):
+            raise IndexError(f"Posizione riga non valida: {posizione}")
+        aliquota, importi = self._calcola_riga(riga)
+        self._aliquote.insert(posizione, aliquota)
+        self._importi.insert(posizione, importi)
+        self._accumula(aliquota, importi, 1)
+        return posizione
+
+    def aggiorna_riga(self, indice: int, riga: Any, riga_precedente: Any = None) -> None:
+        """Sostituisce i valori della riga all'indice dato"""
+        self._rimuovi_importi(indice, riga_precedente)
+        aliquota, importi = self._calcola_riga(riga)
+        self._aliquote[indice] = aliquota
+        self._importi[indice] = importi
+        self._accumula(aliquota, importi, 1)
+
+    def rimuovi_riga(self, indice: int, riga_precedente: Any = None) -> None:
+        """Rimuove la riga all'indice dato"""
+        self._rimuovi_importi(indice, riga_precedente)
+        del self._aliquote[indice], self._importi[indice]
+
+    def sposta_riga(self, da: int, a: int) -> None:
+        """Sposta una riga: i totali non cambiano, solo l'ordine del riepilogo IVA può cambiare"""
+        self._controlla_indice(da)
+        self._controlla_indice(a)
+        for valori in (self._aliquote, self._importi):
+            valori.insert(a, valori.pop(da))
+
+    def riordina_righe(self, ordine: Sequence[int]) -> None:
+        """Applica una permutazione delle righe: ordine[i] è l'indice attuale della riga che va in posizione i"""
+        if sorted(ordine) != list(range(len(self._aliquote))):
+            raise ValueError("L'ordine deve contenere ogni indice di riga esattamente una volta")
+        self._aliquote = [self._aliquote[i] for i in ordine]
+        self._importi = [self._importi[i] for i in ordine]
+
+    def _rimuovi_importi(self, indice: int, riga_precedente: Any) -> None:
+        self._controlla_indice(indice)
+        importi = self._importi[indice]
+        if importi is None:
+            if riga_precedente is None:
+                raise ValueError(f"Importi della riga {indice} non disponibili: serve la riga precedente")
+            _, importi = self._calcola_riga(riga_precedente)
+        self._accumula(self._aliquote[indice], importi, -1)
+
+    def _controlla_indice(self, indice: int) -> None:
+        if not 0 <= indice < len(self._aliquote):
+            raise IndexError(f"Indice riga non valido: {indice}")
+
+    @property
+    def numero_righe(self) -> int:
+        return len(self._aliquote)
+
+    def importi_riga(self, indice: int) -> Dict[str, Any]:
+        """Campi calcolati di una riga, come li imposta calcola_totali_preventivo"""
+        self._controlla_indice(indice)
+        if self._importi[indice] is None:
+            raise ValueError(f"Importi della riga {indice} non disponibili")
+        _, netto, iva = self._importi[indice]
+        return {
+            "numero_riga": indice + 1,
+            "subtotale_riga_netto": netto / 100,
+            "importo_iva_riga": iva / 100,
+            "subtotale_riga_lordo": (netto + iva) / 100
+        }
+
+    def totali(self) -> SezioneTotali:
+        """
+        Totali correnti del documento. Il riepilogo IVA segue l'ordine di prima comparsa
+        delle aliquote: la scansione si ferma appena tutte le aliquote sono state trovate.
+        """
+        da_trovare = set(self._per_aliquota)
+        ordine = []
+        for aliquota in self._aliquote:
+            if not da_trovare:
+                break
+            if aliquota in da_trovare:
+                da_trovare.discard(aliquota)
+                ordine.append(aliquota)
+
+        return SezioneTotali(
+            totale_imponibile_netto=self._totale_imponibile / 100,
+            totale_sconti=self._totale_sconti / 100,
+            totale_iva=self._totale_iva / 100,
+            totale_generale_lordo=(self._totale_imponibile + self._totale_iva) / 100,
+            riepilogo_iva=[
+                RiepilogoIVA(
+                    aliquota_percentuale=aliquota,
+                    imponibile_aliquota=self._per_aliquota[aliquota][0] / 100,
+                    iva_aliquota=self._per_aliquota[aliquota][1] / 100
+                )
+                for aliquota in ordine
+            ]
+        )
+
+    def verifica(self, righe: Sequence[Any]) -> bool:
+        """
+        Ricalcola da zero i totali delle righe date e li confronta con lo stato incrementale.
+        In caso di differenze lo stato viene ricostruito e viene restituito False.
+        """
+        totali_incrementali = self.totali()
+        importi_incrementali = self._importi
+        self._ricostruisci(list(righe))
+        importi_allineati = len(importi_incrementali) == len(self._importi) and all(
+            importi is None or importi == ricalcolati
+            for importi, ricalcolati in zip(importi_incrementali, self._importi)
         )
-    preventivo.dettagli_totali.riepilogo_iva = lista_riepilogo_iva 
\ No newline at end of file
+        if importi_allineati and self.totali() == totali_incrementali:
+            return True
+        logger.warning("Totali incrementali non allineati al ricalcolo completo: stato ricostruito")
+        return False
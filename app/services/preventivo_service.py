@@ -1,71 +1,358 @@
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from sqlalchemy import Select, and_, delete, func, literal_column, or_, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, defer
+from typing import TYPE_CHECKING, List, Optional, Tuple
 # from uuid import UUID # Rimuoviamo l'import UUID
+import base64
+import json
+import os
 import uuid
-from datetime import datetime, timedelta # Aggiunto timedelta
+from datetime import date, datetime, timedelta # Aggiunto timedelta
+from decimal import Decimal
 
+from ..database import registro_scritture
 from ..db_models import Preventivo, User, Azienda, Cartella
 from ..models import PreventivoMasterModel, IntestazioneAzienda, Indirizzo, PreventivoListItemConCartella
+from .pdf_cache import pdf_cache
+from .preventivo_cache import preventivi_cache
+from .preventivo_calculator import calcola_totali_preventivo
+from .statistiche_service import statistiche_cache
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+
+# Segnaposto inviato dai client che non generano un id_preventivo proprio
+UUID_NULLO = "00000000-0000-0000-0000-000000000000"
+
+# Documento salvato con template_id e nome_documento presi dalle colonne e le righe
+# rinumerate, serializzato direttamente da PostgreSQL
+_SQL_DOCUMENTO_JSON = text("""
+    SELECT CAST(
+               dati_preventivo
+               || jsonb_build_object('metadati_preventivo',
+                      CASE WHEN jsonb_typeof(dati_preventivo -> 'metadati_preventivo') = 'object'
+                           THEN dati_preventivo -> 'metadati_preventivo' ELSE '{}'::jsonb END
+                      || jsonb_build_object('template_id', CAST(template_id AS text))
+                      || CASE WHEN coalesce(nome_documento, '') <> ''
+                              THEN jsonb_build_object('nome_documento', nome_documento) ELSE '{}'::jsonb END)
+               || CASE WHEN jsonb_typeof(dati_preventivo #> '{corpo_preventivo,righe}') = 'array'
+                       THEN jsonb_build_object('corpo_preventivo', (dati_preventivo -> 'corpo_preventivo') || jsonb_build_object('righe', (
+                                SELECT coalesce(jsonb_agg(
+                                           CASE WHEN jsonb_typeof(r.riga) = 'object'
+                                                THEN r.riga || jsonb_build_object('numero_riga', r.posizione) ELSE r.riga END
+                                           ORDER BY r.posizione), '[]'::jsonb)
+                                  FROM jsonb_array_elements(dati_preventivo #> '{corpo_preventivo,righe}')
+                                       WITH ORDINALITY AS r(riga, posizione))))
+                       ELSE '{}'::jsonb END
+           AS text)
+      FROM preventivi
+     WHERE id = :id AND user_id = :user_id
+       AND (NOT :solo_attivi OR stato_record = 'attivo')
+""")
+
+# Giorni dopo i quali un preventivo cestinato viene eliminato definitivamente
+CESTINO_GIORNI_SCADENZA = int(os.getenv("CESTINO_GIORNI_SCADENZA", "30"))
+# Righe eliminate per ogni DELETE (e quindi per ogni transazione)
+ELIMINAZIONE_DIMENSIONE_BLOCCO = int(os.getenv("ELIMINAZIONE_DIMENSIONE_BLOCCO", "500"))
+
+
+class PreventivoCestinatoError(ValueError):
+    """La chiave di idempotenza appartiene a un preventivo nel cestino, che un nuovo invio non riporta in vita"""
+
+
+# Ordinamenti delle liste: chiave -> (espressione, decrescente).
+# Le espressioni coincidono con quelle degli indici (user_id, stato_record, espressione, id):
+# i valori NULL sono sostituiti così che la paginazione keyset confronti sempre valori validi
+ORDINAMENTI_PREVENTIVI = {
+    "updated_at_desc": (Preventivo.updated_at, True),
+    "created_at_desc": (Preventivo.created_at, True),
+    "created_at_asc": (Preventivo.created_at, False),
+    "numero_asc": (Preventivo.numero_preventivo, False),
+    "numero_desc": (Preventivo.numero_preventivo, True),
+    "cliente_asc": (func.coalesce(Preventivo.nome_cliente, literal_column("''")), False),
+    "cliente_desc": (func.coalesce(Preventivo.nome_cliente, literal_column("''")), True),
+    "valore_asc": (func.coalesce(Preventivo.valore_totale_lordo, literal_column("0")), False),
+    "valore_desc": (func.coalesce(Preventivo.valore_totale_lordo, literal_column("0")), True),
+}
+# Solo per il cestino: i record cestinati prima dell'introduzione di cestinato_il usano updated_at
+_ORDINAMENTO_CESTINO = (func.coalesce(Preventivo.cestinato_il, Preventivo.updated_at), True)
+
+# Testo su cui lavora la ricerca libera; il separatore "a capo" impedisce che un termine
+# (che non può contenerne) trovi corrispondenze a cavallo di due campi.
+# Stessa espressione dell'indice trigram creato dalla migrazione
+_A_CAPO = literal_column("'\n'")
+TESTO_RICERCA_PREVENTIVO = (
+    Preventivo.numero_preventivo + _A_CAPO
+    + func.coalesce(Preventivo.nome_documento, literal_column("''")) + _A_CAPO
+    + Preventivo.oggetto_preventivo + _A_CAPO
+    + func.coalesce(Preventivo.nome_cliente, literal_column("''"))
+)
+
+
+def codifica_cursore(chiave_ordinamento: str, valore, preventivo_id) -> str:
+    """Cursore opaco per la paginazione keyset: ordinamento e posizione (valore, id) dell'ultimo elemento restituito"""
+    if isinstance(valore, datetime):
+        valore = ["dt", valore.isoformat()]
+    elif isinstance(valore, date):
+        valore = ["d", valore.isoformat()]
+    elif isinstance(valore, Decimal):
+        valore = ["n", str(valore)]
+    contenuto = json.dumps([chiave_ordinamento, valore, str(preventivo_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(contenuto.encode()).decode().rstrip("=")
+
+
+def decodifica_cursore(cursore: str, chiave_ordinamento: str) -> Tuple[object, uuid.UUID]:
+    """
+    Decodifica un cursore prodotto da codifica_cursore per lo stesso ordinamento.
+
+    Raises:
+        ValueError: Se il cursore non è valido o è stato prodotto con un altro ordinamento
+    """
+    try:
+        contenuto = base64.urlsafe_b64decode(cursore + "=" * (-len(cursore) % 4))
+        chiave, valore, preventivo_id = json.loads(contenuto)
+        if isinstance(valore, list):
+            tipo, testo = valore
+            valore = {"dt": datetime.fromisoformat, "d": date.fromisoformat, "n": Decimal}[tipo](testo)
+        elif not isinstance(valore, str):
+            raise TypeError(valore)
+        if chiave != chiave_ordinamento:
+            raise ValueError("Il cursore appartiene a un altro ordinamento")
+        return valore, uuid.UUID(preventivo_id)
+    except (ValueError, TypeError, KeyError, ArithmeticError) as e:
+        raise ValueError("Cursore di paginazione non valido") from e
+
+
+# Query condivise da PreventivoService e AsyncPreventivoService: i due servizi
+# differiscono solo per come le eseguono (Session o AsyncSession)
+
+def _filtri_preventivo(preventivo_id: str, user_id: str, solo_attivi: bool) -> list:
+    filtri = [Preventivo.id == preventivo_id, Preventivo.user_id == user_id]
+    if solo_attivi:
+        filtri.append(Preventivo.stato_record == "attivo")
+    return filtri
+
+
+def _query_lista(user_id: str, stato_record: str) -> Select:
+    """Preventivi dell'utente nello stato indicato: le colonne di riepilogo bastano, il documento JSONB non viene letto"""
+    return select(Preventivo).options(defer(Preventivo.dati_preventivo)).where(
+        Preventivo.user_id == user_id,
+        Preventivo.stato_record == stato_record
+    )
+
+
+def _query_lista_con_cartelle(
+    user_id: str,
+    stato_record: str,
+    cartella_id: Optional[str],
+    ricerca: Optional[str],
+    stato_preventivo: Optional[str],
+    data_da: Optional[date],
+    data_a: Optional[date],
+    ordinamento: str
+) -> Select:
+    """
+    Query della lista con nome e colore della cartella (vedi lista_preventivi_con_cartelle).
+
+    Raises:
+        ValueError: Se l'ordinamento non è valido
+    """
+    if ordinamento not in ORDINAMENTI_PREVENTIVI:
+        raise ValueError(f"Ordinamento non valido: {ordinamento}. Valori ammessi: {', '.join(ORDINAMENTI_PREVENTIVI)}")
+
+    query = _query_lista(user_id, stato_record).outerjoin(Cartella, Preventivo.cartella_id == Cartella.id)
+
+    # Filtro per cartella se specificato
+    if cartella_id == 'none':
+        query = query.where(Preventivo.cartella_id.is_(None))
+    elif cartella_id:
+        query = query.where(Preventivo.cartella_id == cartella_id)
+
+    termine = " ".join((ricerca or "").split())
+    if termine:
+        # Ricerca "contiene", senza distinzione maiuscole/minuscole; % e _ sono letterali
+        termine = termine.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.where(TESTO_RICERCA_PREVENTIVO.ilike(f"%{termine}%", escape="\\"))
+    if stato_preventivo:
+        query = query.where(Preventivo.stato_preventivo == stato_preventivo)
+    if data_da:
+        query = query.where(Preventivo.data_emissione >= data_da)
+    if data_a:
+        query = query.where(Preventivo.data_emissione <= data_a)
+
+    # Aggiungi le colonne della cartella alla query
+    return query.add_columns(
+        Cartella.nome.label('cartella_nome'),
+        Cartella.colore.label('cartella_colore')
+    )
+
+
+def _query_pagina(query: Select, chiave_ordinamento: str, ordinamento: Tuple[object, bool], skip: int, limit: int, cursore: Optional[str]) -> Select:
+    """
+    Applica ordinamento (espressione e poi id, entrambi ASC o entrambi DESC) e paginazione alla query.
+    Con la stessa direzione per le due colonne un unico indice (..., espressione, id)
+    serve l'ordinamento crescente e, letto all'indietro, quello decrescente.
+    Con un cursore la pagina parte subito dopo l'ultimo elemento della precedente
+    (paginazione keyset, servita dall'indice senza scorrere le righe saltate),
+    altrimenti si usa l'offset `skip` per compatibilità.
+    Il valore dell'ordinamento viene aggiunto come ultima colonna (per il cursore).
+
+    Raises:
+        ValueError: Se il cursore non è valido
+    """
+    espressione, decrescente = ordinamento
+    if cursore:
+        valore, ultimo_id = decodifica_cursore(cursore, chiave_ordinamento)
+        if decrescente:
+            dopo = or_(espressione < valore, and_(espressione == valore, Preventivo.id < ultimo_id))
+        else:
+            dopo = or_(espressione > valore, and_(espressione == valore, Preventivo.id > ultimo_id))
+        query = query.where(
+            # Condizione ridondante ma usabile come limite dello scan sull'indice
+            (espressione <= valore) if decrescente else (espressione >= valore),
+            dopo
+        )
+
+    query = query.add_columns(espressione.label("_ordinamento")).order_by(
+        *((espressione.desc(), Preventivo.id.desc()) if decrescente else (espressione.asc(), Preventivo.id.asc()))
+    )
+    if not cursore and skip:
+        query = query.offset(skip)
+    # Un elemento in più per sapere se esiste una pagina successiva
+    return query.limit(limit + 1)
+
+
+def _risultato_pagina(righe: list, solo_preventivo: bool, chiave_ordinamento: str, limit: int) -> Tuple[list, Optional[str]]:
+    """Elementi della pagina letta con _query_pagina e cursore della successiva (None se è l'ultima)"""
+    prossimo_cursore = None
+    if len(righe) > limit:
+        righe = righe[:limit]
+        ultima = righe[-1]
+        prossimo_cursore = codifica_cursore(chiave_ordinamento, ultima[-1], ultima[0].id)
+
+    elementi = [riga[0] if solo_preventivo else tuple(riga[:-1]) for riga in righe]
+    return elementi, prossimo_cursore
+
+
+def _elementi_con_cartella(righe: list) -> List[PreventivoListItemConCartella]:
+    """Converte le righe (Preventivo, cartella_nome, cartella_colore) in PreventivoListItemConCartella"""
+    result = []
+    for row in righe: # Rinominato item in row per chiarezza
+        preventivo_obj = row[0]    # L'oggetto Preventivo è sempre il primo elemento
+        cartella_nome_val = row[1] # Valore da Cartella.nome.label('cartella_nome')
+        cartella_colore_val = row[2]# Valore da Cartella.colore.label('cartella_colore')
+        
+        result.append(PreventivoListItemConCartella(
+            id=str(preventivo_obj.id),
+            numero_preventivo=preventivo_obj.numero_preventivo,
+            nome_documento=preventivo_obj.nome_documento,
+            oggetto_preventivo=preventivo_obj.oggetto_preventivo,
+            stato_preventivo=preventivo_obj.stato_preventivo,
+            nome_cliente=preventivo_obj.nome_cliente,
+            valore_totale_lordo=preventivo_obj.valore_totale_lordo,
+            data_emissione=preventivo_obj.data_emissione,
+            data_scadenza=preventivo_obj.data_scadenza,
+            created_at=preventivo_obj.created_at,
+            updated_at=preventivo_obj.updated_at,
+            stato_record=preventivo_obj.stato_record,
+            cestinato_il=preventivo_obj.cestinato_il,
+            cartella_id=str(preventivo_obj.cartella_id) if preventivo_obj.cartella_id else None,
+            cartella_nome=cartella_nome_val,
+            cartella_colore=cartella_colore_val
+        ))
+    return result
+
 
 class PreventivoService:
     
     def __init__(self, db: Session):
         self.db = db
     
-    def salva_preventivo(self, preventivo_data: PreventivoMasterModel, user_id: str) -> Preventivo: # Cambiato da UUID a str
+    def salva_preventivo(self, preventivo_data: PreventivoMasterModel, user_id: str, chiave_idempotenza: Optional[str] = None, preventivo_json: Optional[dict] = None) -> Preventivo: # Cambiato da UUID a str
         """
         Salva un nuovo preventivo nel database.
         I nuovi preventivi sono sempre 'attivi'.
-        Include verifica anti-duplicati come fallback di sicurezza.
-        """
-        # Verifica anti-duplicati: controlla se esiste già un preventivo simile
-        numero_preventivo = preventivo_data.metadati_preventivo.numero_preventivo
-        nome_documento = preventivo_data.metadati_preventivo.nome_documento
-        
-        # Cerca preventivi esistenti con stesso numero o nome documento (ultimi 10 minuti)
-        cutoff_time = datetime.utcnow() - timedelta(minutes=10)
-        
-        existing_preventivo = None
-        if numero_preventivo and numero_preventivo.startswith('PREV-'):
-            # Per preventivi con numero auto-generato, cerca anche per nome documento
-            existing_preventivo = self.db.query(Preventivo).filter(
-                Preventivo.user_id == user_id,
-                Preventivo.stato_record == "attivo",
-                Preventivo.created_at >= cutoff_time,
-                (Preventivo.numero_preventivo == numero_preventivo) | 
-                (Preventivo.nome_documento == nome_documento)
-            ).first()
-        
-        if existing_preventivo:
-            print(f"ANTI-DUPLICATI: Trovato preventivo esistente {existing_preventivo.id}, aggiornando invece di creare nuovo")
-            # Aggiorna il preventivo esistente invece di crearne uno nuovo
-            return self.aggiorna_preventivo(str(existing_preventivo.id), preventivo_data, user_id)
-        
+        Il salvataggio è idempotente: la chiave (header Idempotency-Key o, in mancanza,
+        metadati_preventivo.id_preventivo generato dal client) identifica il documento,
+        e un nuovo invio con la stessa chiave aggiorna il preventivo già salvato invece
+        di crearne un altro. Inserimento o aggiornamento avvengono con un'unica
+        INSERT ... ON CONFLICT DO UPDATE, quindi anche invii concorrenti non creano duplicati.
+
+        preventivo_json è il documento già serializzato dal chiamante, se disponibile.
+
+        Raises:
+            PreventivoCestinatoError: Se la chiave appartiene a un preventivo nel cestino
+        """
+        if chiave_idempotenza is None:
+            id_preventivo = str(preventivo_data.metadati_preventivo.id_preventivo)
+            # L'UUID nullo è un segnaposto, non identifica il documento
+            if id_preventivo != UUID_NULLO:
+                chiave_idempotenza = id_preventivo
+
         # Converti il modello Pydantic in dizionario per salvarlo come JSON
-        preventivo_json = preventivo_data.model_dump(mode='json')
-        
-        # Crea il record del preventivo
-        db_preventivo = Preventivo(
-            user_id=user_id,
+        if preventivo_json is None:
+            preventivo_json = preventivo_data.model_dump(mode='json')
+        valori = dict(
             numero_preventivo=preventivo_data.metadati_preventivo.numero_preventivo,
             nome_documento=preventivo_data.metadati_preventivo.nome_documento,
             oggetto_preventivo=preventivo_data.metadati_preventivo.oggetto_preventivo,
             stato_preventivo=preventivo_data.metadati_preventivo.stato_preventivo,
             template_id=preventivo_data.metadati_preventivo.template_id,
             dati_preventivo=preventivo_json,
-            stato_record="attivo"  # Default per nuovi preventivi
+            **self.colonne_riepilogo(preventivo_json)
         )
-        
-        self.db.add(db_preventivo)
+
+        if chiave_idempotenza is None:
+            # Crea il record del preventivo
+            db_preventivo = Preventivo(
+                user_id=user_id,
+                stato_record="attivo",  # Default per nuovi preventivi
+                **valori
+            )
+            self.db.add(db_preventivo)
+            self.db.commit()
+            self.db.refresh(db_preventivo)
+            self._dopo_scrittura(user_id)
+            return db_preventivo
+
+        adesso = datetime.utcnow()
+        insert = pg_insert if self.db.get_bind().dialect.name == "postgresql" else sqlite_insert
+        inserimento = insert(Preventivo).values(
+            id=uuid.uuid4(),
+            user_id=user_id,
+            chiave_idempotenza=chiave_idempotenza,
+            stato_record="attivo",  # Default per nuovi preventivi
+            created_at=adesso,
+            updated_at=adesso,
+            **valori
+        )
+        istruzione = inserimento.on_conflict_do_update(
+            index_elements=[Preventivo.user_id, Preventivo.chiave_idempotenza],
+            set_={**{colonna: inserimento.excluded[colonna] for colonna in valori}, "updated_at": adesso},
+            # Un preventivo cestinato non viene riportato in vita da un nuovo invio
+            where=Preventivo.stato_record == "attivo"
+        ).returning(Preventivo)
+
+        db_preventivo = self.db.scalars(istruzione, execution_options={"populate_existing": True}).first()
+        if db_preventivo is None:
+            self.db.rollback()
+            raise PreventivoCestinatoError(
+                "Esiste già un preventivo con questa chiave di idempotenza, ma è nel cestino: "
+                "ripristinalo per modificarlo o salva il documento con una nuova chiave"
+            )
         self.db.commit()
-        self.db.refresh(db_preventivo)
-        
+
+        # Se il documento esisteva già, i PDF della versione precedente non servono più
+        self._dopo_scrittura(user_id, db_preventivo.id)
         return db_preventivo
     
-    def aggiorna_preventivo(self, preventivo_id: str, preventivo_data: PreventivoMasterModel, user_id: str) -> Optional[Preventivo]: # Cambiato da UUID a str
+    def aggiorna_preventivo(self, preventivo_id: str, preventivo_data: PreventivoMasterModel, user_id: str, preventivo_json: Optional[dict] = None) -> Optional[Preventivo]: # Cambiato da UUID a str
         """
         Aggiorna un preventivo esistente.
         Solo i preventivi attivi possono essere aggiornati tramite questo metodo.
+        preventivo_json è il documento già serializzato dal chiamante, se disponibile.
         """
         # Trova il preventivo attivo
         db_preventivo = self.db.query(Preventivo).filter(
@@ -78,86 +365,220 @@ class PreventivoService:
             return None
         
         # Aggiorna i dati
-        preventivo_json = preventivo_data.model_dump(mode='json')
+        if preventivo_json is None:
+            preventivo_json = preventivo_data.model_dump(mode='json')
         db_preventivo.numero_preventivo = preventivo_data.metadati_preventivo.numero_preventivo
         db_preventivo.nome_documento = preventivo_data.metadati_preventivo.nome_documento
         db_preventivo.oggetto_preventivo = preventivo_data.metadati_preventivo.oggetto_preventivo
         db_preventivo.stato_preventivo = preventivo_data.metadati_preventivo.stato_preventivo
         db_preventivo.template_id = preventivo_data.metadati_preventivo.template_id
         db_preventivo.dati_preventivo = preventivo_json
+        for colonna, valore in self.colonne_riepilogo(preventivo_json).items():
+            setattr(db_preventivo, colonna, valore)
         db_preventivo.updated_at = datetime.utcnow()
         
         self.db.commit()
         self.db.refresh(db_preventivo)
         
+        # I PDF generati dalla versione precedente non verranno più richiesti
+        self._dopo_scrittura(user_id, preventivo_id)
+        
         return db_preventivo
     
+    def _dopo_scrittura(self, user_id: str, *preventivo_ids) -> None:
+        """
+        Invalida quanto calcolato dai preventivi modificati: le statistiche dell'utente,
+        i modelli deserializzati e i PDF in cache dei preventivi indicati. Da chiamare dopo ogni commit che li modifica.
+        Per qualche secondo le letture dell'utente restano sul primario (vedi RegistroScritture).
+        """
+        registro_scritture.segna(user_id)
+        statistiche_cache.invalida_utente(user_id)
+        preventivi_cache.invalida(*preventivo_ids)
+        for preventivo_id in preventivo_ids:
+            pdf_cache.invalida_preventivo(str(preventivo_id))
+
+    @staticmethod
+    def colonne_riepilogo(dati_preventivo: dict) -> dict:
+        """
+        Valori delle colonne di riepilogo (cliente, totale, date) ricavati dal JSON
+        del preventivo, da salvare insieme a dati_preventivo.
+        """
+        metadati = dati_preventivo.get("metadati_preventivo") or {}
+        cliente = dati_preventivo.get("cliente_destinatario") or {}
+        totali = dati_preventivo.get("dettagli_totali") or {}
+        
+        def data(valore):
+            return date.fromisoformat(str(valore)[:10]) if valore else None
+        
+        nome_cliente = cliente.get("nome_cliente")
+        return {
+            "nome_cliente": nome_cliente[:500] if nome_cliente else None,
+            "valore_totale_lordo": totali.get("totale_generale_lordo"),
+            "data_emissione": data(metadati.get("data_emissione")),
+            "data_scadenza": data(metadati.get("data_scadenza"))
+        }
+    
     def carica_preventivo(self, preventivo_id: str, user_id: str, solo_attivi: bool = True) -> Optional[PreventivoMasterModel]: # Cambiato da UUID a str
         """
         Carica un preventivo dal database e lo converte in PreventivoMasterModel.
         Di default carica solo preventivi attivi, ma può caricarli anche se cestinati se solo_attivi=False.
+        Il modello viene dalla cache dei preventivi deserializzati se la versione (updated_at)
+        coincide: in quel caso dal database si legge solo updated_at. Il modello restituito
+        ha i totali già calcolati ed è condiviso: non va modificato.
         """
-        query = self.db.query(Preventivo).filter(
-            Preventivo.id == preventivo_id,
-            Preventivo.user_id == user_id
-        )
-        if solo_attivi:
-            query = query.filter(Preventivo.stato_record == "attivo")
+        filtri = _filtri_preventivo(preventivo_id, user_id, solo_attivi)
         
-        db_preventivo = query.first()
+        versione = self.db.execute(select(Preventivo.updated_at).where(*filtri)).first()
+        if not versione:
+            return None
+        preventivo_model = preventivi_cache.leggi(preventivo_id, versione.updated_at)
+        if preventivo_model is not None:
+            return preventivo_model
+        
+        db_preventivo = self.db.scalars(select(Preventivo).where(*filtri)).first()
         
         if not db_preventivo:
             return None
+        return self._converti_e_memorizza(db_preventivo)
+    
+    def carica_preventivi_per_export(self, user_id: str, preventivo_ids: Optional[List[str]] = None, cartella_id: Optional[str] = None) -> List[Tuple[str, PreventivoMasterModel]]:
+        """
+        Carica con una sola query i preventivi attivi da esportare: quelli indicati
+        (nell'ordine richiesto) oppure tutti quelli di una cartella.
+        I preventivi non trovati o non deserializzabili vengono saltati.
+        """
+        query = self.db.query(Preventivo).filter(
+            Preventivo.user_id == user_id,
+            Preventivo.stato_record == "attivo"
+        )
+        if preventivo_ids is not None:
+            query = query.filter(Preventivo.id.in_(preventivo_ids))
+        else:
+            query = query.filter(Preventivo.cartella_id == cartella_id)
+        
+        righe = query.order_by(Preventivo.updated_at.desc()).all()
+        if preventivo_ids is not None:
+            posizioni = {pid: i for i, pid in enumerate(preventivo_ids)}
+            righe.sort(key=lambda p: posizioni.get(str(p.id), len(posizioni)))
+        
+        risultati = []
+        for db_preventivo in righe:
+            preventivo_model = self._converti_in_modello(db_preventivo)
+            if preventivo_model:
+                risultati.append((str(db_preventivo.id), preventivo_model))
+        return risultati
+    
+    @staticmethod
+    def _converti_e_memorizza(db_preventivo: Preventivo) -> Optional[PreventivoMasterModel]:
+        """Converte il preventivo letto per intero, ne calcola i totali e lo salva nella cache dei preventivi"""
+        # Dimensione stimata dal JSON salvato, per il limite di memoria della cache
+        dimensione = len(json.dumps(db_preventivo.dati_preventivo))
+        preventivo_model = PreventivoService._converti_in_modello(db_preventivo)
+        if preventivo_model is not None:
+            # Totali calcolati una volta qui: i chiamanti ricevono il modello condiviso e non lo modificano
+            calcola_totali_preventivo(preventivo_model)
+            preventivi_cache.salva(db_preventivo.id, db_preventivo.updated_at, preventivo_model, dimensione)
+        return preventivo_model
+    
+    @staticmethod
+    def _dati_con_colonne(db_preventivo: Preventivo) -> dict:
+        """
+        Restituisce il JSON salvato di un preventivo allineando template_id e
+        nome_documento con le colonne del DB e rinumerando le righe.
+        """
+        preventivo_id = db_preventivo.id
+        
+        # Inizia con il dizionario JSON memorizzato
+        preventivo_dati_dict = db_preventivo.dati_preventivo
         
+        # Assicurati che 'metadati_preventivo' esista come dizionario
+        # e che preventivo_dati_dict sia effettivamente un dizionario
+        if not isinstance(preventivo_dati_dict, dict):
+            # Questo non dovrebbe accadere se dati_preventivo è sempre un JSON valido
+            print(f"Attenzione: dati_preventivo per {preventivo_id} non è un dict come atteso.")
+            preventivo_dati_dict = {} # Fallback per evitare errori ulteriori
+
+        if not isinstance(preventivo_dati_dict.get('metadati_preventivo'), dict):
+            preventivo_dati_dict['metadati_preventivo'] = {}
+
+        # Imposta o sovrascrivi il template_id nei dati con quello dalla colonna del DB
+        # Converti l'UUID in stringa se presente, altrimenti None
+        preventivo_dati_dict['metadati_preventivo']['template_id'] = str(db_preventivo.template_id) if db_preventivo.template_id else None
+        
+        # Imposta il nome_documento dal database se presente
+        if db_preventivo.nome_documento:
+            preventivo_dati_dict['metadati_preventivo']['nome_documento'] = db_preventivo.nome_documento
+        
+        # numero_riga segue la posizione: riallineato anche per i documenti salvati
+        # prima che le modifiche di riga rinumerassero le righe spostate
+        righe = (preventivo_dati_dict.get('corpo_preventivo') or {}).get('righe')
+        if isinstance(righe, list):
+            for numero_riga, riga in enumerate(righe, start=1):
+                if isinstance(riga, dict):
+                    riga['numero_riga'] = numero_riga
+        return preventivo_dati_dict
+    
+    @staticmethod
+    def _converti_in_modello(db_preventivo: Preventivo) -> Optional[PreventivoMasterModel]:
+        """
+        Converte il JSON salvato di un preventivo in PreventivoMasterModel,
+        allineando template_id e nome_documento con le colonne del DB.
+        """
         # Converte il JSON in PreventivoMasterModel
         try:
-            # Inizia con il dizionario JSON memorizzato
-            preventivo_dati_dict = db_preventivo.dati_preventivo
-            
-            # Assicurati che 'metadati_preventivo' esista come dizionario
-            # e che preventivo_dati_dict sia effettivamente un dizionario
-            if not isinstance(preventivo_dati_dict, dict):
-                # Questo non dovrebbe accadere se dati_preventivo è sempre un JSON valido
-                print(f"Attenzione: dati_preventivo per {preventivo_id} non è un dict come atteso.")
-                preventivo_dati_dict = {} # Fallback per evitare errori ulteriori
-
-            if not isinstance(preventivo_dati_dict.get('metadati_preventivo'), dict):
-                preventivo_dati_dict['metadati_preventivo'] = {}
-
-            # Imposta o sovrascrivi il template_id nei dati con quello dalla colonna del DB
-            # Converti l'UUID in stringa se presente, altrimenti None
-            preventivo_dati_dict['metadati_preventivo']['template_id'] = str(db_preventivo.template_id) if db_preventivo.template_id else None
-            
-            # Imposta il nome_documento dal database se presente
-            if db_preventivo.nome_documento:
-                preventivo_dati_dict['metadati_preventivo']['nome_documento'] = db_preventivo.nome_documento
-            
             # Ora crea il PreventivoMasterModel usando il dizionario aggiornato
-            preventivo_model = PreventivoMasterModel(**preventivo_dati_dict)
+            preventivo_model = PreventivoMasterModel(**PreventivoService._dati_con_colonne(db_preventivo))
             # Potremmo voler arricchire il modello con lo stato_record se necessario al chiamante
             return preventivo_model
         except Exception as e:
             # Log dell'errore
-            print(f"Errore nella deserializzazione del preventivo {preventivo_id}: {e}")
+            print(f"Errore nella deserializzazione del preventivo {db_preventivo.id}: {e}")
             return None
     
-    def lista_preventivi_attivi(self, user_id: str, skip: int = 0, limit: int = 100) -> List[Preventivo]:
+    def carica_preventivo_json(self, preventivo_id: str, user_id: str, solo_attivi: bool = True) -> Optional[str]:
         """
-        Restituisce la lista dei preventivi attivi per un utente.
+        Restituisce il documento JSON salvato così com'è, con le stesse correzioni di
+        carica_preventivo (template_id, nome_documento, numerazione delle righe) ma
+        senza costruire e riserializzare il PreventivoMasterModel: il documento è già
+        stato validato al salvataggio. Su PostgreSQL le correzioni sono applicate nella query.
         """
-        return self.db.query(Preventivo).filter(
-            Preventivo.user_id == user_id,
-            Preventivo.stato_record == "attivo"
-        ).order_by(Preventivo.updated_at.desc()).offset(skip).limit(limit).all()
+        if self.db.get_bind().dialect.name == "postgresql":
+            return self.db.execute(_SQL_DOCUMENTO_JSON, {
+                "id": preventivo_id,
+                "user_id": user_id,
+                "solo_attivi": solo_attivi
+            }).scalar()
+        
+        db_preventivo = self.db.scalars(select(Preventivo).where(*_filtri_preventivo(preventivo_id, user_id, solo_attivi))).first()
+        if not db_preventivo:
+            return None
+        return json.dumps(self._dati_con_colonne(db_preventivo))
+    
+    def lista_preventivi_attivi(self, user_id: str, skip: int = 0, limit: int = 100, cursore: Optional[str] = None) -> Tuple[List[Preventivo], Optional[str]]:
+        """
+        Restituisce la lista dei preventivi attivi per un utente, dal più recente,
+        e il cursore della pagina successiva (None se non ci sono altri elementi).
+        Con il cursore skip viene ignorato.
+        """
+        return self._pagina(_query_lista(user_id, "attivo"), "updated_at_desc", ORDINAMENTI_PREVENTIVI["updated_at_desc"], skip, limit, cursore)
 
-    def lista_preventivi_cestinati(self, user_id: str, skip: int = 0, limit: int = 100) -> List[Preventivo]:
+    def lista_preventivi_cestinati(self, user_id: str, skip: int = 0, limit: int = 100, cursore: Optional[str] = None) -> Tuple[List[Preventivo], Optional[str]]:
         """
-        Restituisce la lista dei preventivi cestinati per un utente.
+        Restituisce la lista dei preventivi cestinati per un utente, dal più
+        recentemente cestinato, e il cursore della pagina successiva.
         """
-        return self.db.query(Preventivo).filter(
-            Preventivo.user_id == user_id,
-            Preventivo.stato_record == "cestinato"
-        ).order_by(Preventivo.cestinato_il.desc()).offset(skip).limit(limit).all()
+        return self._pagina(_query_lista(user_id, "cestinato"), "cestinato_il_desc", _ORDINAMENTO_CESTINO, skip, limit, cursore)
+
+    def _pagina(self, query: Select, chiave_ordinamento: str, ordinamento: Tuple[object, bool], skip: int, limit: int, cursore: Optional[str]) -> Tuple[list, Optional[str]]:
+        """
+        Esegue la query paginata (vedi _query_pagina). La query può restituire
+        il Preventivo da solo o come primo elemento di una riga.
+
+        Raises:
+            ValueError: Se il cursore non è valido
+        """
+        righe = self.db.execute(_query_pagina(query, chiave_ordinamento, ordinamento, skip, limit, cursore)).all()
+        return _risultato_pagina(righe, len(query.column_descriptions) == 1, chiave_ordinamento, limit)
 
     def cestina_preventivo(self, preventivo_id: str, user_id: str) -> Optional[Preventivo]:
         """
@@ -178,6 +599,7 @@ class PreventivoService:
         
         self.db.commit()
         self.db.refresh(db_preventivo)
+        self._dopo_scrittura(user_id)
         return db_preventivo
 
     def ripristina_preventivo(self, preventivo_id: str, user_id: str) -> Optional[Preventivo]:
@@ -199,6 +621,7 @@ class PreventivoService:
         
         self.db.commit()
         self.db.refresh(db_preventivo)
+        self._dopo_scrittura(user_id)
         return db_preventivo
 
     def elimina_definitivamente_preventivo(self, preventivo_id: str, user_id: str) -> bool:
@@ -218,62 +641,65 @@ class PreventivoService:
         
         self.db.delete(db_preventivo)
         self.db.commit()
+        self._dopo_scrittura(user_id, preventivo_id)
         
         return True
 
-    def svuota_cestino_scaduti(self, user_id: Optional[str] = None, giorni_scadenza: int = 30) -> int:
+    def svuota_cestino_scaduti(self, user_id: Optional[str] = None, giorni_scadenza: int = CESTINO_GIORNI_SCADENZA) -> int:
         """
         Elimina definitivamente i preventivi cestinati da più di 'giorni_scadenza'.
         Se user_id è fornito, opera solo per quell'utente.
-        Altrimenti (con cautela!), potrebbe operare globalmente (richiede privilegi admin non implementati qui).
+        Altrimenti non fa nulla: la pulizia globale è eseguita da RetentionSweeper.
         Restituisce il numero di preventivi eliminati.
         """
+        if not user_id:
+            print("Attenzione: user_id non fornito per svuota_cestino_scaduti. Nessuna operazione globale eseguita per sicurezza.")
+            return 0
+
         cutoff_date = datetime.utcnow() - timedelta(days=giorni_scadenza)
-        query = self.db.query(Preventivo).filter(
+        return self.elimina_in_blocchi(
+            Preventivo.user_id == user_id,
             Preventivo.stato_record == "cestinato",
             Preventivo.cestinato_il <= cutoff_date
         )
-        
-        if user_id:
-            query = query.filter(Preventivo.user_id == user_id)
-        else:
-            # Qui si potrebbe inserire un controllo per ruolo admin se si volesse un cleanup globale
-            # Per ora, se user_id non è fornito, non fa nulla per sicurezza.
-            # O, si potrebbe decidere che questa funzione è sempre per utente.
-            # In un sistema multi-tenant reale, il cleanup globale sarebbe più complesso.
-            print("Attenzione: user_id non fornito per svuota_cestino_scaduti. Nessuna operazione globale eseguita per sicurezza.")
-            return 0
-
-
-        preventivi_da_eliminare = query.all()
-        count = len(preventivi_da_eliminare)
-        
-        if count > 0:
-            for preventivo in preventivi_da_eliminare:
-                self.db.delete(preventivo)
-            self.db.commit()
-            
-        return count
 
     def svuota_tutto_cestino(self, user_id: str) -> int:
         """
         Elimina definitivamente TUTTI i preventivi nel cestino per un utente.
         Restituisce il numero di preventivi eliminati.
         """
-        query = self.db.query(Preventivo).filter(
+        return self.elimina_in_blocchi(
             Preventivo.user_id == user_id,
             Preventivo.stato_record == "cestinato"
         )
-        
-        preventivi_da_eliminare = query.all()
-        count = len(preventivi_da_eliminare)
-        
-        if count > 0:
-            for preventivo in preventivi_da_eliminare:
-                self.db.delete(preventivo)
+
+    def elimina_in_blocchi(self, *condizioni, dimensione_blocco: int = ELIMINAZIONE_DIMENSIONE_BLOCCO) -> int:
+        """
+        Elimina definitivamente i preventivi che soddisfano le condizioni con
+        DELETE ... RETURNING a blocchi di `dimensione_blocco` righe, ognuno nella propria
+        transazione breve. Le righe bloccate da altre transazioni vengono saltate e
+        riprese al passaggio successivo. Restituisce il numero di preventivi eliminati.
+        """
+        eliminati = 0
+        while True:
+            blocco = select(Preventivo.id).where(*condizioni).limit(dimensione_blocco).with_for_update(skip_locked=True)
+            righe = self.db.execute(
+                delete(Preventivo)
+                .where(Preventivo.id.in_(blocco.scalar_subquery()))
+                .returning(Preventivo.id, Preventivo.user_id)
+                .execution_options(synchronize_session=False)
+            ).all()
             self.db.commit()
-            
-        return count
+
+            utenti = {}
+            for preventivo_id, user_id in righe:
+                utenti.setdefault(user_id, []).append(preventivo_id)
+            for user_id, preventivo_ids in utenti.items():
+                self._dopo_scrittura(user_id, *preventivo_ids)
+
+            eliminati += len(righe)
+            if len(righe) < dimensione_blocco:
+                return eliminati
 
     def get_dati_azienda_utente(self, user_id: str) -> Optional[IntestazioneAzienda]: # Cambiato da UUID a str
         """
@@ -306,58 +732,35 @@ class PreventivoService:
         
         return intestazione_azienda
 
-    def lista_preventivi_con_cartelle(self, user_id: str, stato_record: str = "attivo", cartella_id: Optional[str] = None, skip: int = 0, limit: int = 100) -> List[PreventivoListItemConCartella]:
+    def lista_preventivi_con_cartelle(
+        self,
+        user_id: str,
+        stato_record: str = "attivo",
+        cartella_id: Optional[str] = None,
+        skip: int = 0,
+        limit: int = 100,
+        cursore: Optional[str] = None,
+        ricerca: Optional[str] = None,
+        stato_preventivo: Optional[str] = None,
+        data_da: Optional[date] = None,
+        data_a: Optional[date] = None,
+        ordinamento: str = "updated_at_desc"
+    ) -> Tuple[List[PreventivoListItemConCartella], Optional[str]]:
         """
-        Restituisce la lista dei preventivi con informazioni delle cartelle.
+        Restituisce la lista dei preventivi con informazioni delle cartelle
+        e il cursore della pagina successiva (None se non ci sono altri elementi).
         Se cartella_id è specificato, filtra per quella cartella.
         Se cartella_id è 'none', filtra per preventivi senza cartella.
+        Filtri opzionali: ricerca libera su numero, nome documento, oggetto e cliente,
+        stato del preventivo e intervallo della data di emissione (estremi inclusi).
+        L'ordinamento è una delle chiavi di ORDINAMENTI_PREVENTIVI.
+
+        Raises:
+            ValueError: Se l'ordinamento o il cursore non sono validi
         """
-        from sqlalchemy.orm import joinedload
-        
-        query = self.db.query(Preventivo).filter(
-            Preventivo.user_id == user_id,
-            Preventivo.stato_record == stato_record
-        ).outerjoin(Cartella, Preventivo.cartella_id == Cartella.id)
-        
-        # Filtro per cartella se specificato
-        if cartella_id == 'none':
-            query = query.filter(Preventivo.cartella_id.is_(None))
-        elif cartella_id:
-            query = query.filter(Preventivo.cartella_id == cartella_id)
-        
-        # Aggiungi le colonne della cartella alla query
-        query = query.add_columns(
-            Cartella.nome.label('cartella_nome'),
-            Cartella.colore.label('cartella_colore')
-        )
-        
-        preventivi = query.order_by(Preventivo.updated_at.desc()).offset(skip).limit(limit).all()
-        
-        # Converti in PreventivoListItemConCartella
-        result = []
-        for row in preventivi: # Rinominato item in row per chiarezza
-            preventivo_obj = row[0]    # L'oggetto Preventivo è sempre il primo elemento
-            cartella_nome_val = row[1] # Valore da Cartella.nome.label('cartella_nome')
-            cartella_colore_val = row[2]# Valore da Cartella.colore.label('cartella_colore')
-            
-            result.append(PreventivoListItemConCartella(
-                id=str(preventivo_obj.id),
-                numero_preventivo=preventivo_obj.numero_preventivo,
-                nome_documento=preventivo_obj.nome_documento,
-                oggetto_preventivo=preventivo_obj.oggetto_preventivo,
-                stato_preventivo=preventivo_obj.stato_preventivo,
-                nome_cliente=preventivo_obj.nome_cliente,
-                valore_totale_lordo=preventivo_obj.valore_totale_lordo,
-                created_at=preventivo_obj.created_at,
-                updated_at=preventivo_obj.updated_at,
-                stato_record=preventivo_obj.stato_record,
-                cestinato_il=preventivo_obj.cestinato_il,
-                cartella_id=str(preventivo_obj.cartella_id) if preventivo_obj.cartella_id else None,
-                cartella_nome=cartella_nome_val,
-                cartella_colore=cartella_colore_val
-            ))
-        
-        return result
+        query = _query_lista_con_cartelle(user_id, stato_record, cartella_id, ricerca, stato_preventivo, data_da, data_a, ordinamento)
+        preventivi, prossimo_cursore = self._pagina(query, ordinamento, ORDINAMENTI_PREVENTIVI[ordinamento], skip, limit, cursore)
+        return _elementi_con_cartella(preventivi), prossimo_cursore
 
     def sposta_preventivo_in_cartella(self, preventivo_id: str, user_id: str, cartella_id: Optional[str] = None) -> Optional[Preventivo]:
         """
@@ -387,5 +790,82 @@ class PreventivoService:
         
         self.db.commit()
         self.db.refresh(db_preventivo)
+        self._dopo_scrittura(user_id)
         
-        return db_preventivo 
\ No newline at end of file
+        return db_preventivo
+
+
+class AsyncPreventivoService:
+    """
+    Letture di PreventivoService su AsyncSession, con le stesse query e la stessa cache
+    dei preventivi deserializzati. Le scritture restano in PreventivoService.
+    """
+    
+    def __init__(self, db: "AsyncSession"):
+        self.db = db
+    
+    async def carica_preventivo(self, preventivo_id: str, user_id: str, solo_attivi: bool = True) -> Optional[PreventivoMasterModel]:
+        """Come PreventivoService.carica_preventivo"""
+        filtri = _filtri_preventivo(preventivo_id, user_id, solo_attivi)
+        
+        versione = (await self.db.execute(select(Preventivo.updated_at).where(*filtri))).first()
+        if not versione:
+            return None
+        preventivo_model = preventivi_cache.leggi(preventivo_id, versione.updated_at)
+        if preventivo_model is not None:
+            return preventivo_model
+        
+        db_preventivo = (await self.db.scalars(select(Preventivo).where(*filtri))).first()
+        if not db_preventivo:
+            return None
+        return PreventivoService._converti_e_memorizza(db_preventivo)
+    
+    async def carica_preventivo_json(self, preventivo_id: str, user_id: str, solo_attivi: bool = True) -> Optional[str]:
+        """Come PreventivoService.carica_preventivo_json"""
+        if self.db.get_bind().dialect.name == "postgresql":
+            return (await self.db.execute(_SQL_DOCUMENTO_JSON, {
+                "id": preventivo_id,
+                "user_id": user_id,
+                "solo_attivi": solo_attivi
+            })).scalar()
+        
+        db_preventivo = (await self.db.scalars(select(Preventivo).where(*_filtri_preventivo(preventivo_id, user_id, solo_attivi)))).first()
+        if not db_preventivo:
+            return None
+        return json.dumps(PreventivoService._dati_con_colonne(db_preventivo))
+    
+    async def lista_preventivi_attivi(self, user_id: str, skip: int = 0, limit: int = 100, cursore: Optional[str] = None) -> Tuple[List[Preventivo], Optional[str]]:
+        """Come PreventivoService.lista_preventivi_attivi"""
+        return await self._pagina(_query_lista(user_id, "attivo"), "updated_at_desc", ORDINAMENTI_PREVENTIVI["updated_at_desc"], skip, limit, cursore)
+    
+    async def lista_preventivi_cestinati(self, user_id: str, skip: int = 0, limit: int = 100, cursore: Optional[str] = None) -> Tuple[List[Preventivo], Optional[str]]:
+        """Come PreventivoService.lista_preventivi_cestinati"""
+        return await self._pagina(_query_lista(user_id, "cestinato"), "cestinato_il_desc", _ORDINAMENTO_CESTINO, skip, limit, cursore)
+    
+    async def lista_preventivi_con_cartelle(
+        self,
+        user_id: str,
+        stato_record: str = "attivo",
+        cartella_id: Optional[str] = None,
+        skip: int = 0,
+        limit: int = 100,
+        cursore: Optional[str] = None,
+        ricerca: Optional[str] = None,
+        stato_preventivo: Optional[str] = None,
+        data_da: Optional[date] = None,
+        data_a: Optional[date] = None,
+        ordinamento: str = "updated_at_desc"
+    ) -> Tuple[List[PreventivoListItemConCartella], Optional[str]]:
+        """
+        Come PreventivoService.lista_preventivi_con_cartelle
+
+        Raises:
+            ValueError: Se l'ordinamento o il cursore non sono validi
+        """
+        query = _query_lista_con_cartelle(user_id, stato_record, cartella_id, ricerca, stato_preventivo, data_da, data_a, ordinamento)
+        preventivi, prossimo_cursore = await self._pagina(query, ordinamento, ORDINAMENTI_PREVENTIVI[ordinamento], skip, limit, cursore)
+        return _elementi_con_cartella(preventivi), prossimo_cursore
+    
+    async def _pagina(self, query: Select, chiave_ordinamento: str, ordinamento: Tuple[object, bool], skip: int, limit: int, cursore: Optional[str]) -> Tuple[list, Optional[str]]:
+        righe = (await self.db.execute(_query_pagina(query, chiave_ordinamento, ordinamento, skip, limit, cursore))).all()
+        return _risultato_pagina(righe, len(query.column_descriptions) == 1, chiave_ordinamento, limit)
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+from ..database import SessionLocal
+from ..db_models import Preventivo, UserPreferences
+from .preventivo_service import CESTINO_GIORNI_SCADENZA, ELIMINAZIONE_DIMENSIONE_BLOCCO, PreventivoService
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# Configurazione della pulizia periodica (sovrascrivibile da variabili d'ambiente).
+# Disattivata di default: elimina definitivamente i preventivi dal cestino
+RETENTION_SWEEPER_ENABLED = os.getenv("RETENTION_SWEEPER_ENABLED", "false").lower() == "true"
+# Spostamento nel cestino dei preventivi oltre UserPreferences.data_retention_days.
+# Va attivato a parte: la preferenza (default 365 giorni) è nata come impostazione informativa
+# e applicarla sposta nel cestino, e poi elimina, i preventivi non modificati da un anno
+RETENTION_CONSERVAZIONE_ENABLED = os.getenv("RETENTION_CONSERVAZIONE_ENABLED", "false").lower() == "true"
+RETENTION_SWEEPER_INTERVAL = float(os.getenv("RETENTION_SWEEPER_INTERVAL", "3600"))
+
+
+@dataclass
+class EsitoPulizia:
+    spostati_nel_cestino: int
+    eliminati: int
+    durata_secondi: float
+
+
+class RetentionService:
+    """
+    Applica le regole di conservazione dei preventivi a tutti gli utenti:
+    - se applica_conservazione è attivo (RETENTION_CONSERVAZIONE_ENABLED), i preventivi attivi
+      non modificati da più di UserPreferences.data_retention_days giorni vengono spostati
+      nel cestino (solo per gli utenti con le preferenze salvate);
+    - i preventivi nel cestino da più di CESTINO_GIORNI_SCADENZA giorni vengono eliminati.
+    Quindi un preventivo oltre il periodo di conservazione resta recuperabile dal cestino
+    per CESTINO_GIORNI_SCADENZA giorni prima dell'eliminazione definitiva.
+    Ogni operazione lavora a blocchi, con transazioni brevi.
+    """
+
+    def __init__(self, db: Session, dimensione_blocco: int = ELIMINAZIONE_DIMENSIONE_BLOCCO):
+        self.db = db
+        self.dimensione_blocco = dimensione_blocco
+
+    def esegui_pulizia(
+        self,
+        giorni_scadenza_cestino: int = CESTINO_GIORNI_SCADENZA,
+        applica_conservazione: bool = RETENTION_CONSERVAZIONE_ENABLED,
+    ) -> EsitoPulizia:
+        inizio = time.monotonic()
+        spostati = self.applica_periodo_conservazione() if applica_conservazione else 0
+
+        cutoff_cestino = datetime.utcnow() - timedelta(days=giorni_scadenza_cestino)
+        eliminati = PreventivoService(self.db).elimina_in_blocchi(
+            Preventivo.stato_record == "cestinato",
+            Preventivo.cestinato_il <= cutoff_cestino,
+            dimensione_blocco=self.dimensione_blocco
+        )
+        return EsitoPulizia(spostati, eliminati, round(time.monotonic() - inizio, 3))
+
+    def applica_periodo_conservazione(self) -> int:
+        """Sposta nel cestino i preventivi attivi oltre il periodo di conservazione di ciascun utente"""
+        preferenze = self.db.query(UserPreferences.user_id, UserPreferences.data_retention_days).filter(
+            UserPreferences.data_retention_days > 0
+        ).all()
+        self.db.commit()  # Chiude la transazione della lettura
+
+        spostati = 0
+        for user_id, giorni in preferenze:
+            cutoff = datetime.utcnow() - timedelta(days=giorni)
+            spostati += self._sposta_nel_cestino_in_blocchi(
+                Preventivo.user_id == user_id,
+                Preventivo.stato_record == "attivo",
+                Preventivo.updated_at < cutoff
+            )
+        return spostati
+
+    def _sposta_nel_cestino_in_blocchi(self, *condizioni) -> int:
+        spostati = 0
+        while True:
+            adesso = datetime.utcnow()
+            blocco = select(Preventivo.id).where(*condizioni).limit(self.dimensione_blocco).with_for_update(skip_locked=True)
+            righe = self.db.execute(
+                update(Preventivo)
+                .where(Preventivo.id.in_(blocco.scalar_subquery()))
+                .values(stato_record="cestinato", cestinato_il=adesso, updated_at=adesso)
+                .returning(Preventivo.id, Preventivo.user_id)
+                .execution_options(synchronize_session=False)
+            ).all()
+            self.db.commit()
+
+            # Come per ogni altra scrittura: statistiche, modelli e PDF in cache dei preventivi spostati
+            utenti = {}
+            for preventivo_id, user_id in righe:
+                utenti.setdefault(user_id, []).append(preventivo_id)
+            for user_id, preventivo_ids in utenti.items():
+                PreventivoService(self.db)._dopo_scrittura(user_id, *preventivo_ids)
+
+            spostati += len(righe)
+            if len(righe) < self.dimensione_blocco:
+                return spostati
+
+
+class RetentionSweeper:
+    """
+    Task in-process che esegue periodicamente RetentionService.
+    Più istanze possono eseguirlo contemporaneamente: le righe già bloccate
+    da un'altra istanza vengono saltate.
+    """
+
+    def __init__(self, intervallo: float = RETENTION_SWEEPER_INTERVAL):
+        self.intervallo = intervallo
+        self._task: Optional[asyncio.Task] = None
+
+    def avvia(self) -> None:
+        if self._task:
+            return
+        self._task = asyncio.create_task(self._ciclo())
+        logger.info(f"Pulizia periodica dei preventivi avviata (ogni {self.intervallo:.0f}s)")
+
+    async def arresta(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _ciclo(self) -> None:
+        while True:
+            try:
+                await self.esegui()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Errore nella pulizia periodica dei preventivi: {e}")
+            await asyncio.sleep(self.intervallo)
+
+    async def esegui(self) -> EsitoPulizia:
+        # Le query sono sincrone: vengono eseguite in un thread per non bloccare il loop
+        esito = await asyncio.to_thread(self._esegui_sincrono)
+        logger.info(
+            f"Pulizia preventivi: {esito.spostati_nel_cestino} spostati nel cestino per conservazione, "
+            f"{esito.eliminati} eliminati dal cestino in {esito.durata_secondi}s"
+        )
+        return esito
+
+    @staticmethod
+    def _esegui_sincrono() -> EsitoPulizia:
+        db = SessionLocal()
+        try:
+            return RetentionService(db).esegui_pulizia()
+        finally:
+            db.close()
@@ -0,0 +1,289 @@
+import functools
+import json
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import flag_modified
+
+from ..db_models import Preventivo
+from ..models import RigaPreventivo, SezioneTotali
+from .autosave_service import AutosaveBuffer, autosave_buffer
+from .preventivo_calculator import CalcolatoreTotaliIncrementale
+from .preventivo_service import PreventivoService
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+PERCORSO_RIGHE = ["corpo_preventivo", "righe"]
+
+# Lettura per le modifiche di riga: la riga interessata, i totali salvati e le sole aliquote
+# delle righe (per il riepilogo IVA), senza trasferire il resto del documento
+_SQL_STATO_RIGHE = text("""
+    SELECT dati_preventivo #> CAST(:percorso_riga AS text[]) AS riga,
+           dati_preventivo -> 'dettagli_totali' AS dettagli_totali,
+           (SELECT coalesce(jsonb_agg(r.valore -> 'percentuale_iva' ORDER BY r.posizione), '[]'::jsonb)
+              FROM jsonb_array_elements(coalesce(dati_preventivo #> '{corpo_preventivo,righe}', '[]'::jsonb))
+                   WITH ORDINALITY AS r(valore, posizione)) AS aliquote
+      FROM preventivi
+     WHERE id = :id AND user_id = :user_id AND stato_record = 'attivo'
+       FOR UPDATE
+""")
+
+# Riassegna numero_riga (da 1) a tutte le righe del documento {documento}, dopo un inserimento,
+# un'eliminazione o un riordino che spostano le righe successive
+_SQL_RINUMERA_RIGHE = """(
+    SELECT jsonb_set(d.documento, '{{corpo_preventivo,righe}}', (
+        SELECT coalesce(jsonb_agg(
+                   CASE WHEN jsonb_typeof(r.riga) = 'object' THEN r.riga || jsonb_build_object('numero_riga', r.posizione) ELSE r.riga END
+                   ORDER BY r.posizione), '[]'::jsonb)
+          FROM jsonb_array_elements(coalesce(d.documento #> '{{corpo_preventivo,righe}}', '[]'::jsonb))
+               WITH ORDINALITY AS r(riga, posizione)
+    ))
+      FROM (SELECT {documento} AS documento) d
+)"""
+
+_SQL_RIGHE_COMPLETE = text("""
+    SELECT coalesce(dati_preventivo #> '{corpo_preventivo,righe}', '[]'::jsonb) FROM preventivi WHERE id = :id
+""")
+
+
+def _sopra_la_bozza(metodo):
+    """
+    Esegue la modifica dopo aver scritto l'eventuale bozza del salvataggio automatico
+    dello stesso documento, che altrimenti, scritta più tardi, la sovrascriverebbe
+    """
+    @functools.wraps(metodo)
+    def modifica(self, preventivo_id: str, user_id: str, *args, **kwargs):
+        with self.buffer.modifica_diretta(preventivo_id, user_id, self.db):
+            return metodo(self, preventivo_id, user_id, *args, **kwargs)
+    return modifica
+
+
+class RighePreventivoService:
+    """
+    Modifica delle singole righe di un preventivo salvato.
+    Su PostgreSQL ogni operazione legge solo la riga interessata, i totali e le aliquote,
+    e aggiorna il JSONB con jsonb_set/jsonb_insert: la richiesta, la validazione e il
+    ricalcolo dei totali (incrementale) non dipendono dal numero di righe del documento.
+    Gli indici delle righe partono da 0; numero_riga, salvato in ogni riga, parte da 1
+    e viene aggiornato nella stessa UPDATE quando le righe cambiano posizione.
+    """
+
+    def __init__(self, db: Session, buffer: AutosaveBuffer = autosave_buffer):
+        self.db = db
+        self.buffer = buffer
+        self.usa_jsonb = db.get_bind().dialect.name == "postgresql"
+
+    @_sopra_la_bozza
+    def aggiungi_riga(self, preventivo_id: str, user_id: str, riga: RigaPreventivo, posizione: Optional[int] = None) -> Optional[Tuple[int, Dict[str, Any], SezioneTotali]]:
+        """
+        Inserisce una riga (in coda o alla posizione indicata).
+        Restituisce (indice, riga salvata, nuovi totali) o None se il preventivo non esiste.
+
+        Raises:
+            IndexError: Se la posizione non è valida
+        """
+        stato = self._leggi_stato(preventivo_id, user_id)
+        if not stato:
+            return None
+        _, calcolatore = stato
+
+        indice = calcolatore.aggiungi_riga(riga, posizione)
+        riga_json = {**riga.model_dump(mode="json"), **calcolatore.importi_riga(indice)}
+        totali = calcolatore.totali()
+        percorso = PERCORSO_RIGHE + [str(indice)]
+
+        in_coda = indice == calcolatore.numero_righe - 1
+        if in_coda:
+            # jsonb_set con indice oltre la fine dell'array aggiunge in coda
+            espressione = "jsonb_set(dati_preventivo, CAST(:percorso AS text[]), CAST(:riga AS jsonb), true)"
+        else:
+            espressione = "jsonb_insert(dati_preventivo, CAST(:percorso AS text[]), CAST(:riga AS jsonb))"
+        self._scrivi(
+            preventivo_id, user_id, totali, espressione,
+            {"percorso": percorso, "riga": json.dumps(riga_json)},
+            lambda righe: righe.insert(indice, riga_json),
+            rinumera=not in_coda
+        )
+        return indice, riga_json, totali
+
+    @_sopra_la_bozza
+    def aggiorna_riga(self, preventivo_id: str, user_id: str, indice: int, modifiche: Dict[str, Any]) -> Optional[Tuple[int, Dict[str, Any], SezioneTotali]]:
+        """
+        Applica le modifiche parziali a una riga esistente.
+        Restituisce (indice, riga salvata, nuovi totali) o None se il preventivo non esiste.
+
+        Raises:
+            IndexError: Se la riga non esiste
+            ValidationError: Se la riga risultante non è valida
+        """
+        stato = self._leggi_stato(preventivo_id, user_id, indice)
+        if not stato:
+            return None
+        riga_precedente, calcolatore = stato
+        if riga_precedente is None:
+            raise IndexError(f"Indice riga non valido: {indice}")
+
+        riga = RigaPreventivo.model_validate({**riga_precedente, **modifiche})
+        calcolatore.aggiorna_riga(indice, riga, riga_precedente)
+        riga_json = {**riga.model_dump(mode="json"), **calcolatore.importi_riga(indice)}
+        totali = calcolatore.totali()
+
+        def sostituisci(righe: List[Dict[str, Any]]) -> None:
+            righe[indice] = riga_json
+
+        self._scrivi(
+            preventivo_id, user_id, totali,
+            "jsonb_set(dati_preventivo, CAST(:percorso AS text[]), CAST(:riga AS jsonb))",
+            {"percorso": PERCORSO_RIGHE + [str(indice)], "riga": json.dumps(riga_json)},
+            sostituisci
+        )
+        return indice, riga_json, totali
+
+    @_sopra_la_bozza
+    def elimina_riga(self, preventivo_id: str, user_id: str, indice: int) -> Optional[Tuple[int, SezioneTotali]]:
+        """
+        Elimina una riga. Restituisce (numero di righe rimaste, nuovi totali)
+        o None se il preventivo non esiste.
+
+        Raises:
+            IndexError: Se la riga non esiste
+        """
+        stato = self._leggi_stato(preventivo_id, user_id, indice)
+        if not stato:
+            return None
+        riga_precedente, calcolatore = stato
+        if riga_precedente is None:
+            raise IndexError(f"Indice riga non valido: {indice}")
+
+        calcolatore.rimuovi_riga(indice, riga_precedente)
+        totali = calcolatore.totali()
+
+        def rimuovi(righe: List[Dict[str, Any]]) -> None:
+            del righe[indice]
+
+        self._scrivi(
+            preventivo_id, user_id, totali,
+            "dati_preventivo #- CAST(:percorso AS text[])",
+            {"percorso": PERCORSO_RIGHE + [str(indice)]},
+            rimuovi,
+            rinumera=indice < calcolatore.numero_righe
+        )
+        return calcolatore.numero_righe, totali
+
+    @_sopra_la_bozza
+    def riordina_righe(self, preventivo_id: str, user_id: str, ordine: List[int]) -> Optional[Tuple[int, SezioneTotali]]:
+        """
+        Riordina le righe: ordine[i] è l'indice attuale della riga che va in posizione i.
+        Restituisce (numero di righe, totali) o None se il preventivo non esiste.
+
+        Raises:
+            ValueError: Se ordine non è una permutazione degli indici delle righe
+        """
+        stato = self._leggi_stato(preventivo_id, user_id)
+        if not stato:
+            return None
+        _, calcolatore = stato
+
+        calcolatore.riordina_righe(ordine)
+        totali = calcolatore.totali()
+
+        def permuta(righe: List[Dict[str, Any]]) -> None:
+            righe[:] = [righe[i] for i in ordine]
+
+        self._scrivi(
+            preventivo_id, user_id, totali,
+            """jsonb_set(dati_preventivo, '{corpo_preventivo,righe}', (
+                SELECT coalesce(jsonb_agg(dati_preventivo #> '{corpo_preventivo,righe}' -> o.indice ORDER BY o.posizione), '[]'::jsonb)
+                  FROM unnest(CAST(:ordine AS integer[])) WITH ORDINALITY AS o(indice, posizione)
+            ))""",
+            {"ordine": list(ordine)},
+            permuta,
+            rinumera=True
+        )
+        return calcolatore.numero_righe, totali
+
+    def _leggi_stato(self, preventivo_id: str, user_id: str, indice: Optional[int] = None) -> Optional[Tuple[Optional[Dict[str, Any]], CalcolatoreTotaliIncrementale]]:
+        """
+        Blocca il preventivo e restituisce la riga richiesta (None se l'indice non esiste)
+        e il calcolatore incrementale inizializzato dai totali salvati.
+        """
+        if not self.usa_jsonb:
+            db_preventivo = self._preventivo_attivo(preventivo_id, user_id)
+            if not db_preventivo:
+                return None
+            righe = db_preventivo.dati_preventivo.get("corpo_preventivo", {}).get("righe", [])
+            riga = righe[indice] if indice is not None and 0 <= indice < len(righe) else None
+            return riga, CalcolatoreTotaliIncrementale(righe)
+
+        # Indici negativi: in JSONB conterebbero dalla fine, per l'API non sono validi
+        percorso_riga = PERCORSO_RIGHE + [str(indice if indice is not None and indice >= 0 else -10**9)]
+        risultato = self.db.execute(_SQL_STATO_RIGHE, {
+            "percorso_riga": percorso_riga,
+            "id": preventivo_id,
+            "user_id": user_id
+        }).first()
+        if not risultato:
+            return None
+
+        riga, dettagli_totali, aliquote = risultato
+        try:
+            calcolatore = CalcolatoreTotaliIncrementale.da_totali(dettagli_totali or {}, aliquote)
+        except (ValueError, KeyError, TypeError) as e:
+            # Totali salvati mancanti o incoerenti: ricalcolo completo come fallback
+            logger.warning(f"Totali del preventivo {preventivo_id} non utilizzabili ({e}): ricalcolo completo")
+            righe = self.db.execute(_SQL_RIGHE_COMPLETE, {"id": preventivo_id}).scalar()
+            calcolatore = CalcolatoreTotaliIncrementale(righe)
+        return riga, calcolatore
+
+    def _scrivi(self, preventivo_id: str, user_id: str, totali: SezioneTotali, espressione_righe: str, parametri: Dict[str, Any], modifica_righe: Callable[[List[Dict[str, Any]]], None], rinumera: bool = False) -> None:
+        """
+        Salva la modifica delle righe, i nuovi dettagli_totali e il totale di riepilogo.
+        Su PostgreSQL con un UPDATE sui percorsi JSONB, altrimenti riscrivendo il documento.
+        Con rinumera anche numero_riga di tutte le righe viene riallineato alla posizione.
+        """
+        totali_json = totali.model_dump(mode="json")
+        adesso = datetime.utcnow()
+
+        if self.usa_jsonb:
+            if rinumera:
+                espressione_righe = _SQL_RINUMERA_RIGHE.format(documento=espressione_righe)
+            self.db.execute(text(f"""
+                UPDATE preventivi
+                   SET dati_preventivo = jsonb_set({espressione_righe}, '{{dettagli_totali}}', CAST(:totali AS jsonb)),
+                       valore_totale_lordo = :valore_totale_lordo,
+                       updated_at = :adesso
+                 WHERE id = :id
+            """), {
+                **parametri,
+                "totali": json.dumps(totali_json),
+                "valore_totale_lordo": totali.totale_generale_lordo,
+                "adesso": adesso,
+                "id": preventivo_id
+            })
+        else:
+            db_preventivo = self.db.query(Preventivo).filter(Preventivo.id == preventivo_id).first()
+            dati = db_preventivo.dati_preventivo
+            righe = dati.setdefault("corpo_preventivo", {}).setdefault("righe", [])
+            modifica_righe(righe)
+            if rinumera:
+                for numero_riga, riga in enumerate(righe, start=1):
+                    if isinstance(riga, dict):
+                        riga["numero_riga"] = numero_riga
+            dati["dettagli_totali"] = totali_json
+            flag_modified(db_preventivo, "dati_preventivo")
+            db_preventivo.valore_totale_lordo = totali.totale_generale_lordo
+            db_preventivo.updated_at = adesso
+
+        self.db.commit()
+        PreventivoService(self.db)._dopo_scrittura(user_id, preventivo_id)
+
+    def _preventivo_attivo(self, preventivo_id: str, user_id: str) -> Optional[Preventivo]:
+        return self.db.query(Preventivo).filter(
+            Preventivo.id == preventivo_id,
+            Preventivo.user_id == user_id,
+            Preventivo.stato_record == "attivo"
+        ).with_for_update().first()
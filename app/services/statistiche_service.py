@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import extract, func
+from sqlalchemy.orm import Session
+
+from ..db_models import Cartella, Preventivo
+from ..models import StatisticaCartella, StatisticaMese, StatisticaStato, StatistichePreventivi
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# Durata massima di una voce in cache (secondi). L'invalidazione esplicita copre le scritture
+# fatte da questa istanza; la scadenza limita il ritardo per quelle fatte da altre istanze.
+# 0 = cache disabilitata
+STATISTICHE_CACHE_TTL = float(os.getenv("STATISTICHE_CACHE_TTL", "300"))
+
+
+class StatisticheCache:
+    """
+    Cache in memoria delle statistiche della dashboard, per utente.
+    Ogni scrittura su un preventivo (o su una cartella) dell'utente invalida le sue voci.
+    Un contatore di generazione per utente impedisce di salvare un risultato calcolato
+    prima di un'invalidazione avvenuta durante il calcolo.
+    """
+
+    def __init__(self, ttl: float = STATISTICHE_CACHE_TTL):
+        self.ttl = ttl
+        self._voci: Dict[Tuple[str, str], Tuple[float, int, StatistichePreventivi]] = {}
+        self._generazioni: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def generazione(self, user_id: str) -> int:
+        with self._lock:
+            return self._generazioni.get(str(user_id), 0)
+
+    def leggi(self, user_id: str, stato_record: str) -> Optional[StatistichePreventivi]:
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            voce = self._voci.get((str(user_id), stato_record))
+            if not voce:
+                return None
+            scadenza, generazione, statistiche = voce
+            if scadenza < time.monotonic() or generazione != self._generazioni.get(str(user_id), 0):
+                del self._voci[(str(user_id), stato_record)]
+                return None
+            return statistiche
+
+    def salva(self, user_id: str, stato_record: str, generazione: int, statistiche: StatistichePreventivi) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            if generazione != self._generazioni.get(str(user_id), 0):
+                return  # Invalidata durante il calcolo
+            self._voci[(str(user_id), stato_record)] = (time.monotonic() + self.ttl, generazione, statistiche)
+
+    def invalida_utente(self, user_id) -> None:
+        """Da chiamare dopo ogni scrittura che modifica i preventivi dell'utente"""
+        with self._lock:
+            chiave = str(user_id)
+            self._generazioni[chiave] = self._generazioni.get(chiave, 0) + 1
+            for stato_record in [s for (u, s) in self._voci if u == chiave]:
+                del self._voci[(chiave, stato_record)]
+
+
+# Istanza condivisa dall'applicazione
+statistiche_cache = StatisticheCache()
+
+
+class StatisticheService:
+    """
+    Statistiche della dashboard calcolate nel database con GROUP BY sulle colonne
+    di riepilogo dei preventivi (stato, cartella, data di emissione, totale lordo),
+    senza leggere i documenti JSONB.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def calcola_statistiche(self, user_id: str, stato_record: str = "attivo") -> StatistichePreventivi:
+        """Conteggi e somme dei totali per stato, per cartella e per mese (dalla cache se disponibile)"""
+        statistiche = statistiche_cache.leggi(user_id, stato_record)
+        if statistiche is not None:
+            return statistiche
+
+        generazione = statistiche_cache.generazione(user_id)
+        statistiche = self._calcola(user_id, stato_record)
+        statistiche_cache.salva(user_id, stato_record, generazione, statistiche)
+        return statistiche
+
+    def _calcola(self, user_id: str, stato_record: str) -> StatistichePreventivi:
+        numero = func.count(Preventivo.id)
+        valore = func.coalesce(func.sum(Preventivo.valore_totale_lordo), 0)
+        filtro = (Preventivo.user_id == user_id, Preventivo.stato_record == stato_record)
+
+        per_stato = [
+            StatisticaStato(stato_preventivo=stato, numero_preventivi=n, valore_totale_lordo=float(v))
+            for stato, n, v in self.db.query(Preventivo.stato_preventivo, numero, valore)
+            .filter(*filtro)
+            .group_by(Preventivo.stato_preventivo)
+            .order_by(numero.desc(), Preventivo.stato_preventivo)
+            .all()
+        ]
+
+        per_cartella = [
+            StatisticaCartella(
+                cartella_id=str(cartella_id) if cartella_id else None,
+                cartella_nome=nome,
+                cartella_colore=colore,
+                numero_preventivi=n,
+                valore_totale_lordo=float(v)
+            )
+            for cartella_id, nome, colore, n, v in self.db.query(Preventivo.cartella_id, Cartella.nome, Cartella.colore, numero, valore)
+            .outerjoin(Cartella, Preventivo.cartella_id == Cartella.id)
+            .filter(*filtro)
+            .group_by(Preventivo.cartella_id, Cartella.nome, Cartella.colore)
+            .order_by(Cartella.nome.nulls_first())
+            .all()
+        ]
+
+        data_riferimento = func.coalesce(Preventivo.data_emissione, Preventivo.created_at)
+        anno = extract("year", data_riferimento)
+        mese = extract("month", data_riferimento)
+        per_mese = [
+            StatisticaMese(anno=int(a), mese=int(m), numero_preventivi=n, valore_totale_lordo=float(v))
+            for a, m, n, v in self.db.query(anno, mese, numero, valore)
+            .filter(*filtro, data_riferimento.isnot(None))
+            .group_by(anno, mese)
+            .order_by(anno.desc(), mese.desc())
+            .all()
+        ]
+
+        return StatistichePreventivi(
+            stato_record=stato_record,
+            numero_preventivi=sum(s.numero_preventivi for s in per_stato),
+            valore_totale_lordo=round(sum(s.valore_totale_lordo for s in per_stato), 2),
+            per_stato=per_stato,
+            per_cartella=per_cartella,
+            per_mese=per_mese
+        )
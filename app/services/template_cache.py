@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+import time
+from functools import cached_property
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from ..db_models import DocumentTemplate
+from ..models import DocumentTemplateResponse, ModuleComposition, ModuleConfig
+from .metriche import richieste_cache
+
+# Setup logger
+logger = logging.getLogger(__name__)
+
+# Durata massima di una voce in cache (secondi). Le modifiche fatte da altre istanze sono
+# rilevate a ogni lettura confrontando le versioni dei template; la scadenza libera la
+# memoria degli utenti inattivi. 0 = cache disabilitata
+TEMPLATE_CACHE_TTL = float(os.getenv("TEMPLATE_CACHE_TTL", "300"))
+
+
+@dataclass(frozen=True)
+class TemplateInCache:
+    """
+    Copia di un DocumentTemplate indipendente dalla sessione, con gli stessi attributi
+    usati dal rendering (module_composition resta il dict salvato). La risposta API,
+    con il ModuleComposition validato, viene costruita alla prima richiesta e riusata.
+    """
+    id: Any
+    user_id: Any
+    name: str
+    description: Optional[str]
+    document_type: str
+    module_composition: Dict[str, Any]
+    page_format: str
+    page_orientation: str
+    margins: Optional[Dict[str, Any]]
+    custom_styles: Optional[str]
+    is_default: bool
+    is_public: bool
+    version: int
+    created_at: datetime
+    updated_at: datetime
+
+    @classmethod
+    def da_db(cls, template: DocumentTemplate) -> "TemplateInCache":
+        return cls(**{campo.name: getattr(template, campo.name) for campo in fields(cls)})
+
+    @cached_property
+    def risposta(self) -> DocumentTemplateResponse:
+        return DocumentTemplateResponse(
+            id=str(self.id),
+            user_id=str(self.user_id),
+            name=self.name,
+            description=self.description,
+            document_type=self.document_type,
+            module_composition=self._composizione(),
+            page_format=self.page_format,
+            page_orientation=self.page_orientation,
+            margins=self.margins,
+            custom_styles=self.custom_styles,
+            is_default=self.is_default,
+            is_public=self.is_public,
+            version=self.version,
+            created_at=self.created_at,
+            updated_at=self.updated_at
+        )
+
+    def _composizione(self) -> ModuleComposition:
+        """Converte module_composition da dict a ModuleComposition"""
+        if not isinstance(self.module_composition, dict):
+            return self.module_composition
+        try:
+            return ModuleComposition(modules=[ModuleConfig(**m) for m in self.module_composition.get("modules", [])])
+        except Exception as e:
+            logger.error(f"Errore nella conversione di module_composition per template {self.id}: {e}")
+            # Fallback: crea una composizione vuota
+            return ModuleComposition(modules=[])
+
+
+class TemplateCache:
+    """
+    Cache in memoria dei template di ogni utente (tutti insieme: sono pochi e cambiano di rado).
+    Una voce vale finché le coppie (id, version) dei template dell'utente coincidono con
+    quelle lette dal database: ogni modifica incrementa la version (o aggiunge o toglie
+    un template), quindi anche le modifiche fatte da altre istanze vengono rilevate.
+    Le modifiche di questa istanza invalidano subito la voce; un contatore di generazione
+    per utente impedisce di salvare un elenco letto prima di un'invalidazione avvenuta
+    durante la lettura.
+    """
+
+    def __init__(self, ttl: float = TEMPLATE_CACHE_TTL):
+        self.ttl = ttl
+        self._voci: Dict[str, Tuple[float, int, frozenset, List[TemplateInCache]]] = {}
+        self._generazioni: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def generazione(self, user_id) -> int:
+        with self._lock:
+            return self._generazioni.get(str(user_id), 0)
+
+    @staticmethod
+    def versioni(coppie: Iterable[Tuple[Any, int]]) -> frozenset:
+        """Insieme confrontabile delle coppie (id, version) dei template"""
+        return frozenset((str(template_id), version) for template_id, version in coppie)
+
+    def leggi(self, user_id, versioni: Iterable[Tuple[Any, int]]) -> Optional[List[TemplateInCache]]:
+        """Template in cache dell'utente, se le loro versioni coincidono con quelle indicate (lette dal database)"""
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            voce = self._voci.get(str(user_id))
+            if voce and (
+                voce[0] < time.monotonic()
+                or voce[1] != self._generazioni.get(str(user_id), 0)
+                or voce[2] != self.versioni(versioni)
+            ):
+                del self._voci[str(user_id)]
+                voce = None
+        richieste_cache.incrementa(cache="template", result="hit" if voce else "miss")
+        return voce[3] if voce else None
+
+    def salva(self, user_id, generazione: int, templates: List[TemplateInCache]) -> None:
+        if self.ttl <= 0:
+            return
+        versioni = self.versioni((template.id, template.version) for template in templates)
+        with self._lock:
+            if generazione != self._generazioni.get(str(user_id), 0):
+                return  # Invalidata durante la lettura
+            self._voci[str(user_id)] = (time.monotonic() + self.ttl, generazione, versioni, templates)
+
+    def invalida_utente(self, user_id) -> None:
+        """Da chiamare dopo ogni scrittura sui template dell'utente"""
+        with self._lock:
+            chiave = str(user_id)
+            self._generazioni[chiave] = self._generazioni.get(chiave, 0) + 1
+            self._voci.pop(chiave, None)
+
+
+# Istanza condivisa dall'applicazione
+template_cache = TemplateCache()
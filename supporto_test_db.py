@@ -0,0 +1,59 @@
+"""
+Database PostgreSQL per i test che eseguono le query reali dei servizi
+(upsert, FOR UPDATE SKIP LOCKED, DELETE ... RETURNING, JSONB).
+
+Indicare in TEST_DATABASE_URL un database dedicato ai test: le tabelle vengono
+eliminate e ricreate a ogni chiamata di sessione_test(). Senza TEST_DATABASE_URL
+i test che lo usano vengono saltati.
+"""
+
+import os
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.database import Base
+from app.db_models import Preventivo, User
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+_engine = None
+
+
+def engine_test():
+    global _engine
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL non impostato: test su PostgreSQL saltato")
+    if _engine is None:
+        _engine = create_engine(TEST_DATABASE_URL)
+    return _engine
+
+
+def sessione_test() -> Session:
+    """Sessione su un database con le tabelle appena ricreate"""
+    engine = engine_test()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine, autoflush=False)()
+
+
+def crea_utente(db: Session) -> str:
+    user_id = uuid.uuid4()
+    db.add(User(id=user_id, email=f"{user_id}@test.it", username=str(user_id), hashed_password="x"))
+    db.commit()
+    return str(user_id)
+
+
+def crea_preventivo(db: Session, user_id: str, **colonne) -> Preventivo:
+    adesso = datetime.utcnow()
+    valori = {
+        "numero_preventivo": "PREV-1", "oggetto_preventivo": "Oggetto", "dati_preventivo": {},
+        "stato_record": "attivo", "created_at": adesso, "updated_at": adesso,
+    }
+    preventivo = Preventivo(user_id=uuid.UUID(user_id), **{**valori, **colonne})
+    db.add(preventivo)
+    db.commit()
+    return preventivo
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Test dell'Environment Jinja2 condiviso (app/services/ambiente_jinja.py)
+"""
+
+from app.services.ambiente_jinja import TEMPLATES_DIR, ambiente_jinja, precompila_template
+from app.services.pdf_export_service import PDFExportService
+
+
+def test_ambiente_condiviso_tra_html_e_pdf():
+    """Il servizio PDF usa lo stesso Environment delle pagine HTML, con la cache del bytecode"""
+    env = ambiente_jinja()
+    assert ambiente_jinja(TEMPLATES_DIR) is env
+    assert PDFExportService(TEMPLATES_DIR).env is env
+    assert env.bytecode_cache is not None and env.autoescape is True
+    print("✅ Environment condiviso")
+
+
+def test_precompilazione():
+    """Dopo la precompilazione i template sono già nella cache dell'Environment"""
+    env = ambiente_jinja()
+    assert precompila_template(env) > 0
+    template = env.get_template("preventivo/preventivo_unificato.html")
+    assert env.get_template("preventivo/preventivo_unificato.html") is template
+    print("✅ Template precompilati")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST AMBIENTE JINJA2")
+    print("=" * 50)
+    test_ambiente_condiviso_tra_html_e_pdf()
+    test_precompilazione()
+    print("\n🎉 Tutti i test dell'ambiente Jinja2 sono passati")
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Test del salvataggio automatico (app/services/autosave_service.py).
+Le bozze sono nella tabella preventivi_bozze: i test richiedono PostgreSQL, vedi supporto_test_db.py
+"""
+
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from app.db_models import BozzaPreventivo
+from app.models import PreventivoMasterModel, RigaPreventivo
+from app.services import autosave_service
+from app.services.autosave_service import AutosaveBuffer, AutosaveService
+from app.services.preventivo_service import PreventivoService
+from app.services.righe_preventivo_service import RighePreventivoService
+from supporto_test_db import crea_utente, engine_test, sessione_test
+
+ALTRO_UTENTE = "11111111-2222-3333-4444-555555555555"
+
+
+def _preventivo(oggetto):
+    return PreventivoMasterModel.model_validate({
+        "metadati_preventivo": {"id_preventivo": "0b7c3f4e-8d2a-4c61-9f35-2e1a7d6b8c90", "numero_preventivo": "PREV-1", "data_emissione": "2024-06-01", "oggetto_preventivo": oggetto},
+        "azienda_emittente": {"nome_azienda": "Azienda", "partita_iva_azienda": "12345678901", "indirizzo_azienda": {"via": "Via Roma 1"}, "email_azienda": "info@azienda.it"},
+        "cliente_destinatario": {"nome_cliente": "Cliente", "indirizzo": {"via": "Via Milano 2"}},
+        "corpo_preventivo": {"righe": [{"descrizione": "Servizio", "quantita": 1, "prezzo_unitario_netto": 100}]},
+        "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+    })
+
+
+def _json(oggetto):
+    return _preventivo(oggetto).model_dump(mode="json")
+
+
+def _prepara():
+    """Sessione di test, utente e un suo preventivo salvato"""
+    db = sessione_test()
+    user_id = crea_utente(db)
+    preventivo_id = str(PreventivoService(db).salva_preventivo(_preventivo("Salvato"), user_id).id)
+    return db, user_id, preventivo_id
+
+
+def _svuota(buffer, tutte=False):
+    """svuota() con le sessioni sul database di test"""
+    with patch.object(autosave_service, "SessionLocal", sessionmaker(bind=engine_test(), autoflush=False)):
+        return buffer.svuota(tutte)
+
+
+def _oggetto_salvato(db, preventivo_id, user_id):
+    db.expire_all()
+    return PreventivoService(db).carica_preventivo(preventivo_id, user_id).metadati_preventivo.oggetto_preventivo
+
+
+def test_modifiche_ravvicinate_unite_in_una_bozza():
+    """La prima bozza fissa la scadenza, le successive sostituiscono solo il contenuto"""
+    db, user_id, preventivo_id = _prepara()
+    buffer = AutosaveBuffer()
+    primo = buffer.registra(db, preventivo_id, user_id, _json("Prima"), intervallo=30)
+    secondo = buffer.registra(db, preventivo_id, user_id, _json("Seconda"), intervallo=30)
+
+    assert 0 < secondo <= primo <= 30
+    assert db.query(BozzaPreventivo).count() == 1
+    assert buffer.bozza(db, preventivo_id, user_id).metadati_preventivo.oggetto_preventivo == "Seconda"
+    assert buffer.bozza(db, preventivo_id, ALTRO_UTENTE) is None
+    # Non ancora scaduta: il preventivo non cambia
+    assert _svuota(buffer) == 0
+    assert _oggetto_salvato(db, preventivo_id, user_id) == "Salvato"
+    db.close()
+    print("✅ Bozze unite con scadenza invariata")
+
+
+def test_contenuto_invariato_non_viene_scritto():
+    """Una bozza identica all'ultimo salvataggio non viene accodata e annulla quella in attesa"""
+    db, user_id, preventivo_id = _prepara()
+    buffer = AutosaveBuffer()
+    buffer.registra(db, preventivo_id, user_id, _json("Scritto"), intervallo=0)
+    assert _svuota(buffer) == 1
+    assert _oggetto_salvato(db, preventivo_id, user_id) == "Scritto"
+
+    assert buffer.registra(db, preventivo_id, user_id, _json("Scritto"), intervallo=30) is None
+    assert not buffer.in_attesa(db, preventivo_id, user_id)
+
+    buffer.registra(db, preventivo_id, user_id, _json("Modificato"), intervallo=30)
+    assert buffer.in_attesa(db, preventivo_id, user_id)
+    buffer.registra(db, preventivo_id, user_id, _json("Scritto"), intervallo=30)
+    assert not buffer.in_attesa(db, preventivo_id, user_id)
+    assert _svuota(buffer, tutte=True) == 0
+    db.close()
+    print("✅ Contenuto invariato ignorato")
+
+
+def test_bozze_condivise_tra_istanze():
+    """Una bozza registrata da un'istanza è servita e scritta da un'altra, anche se la prima si è fermata senza scriverla"""
+    db, user_id, preventivo_id = _prepara()
+    AutosaveBuffer().registra(db, preventivo_id, user_id, _json("Da un altro worker"), intervallo=30)
+
+    altra_istanza = AutosaveBuffer()
+    assert altra_istanza.bozza(db, preventivo_id, user_id).metadati_preventivo.oggetto_preventivo == "Da un altro worker"
+    assert _svuota(altra_istanza, tutte=True) == 1
+    assert _oggetto_salvato(db, preventivo_id, user_id) == "Da un altro worker"
+    assert altra_istanza.bozza(db, preventivo_id, user_id) is None
+    db.close()
+    print("✅ Bozze condivise tra istanze")
+
+
+def test_salvataggio_esplicito_scarta_la_bozza():
+    db, user_id, preventivo_id = _prepara()
+    buffer = AutosaveBuffer()
+    buffer.registra(db, preventivo_id, user_id, _json("Bozza"), intervallo=0)
+    with buffer.salvataggio_esplicito(db, preventivo_id, user_id, _json("Esplicito")):
+        PreventivoService(db).aggiorna_preventivo(preventivo_id, _preventivo("Esplicito"), user_id)
+
+    assert buffer.bozza(db, preventivo_id, user_id) is None
+    assert _svuota(buffer) == 0  # Nessuna scrittura residua
+    assert _oggetto_salvato(db, preventivo_id, user_id) == "Esplicito"
+    # Il contenuto salvato esplicitamente è quello noto: la stessa bozza non viene accodata
+    assert buffer.registra(db, preventivo_id, user_id, _json("Esplicito"), intervallo=30) is None
+    db.close()
+    print("✅ Bozza scartata dal salvataggio esplicito")
+
+
+def test_salvataggio_non_riuscito_o_di_altri_non_scarta_la_bozza():
+    """La bozza resta se il salvataggio esplicito fallisce o se lo fa un altro utente"""
+    db, user_id, preventivo_id = _prepara()
+    buffer = AutosaveBuffer()
+    buffer.registra(db, preventivo_id, user_id, _json("Bozza"), intervallo=30)
+    with pytest.raises(LookupError):
+        with buffer.salvataggio_esplicito(db, preventivo_id, user_id, _json("Esplicito")):
+            raise LookupError("Preventivo non trovato")
+    with buffer.salvataggio_esplicito(db, preventivo_id, ALTRO_UTENTE, _json("Estraneo")):
+        db.commit()
+
+    assert buffer.bozza(db, preventivo_id, user_id).metadati_preventivo.oggetto_preventivo == "Bozza"
+    db.close()
+    print("✅ Bozza conservata")
+
+
+def test_bozza_di_un_altro_utente_rifiutata():
+    """Un altro utente non può sostituire la bozza in attesa, né saltare la verifica del preventivo"""
+    db, user_id, preventivo_id = _prepara()
+    altro_utente = crea_utente(db)
+    buffer = AutosaveBuffer()
+    buffer.registra(db, preventivo_id, user_id, _json("Del proprietario"), intervallo=30)
+
+    with pytest.raises(PermissionError):
+        buffer.registra(db, preventivo_id, altro_utente, _json("Estranea"), intervallo=30)
+    assert AutosaveService(db, buffer).registra(preventivo_id, altro_utente, _preventivo("Estranea")) is None
+    assert not buffer.in_attesa(db, preventivo_id, altro_utente)
+    assert buffer.bozza(db, preventivo_id, user_id).metadati_preventivo.oggetto_preventivo == "Del proprietario"
+    db.close()
+    print("✅ Bozza di un altro utente rifiutata")
+
+
+def test_modifica_righe_applicata_sopra_la_bozza():
+    """Le modifiche delle righe scrivono prima la bozza in attesa, che poi non le sovrascrive"""
+    db, user_id, preventivo_id = _prepara()
+    buffer = AutosaveBuffer()
+    AutosaveService(db, buffer).registra(preventivo_id, user_id, _preventivo("Bozza"))
+
+    riga = RigaPreventivo(descrizione="Nuova", quantita=2, prezzo_unitario_netto=50)
+    RighePreventivoService(db, buffer).aggiungi_riga(preventivo_id, user_id, riga)
+
+    assert not buffer.in_attesa(db, preventivo_id, user_id)
+    dati = PreventivoService(db).carica_preventivo(preventivo_id, user_id)
+    assert dati.metadati_preventivo.oggetto_preventivo == "Bozza"
+    assert [riga.descrizione for riga in dati.corpo_preventivo.righe] == ["Servizio", "Nuova"]
+    # Il contenuto è cambiato dopo la bozza: tornare alla bozza è una modifica da scrivere
+    assert AutosaveService(db, buffer).registra(preventivo_id, user_id, _preventivo("Bozza"))["stato"] == "in_attesa"
+    db.close()
+    print("✅ Modifica delle righe sopra la bozza")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST SALVATAGGIO AUTOMATICO")
+    print("=" * 50)
+    test_modifiche_ravvicinate_unite_in_una_bozza()
+    test_contenuto_invariato_non_viene_scritto()
+    test_bozze_condivise_tra_istanze()
+    test_salvataggio_esplicito_scarta_la_bozza()
+    test_salvataggio_non_riuscito_o_di_altri_non_scarta_la_bozza()
+    test_bozza_di_un_altro_utente_rifiutata()
+    test_modifica_righe_applicata_sopra_la_bozza()
+    print("\n🎉 Tutti i test del salvataggio automatico sono passati")
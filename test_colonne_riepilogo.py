@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Test delle colonne di riepilogo dei preventivi (nome_cliente, valore_totale_lordo,
+data_emissione, data_scadenza) e delle liste che le leggono senza il documento JSONB.
+
+Verifica:
+1. Valori ricavati dal JSON del preventivo (PreventivoService.colonne_riepilogo)
+2. Colonne aggiornate a ogni salvataggio e aggiornamento (richiede PostgreSQL: vedi supporto_test_db.py)
+3. Le liste non selezionano dati_preventivo e leggono i valori dalle colonne (PostgreSQL)
+"""
+
+import uuid
+from datetime import date
+from decimal import Decimal
+
+from sqlalchemy import inspect
+
+from app.db_models import Preventivo
+from app.models import PreventivoMasterModel
+from app.services.preventivo_calculator import calcola_totali_preventivo
+from app.services.preventivo_service import PreventivoService, _query_lista
+from supporto_test_db import crea_preventivo, crea_utente, sessione_test
+
+
+def _preventivo(cliente: str, prezzo: float) -> PreventivoMasterModel:
+    preventivo = PreventivoMasterModel.model_validate({
+        "metadati_preventivo": {"id_preventivo": "00000000-0000-0000-0000-000000000000", "numero_preventivo": "PREV-1", "data_emissione": "2024-06-01", "data_scadenza": "2024-07-01", "oggetto_preventivo": "Oggetto"},
+        "azienda_emittente": {"nome_azienda": "Azienda", "partita_iva_azienda": "12345678901", "indirizzo_azienda": {"via": "Via Roma 1"}, "email_azienda": "info@azienda.it"},
+        "cliente_destinatario": {"nome_cliente": cliente, "indirizzo": {"via": "Via Milano 2"}},
+        "corpo_preventivo": {"righe": [{"descrizione": "Servizio", "quantita": 2, "prezzo_unitario_netto": prezzo, "percentuale_iva": 22}]},
+        "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+    })
+    calcola_totali_preventivo(preventivo)
+    return preventivo
+
+
+def test_valori_dal_documento():
+    """Cliente, totale e date vengono dal JSON; le parti mancanti danno None"""
+    colonne = PreventivoService.colonne_riepilogo(_preventivo("Rossi S.r.l.", 50).model_dump(mode="json"))
+    assert colonne == {
+        "nome_cliente": "Rossi S.r.l.",
+        "valore_totale_lordo": 122.0,
+        "data_emissione": date(2024, 6, 1),
+        "data_scadenza": date(2024, 7, 1),
+    }
+
+    assert PreventivoService.colonne_riepilogo({}) == {
+        "nome_cliente": None, "valore_totale_lordo": None, "data_emissione": None, "data_scadenza": None,
+    }
+    lungo = PreventivoService.colonne_riepilogo({
+        "cliente_destinatario": {"nome_cliente": "x" * 600},
+        "metadati_preventivo": {"data_emissione": "2024-06-01T10:30:00"},
+    })
+    assert len(lungo["nome_cliente"]) == 500 and lungo["data_emissione"] == date(2024, 6, 1)
+    print("✅ Colonne di riepilogo dal documento")
+
+
+def test_colonne_aggiornate_al_salvataggio():
+    """Salvataggio e aggiornamento riscrivono le colonne insieme al documento"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    service = PreventivoService(db)
+    preventivo_id = service.salva_preventivo(_preventivo("Rossi S.r.l.", 50), utente).id
+
+    db_preventivo = db.get(Preventivo, preventivo_id)
+    assert db_preventivo.nome_cliente == "Rossi S.r.l." and db_preventivo.valore_totale_lordo == Decimal("122.00")
+    assert db_preventivo.data_emissione == date(2024, 6, 1) and db_preventivo.data_scadenza == date(2024, 7, 1)
+
+    service.aggiorna_preventivo(str(preventivo_id), _preventivo("Bianchi S.p.A.", 100), utente)
+    db.expire_all()
+    db_preventivo = db.get(Preventivo, preventivo_id)
+    assert db_preventivo.nome_cliente == "Bianchi S.p.A." and db_preventivo.valore_totale_lordo == Decimal("244.00")
+    db.close()
+    print("✅ Colonne aggiornate al salvataggio")
+
+
+def test_liste_senza_documento():
+    """Le liste leggono le colonne: dati_preventivo non compare nella SELECT e non viene caricato"""
+    assert "dati_preventivo" not in str(_query_lista(str(uuid.uuid4()), "attivo"))
+
+    db = sessione_test()
+    utente = crea_utente(db)
+    # Documento vuoto: i valori della lista possono venire solo dalle colonne
+    crea_preventivo(db, utente, nome_cliente="Dalla colonna", valore_totale_lordo=Decimal("99.90"), data_emissione=date(2024, 5, 2))
+    db.expunge_all()
+
+    service = PreventivoService(db)
+    attivi, _ = service.lista_preventivi_attivi(utente)
+    assert "dati_preventivo" in inspect(attivi[0]).unloaded
+    assert attivi[0].nome_cliente == "Dalla colonna"
+
+    elementi, _ = service.lista_preventivi_con_cartelle(utente)
+    assert elementi[0].nome_cliente == "Dalla colonna"
+    assert elementi[0].valore_totale_lordo == 99.9 and elementi[0].data_emissione == date(2024, 5, 2)
+    db.close()
+    print("✅ Liste senza il documento JSONB")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST COLONNE DI RIEPILOGO")
+    print("=" * 50)
+    test_valori_dal_documento()
+    test_colonne_aggiornate_al_salvataggio()
+    test_liste_senza_documento()
+    print("\n🎉 Tutti i test delle colonne di riepilogo sono passati")
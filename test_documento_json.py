@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Test della lettura del documento JSON salvato (PreventivoService.carica_preventivo_json e
+GET /preventivo/{id}). Su PostgreSQL le correzioni (template_id, nome_documento, numerazione
+delle righe) sono applicate nella query _SQL_DOCUMENTO_JSON: il risultato deve coincidere con
+quello delle stesse correzioni applicate in Python. Richiedono PostgreSQL: vedi supporto_test_db.py
+"""
+
+import json
+import uuid
+
+from fastapi.testclient import TestClient
+
+from app.database import get_db_lettura
+from app.db_models import Preventivo
+from app.main import app
+from app.models import PreventivoMasterModel
+from app.services.document_template_service import DocumentTemplateService
+from app.services.preventivo_calculator import calcola_totali_preventivo
+from app.services.preventivo_service import PreventivoService
+from supporto_test_db import crea_preventivo, crea_utente, sessione_test
+
+
+def _documento(righe) -> dict:
+    preventivo = PreventivoMasterModel.model_validate({
+        "metadati_preventivo": {"id_preventivo": "0b7c3f4e-8d2a-4c61-9f35-2e1a7d6b8c90", "numero_preventivo": "PREV-JSON", "data_emissione": "2024-06-01", "oggetto_preventivo": "Oggetto", "nome_documento": "Nel JSON"},
+        "azienda_emittente": {"nome_azienda": "Azienda", "partita_iva_azienda": "12345678901", "indirizzo_azienda": {"via": "Via Roma 1"}, "email_azienda": "info@azienda.it"},
+        "cliente_destinatario": {"nome_cliente": "Cliente", "indirizzo": {"via": "Via Milano 2"}},
+        "corpo_preventivo": {"righe": righe},
+        "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+    })
+    calcola_totali_preventivo(preventivo)
+    return preventivo.model_dump(mode="json")
+
+
+def _con_correzioni_in_python(db, preventivo_id) -> dict:
+    """Riferimento: le correzioni di _dati_con_colonne su una copia appena letta"""
+    db.expire_all()
+    return PreventivoService._dati_con_colonne(db.get(Preventivo, preventivo_id))
+
+
+def test_documento_come_in_python():
+    """Per documenti validi e irregolari la query restituisce lo stesso JSON delle correzioni in Python"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    template = DocumentTemplateService(db).create_default_template_for_user(utente)
+    valido = _documento([
+        {"descrizione": "A", "quantita": 1, "prezzo_unitario_netto": 10},
+        {"descrizione": "B", "quantita": 2, "prezzo_unitario_netto": 20},
+    ])
+    numerazione_vecchia = json.loads(json.dumps(valido))
+    for riga, numero in zip(numerazione_vecchia["corpo_preventivo"]["righe"], (7, 3)):
+        riga["numero_riga"] = numero
+
+    casi = {
+        "valido, con template e nome documento": dict(dati_preventivo=valido, template_id=template.id, nome_documento="Dalla colonna"),
+        "senza template, nome documento vuoto": dict(dati_preventivo=valido, nome_documento=""),
+        "numerazione non allineata": dict(dati_preventivo=numerazione_vecchia),
+        "metadati non oggetto e righe non oggetto": dict(dati_preventivo={"metadati_preventivo": "x", "corpo_preventivo": {"righe": [1, {"descrizione": "A"}]}}),
+        "senza righe": dict(dati_preventivo={"corpo_preventivo": {}}),
+    }
+    service = PreventivoService(db)
+    for nome, colonne in casi.items():
+        preventivo_id = crea_preventivo(db, utente, **colonne).id
+        veloce = service.carica_preventivo_json(str(preventivo_id), utente)
+        assert json.loads(veloce) == _con_correzioni_in_python(db, preventivo_id), nome
+
+    preventivo_id = crea_preventivo(db, utente, **casi["valido, con template e nome documento"]).id
+    dati = json.loads(service.carica_preventivo_json(str(preventivo_id), utente))
+    assert dati["metadati_preventivo"]["template_id"] == str(template.id)
+    assert dati["metadati_preventivo"]["nome_documento"] == "Dalla colonna"
+    assert [riga["numero_riga"] for riga in dati["corpo_preventivo"]["righe"]] == [1, 2]
+    db.close()
+    print("✅ Documento JSON uguale alle correzioni in Python")
+
+
+def test_filtri_e_endpoint():
+    """Preventivi cestinati solo con solo_attivi=False, mai quelli di altri utenti; l'endpoint restituisce il JSON salvato"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    service = PreventivoService(db)
+    cestinato = str(crea_preventivo(db, utente, dati_preventivo={}, stato_record="cestinato").id)
+    assert service.carica_preventivo_json(cestinato, utente) is None
+    assert json.loads(service.carica_preventivo_json(cestinato, utente, solo_attivi=False))["metadati_preventivo"] == {"template_id": None}
+    assert service.carica_preventivo_json(cestinato, crea_utente(db), solo_attivi=False) is None
+    assert service.carica_preventivo_json(str(uuid.uuid4()), utente) is None
+
+    attivo = str(crea_preventivo(db, utente, dati_preventivo=_documento([{"descrizione": "A", "quantita": 1, "prezzo_unitario_netto": 10}])).id)
+    app.dependency_overrides[get_db_lettura] = lambda: db
+    try:
+        client = TestClient(app)
+        grezzo = client.get(f"/preventivo/{attivo}", params={"user_id": utente})
+        validato = client.get(f"/preventivo/{attivo}", params={"user_id": utente, "valida": True})
+        assert client.get(f"/preventivo/{cestinato}", params={"user_id": utente}).status_code == 404
+    finally:
+        app.dependency_overrides.pop(get_db_lettura)
+
+    assert grezzo.status_code == 200 and grezzo.headers["content-type"] == "application/json"
+    assert grezzo.json() == _con_correzioni_in_python(db, attivo)
+    # Per un documento validato al salvataggio le due strade danno lo stesso documento
+    assert PreventivoMasterModel.model_validate(grezzo.json()).model_dump(mode="json") == validato.json()
+    db.close()
+    print("✅ Filtri e endpoint del documento JSON")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST DOCUMENTO JSON")
+    print("=" * 50)
+    test_documento_come_in_python()
+    test_filtri_e_endpoint()
+    print("\n🎉 Tutti i test del documento JSON sono passati")
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Test della lettura dei preventivi dal body delle richieste (app/services/ingestione_preventivi.py)
+
+Verifica:
+1. Body valido: documento validato, totali calcolati, user_id separato dal documento
+2. Body non valido: errore di validazione e risposta 400 degli endpoint
+3. Validazione e calcolo dei totali fuori dal thread del loop asyncio
+"""
+
+import asyncio
+import json
+import threading
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+from app.main import app
+from app.services import ingestione_preventivi
+from app.services.ingestione_preventivi import leggi_anteprima, leggi_documento
+
+UTENTE = "da2cb935-e023-40dd-9703-d918f1066b24"
+
+DOCUMENTO = {
+    "metadati_preventivo": {"id_preventivo": "0b7c3f4e-8d2a-4c61-9f35-2e1a7d6b8c90", "numero_preventivo": "PREV-1", "data_emissione": "2024-06-01", "oggetto_preventivo": "Oggetto"},
+    "azienda_emittente": {"nome_azienda": "Azienda", "partita_iva_azienda": "12345678901", "indirizzo_azienda": {"via": "Via Roma 1"}, "email_azienda": "info@azienda.it"},
+    "cliente_destinatario": {"nome_cliente": "Cliente", "indirizzo": {"via": "Via Milano 2"}},
+    "corpo_preventivo": {"righe": [{"descrizione": "Consulenza", "quantita": 2, "prezzo_unitario_netto": 100.0, "percentuale_iva": 22}]},
+    "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+}
+
+
+class _Richiesta:
+    """Il minimo di Request usato dalla lettura del body"""
+
+    def __init__(self, dati):
+        self._corpo = dati if isinstance(dati, bytes) else json.dumps(dati).encode()
+
+    async def body(self) -> bytes:
+        return self._corpo
+
+
+def test_body_valido():
+    """Documento validato con i totali calcolati; user_id è restituito a parte e non entra nel documento"""
+    documento = asyncio.run(leggi_documento(_Richiesta({**DOCUMENTO, "user_id": UTENTE})))
+
+    assert documento.user_id == UTENTE
+    assert documento.preventivo.dettagli_totali.totale_imponibile_netto == 200
+    assert documento.preventivo.dettagli_totali.totale_generale_lordo == 244
+    assert "user_id" not in documento.json
+    assert "user_id" not in documento.preventivo.model_dump()
+    assert documento.json["corpo_preventivo"]["righe"][0]["numero_riga"] == 1
+    print("✅ Body valido letto con i totali")
+
+
+def test_body_non_valido():
+    """JSON malformato o documento incompleto: ValidationError dal servizio, 400 dagli endpoint"""
+    incompleto = {**DOCUMENTO, "metadati_preventivo": {"numero_preventivo": "PREV-1"}}
+    for corpo in (b"{non json", incompleto):
+        with pytest.raises(ValidationError):
+            asyncio.run(leggi_documento(_Richiesta(corpo)))
+    with pytest.raises(ValidationError):
+        asyncio.run(leggi_anteprima(_Richiesta({"preventivo_data": incompleto, "template_config": {}})))
+
+    client = TestClient(app)
+    assert client.post("/preventivo/salva", content=b"{non json").status_code == 400
+    assert client.post("/preventivo/salva", json=incompleto).status_code == 400
+    assert client.post(f"/preventivo/{DOCUMENTO['metadati_preventivo']['id_preventivo']}/autosave", json=incompleto).status_code == 400
+    print("✅ Body non valido rifiutato con 400")
+
+
+def test_validazione_fuori_dal_loop():
+    """Il calcolo dei totali (e la validazione che lo precede) gira nel threadpool, non nel thread del loop"""
+    thread_calcolo = []
+    calcola = ingestione_preventivi.calcola_totali_preventivo
+
+    def calcola_e_registra(preventivo):
+        thread_calcolo.append(threading.current_thread())
+        calcola(preventivo)
+
+    async def leggi():
+        thread_loop = threading.current_thread()
+        await leggi_documento(_Richiesta(DOCUMENTO))
+        await leggi_anteprima(_Richiesta({"preventivo_data": DOCUMENTO, "template_config": {}}))
+        return thread_loop
+
+    with patch.object(ingestione_preventivi, "calcola_totali_preventivo", calcola_e_registra):
+        thread_loop = asyncio.run(leggi())
+
+    assert len(thread_calcolo) == 2
+    assert all(thread is not thread_loop for thread in thread_calcolo)
+    print("✅ Validazione eseguita nel threadpool")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST LETTURA DEI PREVENTIVI DAL BODY")
+    print("=" * 50)
+    test_body_valido()
+    test_body_non_valido()
+    test_validazione_fuori_dal_loop()
+    print("\n🎉 Tutti i test della lettura dei preventivi sono passati")
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Test delle metriche in formato Prometheus (app/services/metriche.py e /metrics)
+"""
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.services.metriche import RegistroMetriche
+
+
+def test_esportazione_formato_prometheus():
+    """Contatori, indicatori e istogrammi con etichette, soglie cumulative e raccolte"""
+    registro = RegistroMetriche()
+    contatore = registro.contatore("richieste_total", "Richieste", ("route",))
+    indicatore = registro.indicatore("in_corso", "In corso")
+    istogramma = registro.istogramma("durata_seconds", "Durata", ("route",), soglie=(0.1, 1.0))
+    registro.aggiungi_raccolta(lambda: [("esterna", "gauge", "Da una raccolta", [("esterna", {"pool": "sincrono"}, 3)])])
+
+    contatore.incrementa(route='/a"b')
+    contatore.incrementa(2, route='/a"b')
+    indicatore.incrementa()
+    indicatore.decrementa()
+    istogramma.osserva(0.05, route="/a")
+    istogramma.osserva(0.5, route="/a")
+    istogramma.osserva(5, route="/a")
+
+    testo = registro.esporta()
+    assert "# TYPE richieste_total counter" in testo
+    assert 'richieste_total{route="/a\\"b"} 3' in testo
+    assert "in_corso 0" in testo
+    assert 'durata_seconds_bucket{route="/a",le="0.1"} 1' in testo
+    assert 'durata_seconds_bucket{route="/a",le="1"} 2' in testo
+    assert 'durata_seconds_bucket{route="/a",le="+Inf"} 3' in testo
+    assert 'durata_seconds_sum{route="/a"} 5.55' in testo
+    assert 'durata_seconds_count{route="/a"} 3' in testo
+    assert 'esterna{pool="sincrono"} 3' in testo
+    print("✅ Formato di esposizione Prometheus")
+
+
+def test_endpoint_metrics_per_route_template():
+    """Il middleware usa il template del percorso come etichetta, non l'URL"""
+    client = TestClient(app)
+    client.get("/percorso-inesistente-1")
+    client.get("/percorso-inesistente-2")
+    client.get("/metrics")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'http_requests_total{method="GET",route="/metrics",status="200"}' in response.text
+    assert 'route="non_trovata",status="404"' in response.text
+    assert "percorso-inesistente" not in response.text
+    assert "# TYPE http_request_duration_seconds histogram" in response.text
+    assert "# TYPE preventivi_pdf_rendered_total counter" in response.text
+    assert 'db_pool_checkout_timeouts_total{pool="sincrono"}' in response.text
+    print("✅ Endpoint /metrics")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST METRICHE")
+    print("=" * 50)
+    test_esportazione_formato_prometheus()
+    test_endpoint_metrics_per_route_template()
+    print("\n🎉 Tutti i test delle metriche sono passati")
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Test delle metriche del pool di connessioni (app/database.py)
+"""
+
+import os
+import tempfile
+
+from sqlalchemy import create_engine, exc
+from sqlalchemy.pool import QueuePool
+
+from app.database import MetrichePool, _pool_misurato
+
+
+def _engine(metriche):
+    percorso = os.path.join(tempfile.mkdtemp(), "pool.db")
+    engine = create_engine(
+        f"sqlite:///{percorso}",
+        poolclass=_pool_misurato(QueuePool, metriche),
+        pool_size=1, max_overflow=1, pool_timeout=0.1
+    )
+    metriche.collega(engine)
+    return engine
+
+
+def test_attese_overflow_e_timeout():
+    """Con il pool pieno la richiesta successiva attende fino al timeout e viene contata"""
+    metriche = MetrichePool("test")
+    engine = _engine(metriche)
+
+    prima = engine.connect()
+    seconda = engine.connect()  # Oltre pool_size: overflow
+    contatori = metriche.contatori()
+    assert contatori["in_uso"] == 2 and contatori["overflow"] == 1
+
+    try:
+        engine.connect()
+        assert False, "Atteso il timeout del pool"
+    except exc.TimeoutError:
+        pass
+
+    seconda.close()
+    prima.close()
+    contatori = metriche.contatori()
+    assert contatori["attese"] == 3 and contatori["timeout"] == 1
+    assert contatori["attesa_massima_secondi"] >= 0.1
+    assert contatori["in_uso"] == 0 and contatori["connessioni_aperte"] == 2
+    assert sum(contatori["attese_per_soglia"].values()) >= 2
+    engine.dispose()
+    print("✅ Attese, overflow e timeout del pool")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST METRICHE POOL")
+    print("=" * 50)
+    test_attese_overflow_e_timeout()
+    print("\n🎉 Tutti i test delle metriche del pool sono passati")
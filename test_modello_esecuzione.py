@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Test del modello di esecuzione delle route: la sessione SQLAlchemy e il rendering sono sincroni,
+quindi le route async non devono bloccare il loop e le altre girano nel threadpool.
+"""
+
+import inspect
+
+from fastapi.routing import APIRoute
+
+from app.main import app
+
+
+def test_route_async_solo_se_attendono():
+    """Una route `async def` senza await eseguirebbe il lavoro bloccante sul loop: deve essere `def`"""
+    bloccanti = [
+        route.path for route in app.routes
+        if isinstance(route, APIRoute)
+        and inspect.iscoroutinefunction(route.endpoint)
+        and "await " not in inspect.getsource(route.endpoint)
+    ]
+    assert bloccanti == [], f"Route async senza await: {bloccanti}"
+    print("✅ Nessuna route async bloccante")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST MODELLO DI ESECUZIONE")
+    print("=" * 50)
+    test_route_async_solo_se_attendono()
+    print("\n🎉 Tutti i test del modello di esecuzione sono passati")
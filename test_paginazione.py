@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Test della paginazione keyset delle liste preventivi (app/services/preventivo_service.py)
+
+Verifica:
+1. Codifica e decodifica del cursore per ogni tipo di valore
+2. Cursori non validi o di un altro ordinamento rifiutati
+3. Scorrendo le pagine con il cursore ogni preventivo compare una sola volta,
+   nello stesso ordine della lista completa (richiede PostgreSQL: vedi supporto_test_db.py)
+"""
+
+import uuid
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+from app.services.preventivo_service import ORDINAMENTI_PREVENTIVI, PreventivoService, codifica_cursore, decodifica_cursore
+from supporto_test_db import crea_preventivo, crea_utente, sessione_test
+
+
+def test_cursore_andata_e_ritorno():
+    """Il cursore restituisce il valore e l'id con cui è stato prodotto"""
+    preventivo_id = uuid.uuid4()
+    for valore in (datetime(2024, 6, 1, 10, 30, 15, 123456), date(2024, 6, 1), Decimal("1234.50"), "Cliente S.r.l."):
+        cursore = codifica_cursore("valore_desc", valore, preventivo_id)
+        assert decodifica_cursore(cursore, "valore_desc") == (valore, preventivo_id)
+    print("✅ Cursore codificato e decodificato")
+
+
+def test_cursore_non_valido():
+    """Un cursore alterato o prodotto con un altro ordinamento viene rifiutato"""
+    cursore = codifica_cursore("numero_asc", "PREV-1", uuid.uuid4())
+    with pytest.raises(ValueError):
+        decodifica_cursore(cursore, "numero_desc")
+    for alterato in ("non-un-cursore", cursore[:-3], codifica_cursore("numero_asc", "PREV-1", "x")):
+        with pytest.raises(ValueError):
+            decodifica_cursore(alterato, "numero_asc")
+    print("✅ Cursori non validi rifiutati")
+
+
+def test_scorrimento_pagine():
+    """Per ogni ordinamento le pagine lette con il cursore coprono la lista senza duplicati né salti"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    base = datetime.utcnow()
+    for indice in range(11):
+        # Valori ripetuti: l'ordine tra gli uguali dipende solo dall'id
+        crea_preventivo(
+            db, utente,
+            numero_preventivo=f"PREV-{indice % 4}",
+            nome_cliente=None if indice % 3 == 0 else f"Cliente {indice % 2}",
+            valore_totale_lordo=None if indice % 5 == 0 else Decimal(indice % 3) * 100,
+            created_at=base - timedelta(days=indice % 4),
+            updated_at=base - timedelta(hours=indice % 2),
+        )
+
+    service = PreventivoService(db)
+    for ordinamento in ORDINAMENTI_PREVENTIVI:
+        completa, cursore = service.lista_preventivi_con_cartelle(utente, ordinamento=ordinamento, limit=100)
+        assert cursore is None and len(completa) == 11
+
+        letti, cursore = [], None
+        while True:
+            pagina, cursore = service.lista_preventivi_con_cartelle(utente, ordinamento=ordinamento, limit=3, cursore=cursore)
+            letti += pagina
+            if cursore is None:
+                break
+        assert [p.id for p in letti] == [p.id for p in completa], ordinamento
+    db.close()
+    print("✅ Scorrimento delle pagine con il cursore")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST PAGINAZIONE KEYSET")
+    print("=" * 50)
+    test_cursore_andata_e_ritorno()
+    test_cursore_non_valido()
+    test_scorrimento_pagine()
+    print("\n🎉 Tutti i test della paginazione sono passati")
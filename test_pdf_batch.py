@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Test dell'export ZIP di più preventivi (app/services/pdf_batch_service.py)
+
+Verifica:
+1. Archivio ZIP valido con un PDF per documento, anche se inviato a pezzi
+2. Documenti non generati elencati in ERRORI.txt
+3. Limite dei rendering contemporanei
+4. Nomi file univoci e sicuri
+"""
+
+import asyncio
+import io
+import uuid
+import zipfile
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from app.models import PreventivoMasterModel
+from app.services.pdf_batch_service import PDFBatchExportService
+from app.services.pdf_export_service import PDFExportService
+
+
+def _documento(numero: str):
+    preventivo = PreventivoMasterModel(**{
+        "metadati_preventivo": {"id_preventivo": str(uuid.uuid4()), "numero_preventivo": numero, "data_emissione": "2024-06-01", "oggetto_preventivo": "Test ZIP"},
+        "azienda_emittente": {
+            "nome_azienda": "Test Azienda S.r.l.", "partita_iva_azienda": "12345678901",
+            "indirizzo_azienda": {"via": "Via Test 123"}, "email_azienda": "info@testazienda.it",
+        },
+        "cliente_destinatario": {"nome_cliente": "Cliente Test", "indirizzo": {"via": "Via Cliente 456"}},
+        "corpo_preventivo": {"righe": []},
+        "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+    })
+    return (str(preventivo.metadati_preventivo.id_preventivo), f"preventivo_{numero}.pdf", preventivo, SimpleNamespace(id="tpl-1", version=1))
+
+
+def _genera_zip(documenti, concorrenza):
+    """Genera l'archivio con un rendering finto; restituisce i pezzi inviati e il massimo di rendering contemporanei"""
+    stato = {"in_corso": 0, "massimo": 0}
+
+    async def render_finto(self, preventivo_data, template, preventivo_id=None):
+        stato["in_corso"] += 1
+        stato["massimo"] = max(stato["massimo"], stato["in_corso"])
+        await asyncio.sleep(0.01)
+        stato["in_corso"] -= 1
+        numero = preventivo_data.metadati_preventivo.numero_preventivo
+        if numero == "ROTTO":
+            raise RuntimeError("rendering fallito")
+        return f"%PDF {numero}".encode()
+
+    async def raccogli():
+        service = PDFBatchExportService(Path("templates"), db=None)
+        return [pezzo async for pezzo in service.genera_zip(documenti, concorrenza=concorrenza)]
+
+    with patch.object(PDFExportService, "genera_pdf_preventivo_con_template_async", render_finto):
+        pezzi = asyncio.run(raccogli())
+    return pezzi, stato["massimo"]
+
+
+def test_archivio_zip():
+    """Un PDF per documento, a pezzi, con i falliti elencati in ERRORI.txt"""
+    documenti = [_documento(f"P{indice}") for indice in range(5)] + [_documento("ROTTO")]
+    pezzi, massimo_contemporanei = _genera_zip(documenti, concorrenza=2)
+
+    assert len(pezzi) > 1
+    assert massimo_contemporanei == 2
+    with zipfile.ZipFile(io.BytesIO(b"".join(pezzi))) as archivio:
+        assert archivio.testzip() is None
+        nomi = set(archivio.namelist())
+        assert nomi == {f"preventivo_P{indice}.pdf" for indice in range(5)} | {"ERRORI.txt"}
+        assert archivio.read("preventivo_P3.pdf") == b"%PDF P3"
+        assert "preventivo_ROTTO.pdf: rendering fallito" in archivio.read("ERRORI.txt").decode()
+    print("✅ Archivio ZIP generato a pezzi")
+
+
+def test_nomi_file_univoci():
+    """I nomi ripetuti ricevono un suffisso e i caratteri non sicuri vengono sostituiti"""
+    nomi_usati = set()
+    assert PDFBatchExportService._nome_file_univoco("preventivo_A/1", nomi_usati) == "preventivo_A_1.pdf"
+    assert PDFBatchExportService._nome_file_univoco("preventivo_A/1", nomi_usati) == "preventivo_A_1_2.pdf"
+    assert PDFBatchExportService._nome_file_univoco("../", nomi_usati) == "preventivo.pdf"
+    print("✅ Nomi file univoci")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST EXPORT ZIP")
+    print("=" * 50)
+    test_archivio_zip()
+    test_nomi_file_univoci()
+    print("\n🎉 Tutti i test dell'export ZIP sono passati")
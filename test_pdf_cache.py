@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Test della cache PDF su disco (app/services/pdf_cache.py)
+
+Verifica:
+1. Chiave dipendente da dati, id e versione del template e impronta del rendering
+2. Lettura/scrittura delle voci
+3. Evizione LRU oltre la dimensione massima
+4. Invalidazione per preventivo e per template, anche dopo un riavvio
+"""
+
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+from app.models import PreventivoMasterModel
+from app.services.pdf_cache import PDFCache, impronta_rendering
+
+DATI_PREVENTIVO = {
+    "metadati_preventivo": {
+        "id_preventivo": "12345678-1234-1234-1234-123456789abc",
+        "numero_preventivo": "PREV-CACHE-001",
+        "data_emissione": "2024-06-01",
+        "oggetto_preventivo": "Test cache PDF",
+    },
+    "azienda_emittente": {
+        "nome_azienda": "Test Azienda S.r.l.",
+        "partita_iva_azienda": "12345678901",
+        "indirizzo_azienda": {"via": "Via Test 123"},
+        "email_azienda": "info@testazienda.it",
+    },
+    "cliente_destinatario": {
+        "nome_cliente": "Cliente Test S.r.l.",
+        "indirizzo": {"via": "Via Cliente 456"},
+    },
+    "corpo_preventivo": {
+        "righe": [{"descrizione": "Consulenza", "quantita": 2, "prezzo_unitario_netto": 100.0}]
+    },
+    "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+}
+
+
+def _template(template_id="tpl-1", version=1):
+    return SimpleNamespace(id=template_id, version=version, name="Template test")
+
+
+def test_chiave_dipende_da_documento_e_versione_template():
+    """La chiave cambia se cambia il documento o la versione del template"""
+    preventivo = PreventivoMasterModel(**DATI_PREVENTIVO)
+    chiave = PDFCache.calcola_chiave(preventivo, _template())
+
+    assert chiave == PDFCache.calcola_chiave(PreventivoMasterModel(**DATI_PREVENTIVO), _template())
+    assert chiave != PDFCache.calcola_chiave(preventivo, _template(version=2))
+    assert chiave != PDFCache.calcola_chiave(preventivo, _template(template_id="tpl-2"))
+
+    preventivo.corpo_preventivo.righe[0].quantita = 3
+    assert chiave != PDFCache.calcola_chiave(preventivo, _template())
+    print("✅ Chiave di cache calcolata correttamente")
+
+
+def test_chiave_dipende_dai_file_dei_template():
+    """Dopo una modifica ai template (un deploy) le voci generate prima non vengono più trovate"""
+    preventivo = PreventivoMasterModel(**DATI_PREVENTIVO)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        (Path(tmp_dir) / "preventivo_unificato.html").write_text("<p>{{ oggetto }}</p>")
+        prima = impronta_rendering(Path(tmp_dir))
+        (Path(tmp_dir) / "preventivo_unificato.html").write_text("<h1>{{ oggetto }}</h1>")
+        impronta_rendering.cache_clear()
+        dopo = impronta_rendering(Path(tmp_dir))
+
+    assert prima != dopo
+    assert PDFCache.calcola_chiave(preventivo, _template(), prima) != PDFCache.calcola_chiave(preventivo, _template(), dopo)
+    print("✅ Chiave legata ai file dei template")
+
+
+def test_evizione_lru():
+    """Oltre la dimensione massima viene rimossa la voce usata meno di recente"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = PDFCache(Path(tmp_dir), max_bytes=25)
+        cache.put("a", b"x" * 10)
+        cache.put("b", b"y" * 10)
+        assert cache.get("a") == b"x" * 10  # "a" diventa la più recente
+
+        cache.put("c", b"z" * 10)
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.get("c") is not None
+        assert cache.stato()["size_bytes"] == 20
+        assert not (Path(tmp_dir) / "b.pdf").exists()
+    print("✅ Evizione LRU funzionante")
+
+
+def test_invalidazione_per_tag():
+    """Le voci vengono rimosse quando il preventivo o il template cambiano"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = PDFCache(Path(tmp_dir), max_bytes=1024)
+        template = _template()
+        cache.put("k1", b"pdf-1", PDFCache.tags_per(template, "prev-1"))
+        cache.put("k2", b"pdf-2", PDFCache.tags_per(template, "prev-2"))
+
+        assert cache.invalida_preventivo("prev-1") == 1
+        assert cache.get("k1") is None
+        assert cache.get("k2") == b"pdf-2"
+
+        assert cache.invalida_template(template.id) == 1
+        assert cache.get("k2") is None
+        assert cache.stato()["entries"] == 0
+    print("✅ Invalidazione per preventivo e template funzionante")
+
+
+def test_indice_ricaricato_da_disco():
+    """Una nuova istanza ritrova le voci già presenti nella directory"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        PDFCache(Path(tmp_dir), max_bytes=1024).put("persistente", b"pdf")
+        cache = PDFCache(Path(tmp_dir), max_bytes=1024)
+        assert cache.get("persistente") == b"pdf"
+    print("✅ Indice ricostruito dai file su disco")
+
+
+def test_invalidazione_dopo_il_riavvio():
+    """I tag sono salvati con le voci: l'invalidazione trova anche quelle scritte prima del riavvio"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        template = _template()
+        PDFCache(Path(tmp_dir), max_bytes=1024).put("k1", b"pdf-1", PDFCache.tags_per(template, "prev-1"))
+
+        cache = PDFCache(Path(tmp_dir), max_bytes=1024)
+        assert cache.invalida_preventivo("prev-1") == 1
+        assert cache.get("k1") is None
+        assert list(Path(tmp_dir).iterdir()) == []
+    print("✅ Invalidazione delle voci precedenti al riavvio")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST CACHE PDF")
+    print("=" * 50)
+    test_chiave_dipende_da_documento_e_versione_template()
+    test_chiave_dipende_dai_file_dei_template()
+    test_evizione_lru()
+    test_invalidazione_per_tag()
+    test_indice_ricaricato_da_disco()
+    test_invalidazione_dopo_il_riavvio()
+    print("\n🎉 Tutti i test della cache PDF sono passati")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Test della coda dei job PDF (app/services/pdf_job_service.py).
+I test sulla tabella pdf_jobs richiedono PostgreSQL: vedi supporto_test_db.py
+"""
+
+import asyncio
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from app.db_models import PdfJob
+from app.services.pdf_job_service import PdfJobService, PdfJobWorker
+from supporto_test_db import crea_preventivo, crea_utente, sessione_test
+
+
+def test_prelievo_e_completamento():
+    """Un job accodato viene assegnato a un solo worker e, completato, conserva il PDF"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    preventivo = crea_preventivo(db, utente)
+    job = PdfJobService(db).accoda_job(str(preventivo.id), utente)
+    assert job.stato == "queued"
+
+    prelevato = PdfJobService(db).preleva_prossimo_job()
+    assert prelevato.id == job.id
+    assert prelevato.stato == "running" and prelevato.tentativi == 1
+    assert PdfJobService(db).preleva_prossimo_job() is None
+
+    PdfJobService(db).completa_job(prelevato, b"%PDF-1.7", "preventivo_PREV-1.pdf")
+    concluso = PdfJobService(db).ottieni_job(str(job.id), utente, con_pdf=True)
+    assert concluso.stato == "done" and concluso.pdf == b"%PDF-1.7"
+    assert PdfJobService(db).preleva_prossimo_job() is None
+    db.close()
+    print("✅ Prelievo e completamento del job")
+
+
+def test_accodamento_preventivo_inesistente():
+    """Un preventivo cestinato non può essere accodato"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    preventivo = crea_preventivo(db, utente, stato_record="cestinato")
+    assert PdfJobService(db).accoda_job(str(preventivo.id), utente) is None
+    db.close()
+    print("✅ Accodamento rifiutato per un preventivo non attivo")
+
+
+def test_eliminazione_job_conclusi():
+    """Vengono eliminati solo i job conclusi oltre il TTL; quelli in coda restano"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    preventivo = crea_preventivo(db, utente)
+    vecchio = datetime.utcnow() - timedelta(hours=48)
+    for stato, finished_at in (("done", vecchio), ("failed", vecchio), ("done", vecchio),
+                               ("done", datetime.utcnow()), ("queued", None)):
+        db.add(PdfJob(user_id=preventivo.user_id, preventivo_id=preventivo.id, stato=stato,
+                      tentativi=1, pdf=b"%PDF", finished_at=finished_at))
+    db.commit()
+
+    assert PdfJobService(db).elimina_job_conclusi(ore=24, dimensione_blocco=2) == 3
+    rimasti = sorted(job.stato for job in db.query(PdfJob).all())
+    assert rimasti == ["done", "queued"]
+    db.close()
+    print("✅ Eliminazione dei job conclusi")
+
+
+def test_sveglia_durante_il_prelievo():
+    """Un job accodato mentre il worker sta già controllando la coda (vuota) viene eseguito subito"""
+    async def scenario():
+        worker = PdfJobWorker(Path("templates"), concorrenza=1, intervallo_polling=5, intervallo_polling_massimo=5)
+        coda, eseguiti, in_prelievo = [], [], asyncio.Event()
+
+        async def preleva():
+            job = coda.pop() if coda else None
+            in_prelievo.set()
+            await asyncio.sleep(0.2)  # Query in corso: la coda è già stata letta
+            return ("db", job) if job else None
+
+        async def esegui(db, job):
+            eseguiti.append(time.perf_counter())
+
+        worker._preleva, worker._esegui = preleva, esegui
+        worker.avvia()
+        try:
+            await in_prelievo.wait()
+            coda.append("job")
+            accodato = time.perf_counter()
+            worker.sveglia()
+            await asyncio.sleep(1)
+        finally:
+            await worker.arresta()
+        return [momento - accodato for momento in eseguiti]
+
+    ritardi = asyncio.run(scenario())
+    assert len(ritardi) == 1 and ritardi[0] < 1
+    print("✅ Sveglia non persa durante il prelievo")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST CODA JOB PDF")
+    print("=" * 50)
+    test_prelievo_e_completamento()
+    test_accodamento_preventivo_inesistente()
+    test_eliminazione_job_conclusi()
+    test_sveglia_durante_il_prelievo()
+    print("\n🎉 Tutti i test della coda PDF sono passati")
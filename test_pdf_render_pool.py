@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Test del pool di processi per il rendering PDF (app/services/pdf_render_pool.py),
+con una funzione di rendering finta al posto di WeasyPrint
+"""
+
+import asyncio
+import os
+import time
+
+from app.services.pdf_render_pool import PDFRenderPool
+
+
+def _render_finto(html_content: str) -> bytes:
+    """Eseguito nei worker: "bloccato" non termina, "crash" fa terminare il processo"""
+    if html_content == "bloccato":
+        time.sleep(60)
+    elif html_content == "crash":
+        time.sleep(0.3)
+        os._exit(1)
+    else:
+        time.sleep(1)
+    return html_content.encode()
+
+
+async def _in_parallelo(pool, problematico, **kwargs):
+    try:
+        return await asyncio.gather(
+            pool.render(problematico, **kwargs),
+            pool.render("sano", timeout=30),
+            return_exceptions=True
+        )
+    finally:
+        pool.arresta(wait=False)
+
+
+def test_timeout_non_fa_fallire_gli_altri_rendering():
+    """Il job bloccato va in timeout; quello sano in corso viene ripetuto sul pool nuovo"""
+    pool = PDFRenderPool(max_workers=2, timeout=30, funzione_render=_render_finto)
+    pool.avvia()
+    bloccato, sano = asyncio.run(_in_parallelo(pool, "bloccato", timeout=0.5))
+
+    assert isinstance(bloccato, TimeoutError)
+    assert sano == b"sano"
+    print("✅ Timeout isolato")
+
+
+def test_worker_terminato_non_fa_fallire_gli_altri_rendering():
+    """Il documento che fa terminare il worker fallisce anche al secondo tentativo, l'altro no"""
+    pool = PDFRenderPool(max_workers=2, timeout=30, funzione_render=_render_finto)
+    pool.avvia()
+    crash, sano = asyncio.run(_in_parallelo(pool, "crash"))
+
+    assert isinstance(crash, RuntimeError)
+    assert sano == b"sano"
+    print("✅ Worker terminato isolato")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST POOL RENDERING PDF")
+    print("=" * 50)
+    test_timeout_non_fa_fallire_gli_altri_rendering()
+    test_worker_terminato_non_fa_fallire_gli_altri_rendering()
+    print("\n🎉 Tutti i test del pool di rendering sono passati")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Test della cache dei preventivi deserializzati (app/services/preventivo_cache.py)
+"""
+
+from datetime import datetime, timedelta
+
+from app.models import PreventivoMasterModel
+from app.services.pdf_export_service import PDFExportService
+from app.services.preventivo_cache import PreventiviCache
+
+VERSIONE = datetime(2025, 6, 1, 12, 0, 0)
+
+
+def _preventivo(numero, righe=()):
+    return PreventivoMasterModel.model_validate({
+        "metadati_preventivo": {"id_preventivo": "0b7c3f4e-8d2a-4c61-9f35-2e1a7d6b8c90", "numero_preventivo": numero, "data_emissione": "2024-06-01", "oggetto_preventivo": "Oggetto"},
+        "azienda_emittente": {"nome_azienda": "Azienda", "partita_iva_azienda": "12345678901", "indirizzo_azienda": {"via": "Via Roma 1"}, "email_azienda": "info@azienda.it"},
+        "cliente_destinatario": {"nome_cliente": "Cliente", "indirizzo": {"via": "Via Milano 2"}},
+        "corpo_preventivo": {"righe": list(righe)},
+        "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+    })
+
+
+def test_voce_valida_solo_per_la_stessa_versione():
+    """Una voce salvata per un updated_at non viene usata per una versione diversa"""
+    cache = PreventiviCache(max_bytes=1000)
+    cache.salva("p1", VERSIONE, _preventivo("PREV-1"), 100)
+
+    assert cache.leggi("p1", VERSIONE).metadati_preventivo.numero_preventivo == "PREV-1"
+    assert cache.leggi("p1", VERSIONE + timedelta(seconds=1)) is None
+    assert cache.contatori()["hit"] == 1 and cache.contatori()["miss"] == 1
+    print("✅ Voci legate alla versione")
+
+
+def test_export_pdf_non_modifica_il_modello_condiviso():
+    """L'export PDF ricalcola i totali su una copia, non sul modello restituito dalla cache"""
+    preventivo = _preventivo("PREV-1", [{"descrizione": "Consulenza", "quantita": 2, "prezzo_unitario_netto": 100.0}])
+    cache = PreventiviCache(max_bytes=1000)
+    cache.salva("p1", VERSIONE, preventivo, 100)
+
+    condiviso = cache.leggi("p1", VERSIONE)
+    con_totali = PDFExportService._con_totali_calcolati(condiviso)
+
+    assert con_totali is not condiviso
+    assert con_totali.dettagli_totali.totale_imponibile_netto == 200
+    assert condiviso.dettagli_totali.totale_imponibile_netto == 0
+    assert condiviso.corpo_preventivo.righe[0].subtotale_riga_netto is None
+    print("✅ Export PDF senza modifiche al modello condiviso")
+
+
+def test_rimozione_lru_oltre_la_dimensione_massima():
+    cache = PreventiviCache(max_bytes=250)
+    cache.salva("p1", VERSIONE, _preventivo("PREV-1"), 100)
+    cache.salva("p2", VERSIONE, _preventivo("PREV-2"), 100)
+    cache.leggi("p1", VERSIONE)  # p1 diventa il più recente
+    cache.salva("p3", VERSIONE, _preventivo("PREV-3"), 100)
+
+    assert cache.leggi("p2", VERSIONE) is None
+    assert cache.leggi("p1", VERSIONE) is not None
+    assert cache.leggi("p3", VERSIONE) is not None
+    assert cache.contatori()["dimensione_byte"] == 200
+    print("✅ Rimozione LRU")
+
+
+def test_invalidazione_e_nuova_versione():
+    """Una nuova versione sostituisce la precedente; l'invalidazione libera la memoria"""
+    cache = PreventiviCache(max_bytes=1000)
+    cache.salva("p1", VERSIONE, _preventivo("PREV-1"), 100)
+    cache.salva("p1", VERSIONE + timedelta(minutes=1), _preventivo("PREV-1"), 150)
+    assert cache.contatori()["voci"] == 1 and cache.contatori()["dimensione_byte"] == 150
+
+    cache.invalida("p1")
+    assert cache.contatori()["voci"] == 0 and cache.contatori()["dimensione_byte"] == 0
+    print("✅ Invalidazione e sostituzione della versione")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST CACHE PREVENTIVI")
+    print("=" * 50)
+    test_voce_valida_solo_per_la_stessa_versione()
+    test_export_pdf_non_modifica_il_modello_condiviso()
+    test_rimozione_lru_oltre_la_dimensione_massima()
+    test_invalidazione_e_nuova_versione()
+    print("\n🎉 Tutti i test della cache preventivi sono passati")
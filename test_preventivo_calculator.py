@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Test del calcolatore vettoriale dei totali (app/services/preventivo_calculator.py)
+
+Verifica che il calcolo in centesimi con NumPy dia esattamente gli stessi risultati
+dell'algoritmo originale riga per riga basato su round_decimal (ROUND_HALF_UP),
+e che il calcolo incrementale resti allineato al ricalcolo completo.
+"""
+
+import random
+
+from app.models import PreventivoMasterModel
+from app.services.preventivo_calculator import (
+    CalcolatoreTotaliIncrementale,
+    arrotonda_centesimi,
+    calcola_totali_preventivi,
+    calcola_totali_preventivo,
+    round_decimal,
+)
+
+
+def _calcola_totali_riferimento(righe):
+    """Algoritmo originale riga per riga, usato come riferimento"""
+    risultati_righe = []
+    totale_sconti = 0.0
+    riepilogo = {}
+    for riga in righe:
+        base = round_decimal(riga["quantita"] * riga["prezzo_unitario_netto"])
+        sconto = 0.0
+        if riga["sconto_riga_percentuale"] is not None and riga["sconto_riga_percentuale"] > 0:
+            sconto = round_decimal(base * (riga["sconto_riga_percentuale"] / 100.0))
+        netto = round_decimal(base - sconto)
+        iva = round_decimal(netto * (riga["percentuale_iva"] / 100.0))
+        lordo = round_decimal(netto + iva)
+        totale_sconti += sconto
+        voce = riepilogo.setdefault(riga["percentuale_iva"], {"imponibile": 0.0, "iva": 0.0})
+        voce["imponibile"] += netto
+        voce["iva"] += iva
+        risultati_righe.append((netto, iva, lordo))
+
+    imponibile = sum(r[0] for r in risultati_righe)
+    iva_totale = sum(r[1] for r in risultati_righe)
+    return {
+        "righe": risultati_righe,
+        "totale_imponibile_netto": round_decimal(imponibile),
+        "totale_sconti": round_decimal(totale_sconti),
+        "totale_iva": round_decimal(iva_totale),
+        "totale_generale_lordo": round_decimal(imponibile + iva_totale),
+        "riepilogo_iva": [
+            (aliquota, round_decimal(v["imponibile"]), round_decimal(v["iva"]))
+            for aliquota, v in riepilogo.items()
+        ],
+    }
+
+
+def _preventivo(righe, numero="PREV-CALC-001"):
+    return PreventivoMasterModel(**{
+        "metadati_preventivo": {
+            "id_preventivo": "12345678-1234-1234-1234-123456789abc",
+            "numero_preventivo": numero,
+            "data_emissione": "2024-06-01",
+            "oggetto_preventivo": "Test calcolo totali",
+        },
+        "azienda_emittente": {
+            "nome_azienda": "Test Azienda S.r.l.",
+            "partita_iva_azienda": "12345678901",
+            "indirizzo_azienda": {"via": "Via Test 123"},
+            "email_azienda": "info@testazienda.it",
+        },
+        "cliente_destinatario": {"nome_cliente": "Cliente Test", "indirizzo": {"via": "Via Cliente 456"}},
+        "corpo_preventivo": {"righe": [dict(r, descrizione="Voce") for r in righe]},
+        "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+    })
+
+
+def _righe_casuali(generatore, numero_righe):
+    return [
+        {
+            "quantita": generatore.choice([1, 2, 3, 0.5, 1.5, 7, 12.25, 100, generatore.randint(1, 999) / 4]),
+            "prezzo_unitario_netto": generatore.choice([
+                1.005, 2.675, 0.125, 10.05, 19.99, 0.01, 1234.565,
+                round(generatore.uniform(0, 5000), 3), round(generatore.uniform(-50, 50), 2),
+            ]),
+            "sconto_riga_percentuale": generatore.choice([None, 0, 5, 10, 12.5, 33.333, -3]),
+            "percentuale_iva": generatore.choice([0, 4, 10, 22, 22.0, 5.5]),
+        }
+        for _ in range(numero_righe)
+    ]
+
+
+def _verifica(preventivo, atteso):
+    for indice, (riga, (netto, iva, lordo)) in enumerate(zip(preventivo.corpo_preventivo.righe, atteso["righe"]), start=1):
+        assert riga.numero_riga == indice
+        assert (riga.subtotale_riga_netto, riga.importo_iva_riga, riga.subtotale_riga_lordo) == (netto, iva, lordo)
+
+    totali = preventivo.dettagli_totali
+    assert totali.totale_imponibile_netto == atteso["totale_imponibile_netto"]
+    assert totali.totale_sconti == atteso["totale_sconti"]
+    assert totali.totale_iva == atteso["totale_iva"]
+    assert totali.totale_generale_lordo == atteso["totale_generale_lordo"]
+    assert [(r.aliquota_percentuale, r.imponibile_aliquota, r.iva_aliquota) for r in totali.riepilogo_iva] == atteso["riepilogo_iva"]
+
+
+def test_arrotondamento_come_round_decimal():
+    """Il ROUND_HALF_UP vettoriale coincide con round_decimal, anche sui casi limite binari"""
+    generatore = random.Random(42)
+    valori = [1.005, 2.675, 0.125, -0.125, -1.005, 0.0, -0.0, 0.005, 0.015, 1e9 + 0.005, 0.1 + 0.2]
+    valori += [generatore.uniform(-1e6, 1e6) for _ in range(20000)]
+    valori += [round(generatore.uniform(-1e4, 1e4), 3) for _ in range(20000)]
+    valori += [k / 1000 for k in range(-20000, 20000)]
+
+    centesimi = arrotonda_centesimi(valori).tolist()
+    for valore, cent in zip(valori, centesimi):
+        assert cent / 100 == round_decimal(valore), valore
+    print("✅ Arrotondamento vettoriale identico a round_decimal")
+
+
+def test_totali_identici_al_calcolo_riga_per_riga():
+    """Totali, righe e riepilogo IVA coincidono con l'algoritmo originale"""
+    generatore = random.Random(7)
+    for _ in range(200):
+        righe = _righe_casuali(generatore, generatore.randint(1, 40))
+        preventivo = _preventivo(righe)
+        calcola_totali_preventivo(preventivo)
+        _verifica(preventivo, _calcola_totali_riferimento(righe))
+    print("✅ Totali identici al calcolo riga per riga")
+
+
+def test_batch_di_piu_preventivi():
+    """Un solo calcolo per più documenti, inclusi documenti senza righe"""
+    generatore = random.Random(3)
+    elenco_righe = [_righe_casuali(generatore, n) for n in (5, 0, 1, 60, 12)]
+    preventivi = [_preventivo(righe, f"PREV-{i}") for i, righe in enumerate(elenco_righe)]
+
+    calcola_totali_preventivi(preventivi)
+
+    for preventivo, righe in zip(preventivi, elenco_righe):
+        _verifica(preventivo, _calcola_totali_riferimento(righe))
+    assert preventivi[1].dettagli_totali.totale_generale_lordo == 0.0
+    assert preventivi[1].dettagli_totali.riepilogo_iva == []
+    print("✅ Calcolo batch su più preventivi corretto")
+
+
+def test_calcolatore_incrementale_allineato_al_ricalcolo():
+    """Inserimenti, modifiche, rimozioni e spostamenti producono gli stessi totali del calcolo completo"""
+    generatore = random.Random(11)
+    righe = _righe_casuali(generatore, 30)
+    calcolatore = CalcolatoreTotaliIncrementale(righe)
+
+    for _ in range(500):
+        operazione = generatore.choice(["aggiungi", "aggiorna", "rimuovi", "sposta"]) if righe else "aggiungi"
+        if operazione == "aggiungi":
+            posizione = generatore.randint(0, len(righe))
+            nuova = _righe_casuali(generatore, 1)[0]
+            righe.insert(posizione, nuova)
+            assert calcolatore.aggiungi_riga(nuova, posizione) == posizione
+        elif operazione == "aggiorna":
+            indice = generatore.randrange(len(righe))
+            righe[indice] = _righe_casuali(generatore, 1)[0]
+            calcolatore.aggiorna_riga(indice, righe[indice])
+        elif operazione == "rimuovi":
+            indice = generatore.randrange(len(righe))
+            del righe[indice]
+            calcolatore.rimuovi_riga(indice)
+        else:
+            da, a = generatore.randrange(len(righe)), generatore.randrange(len(righe))
+            righe.insert(a, righe.pop(da))
+            calcolatore.sposta_riga(da, a)
+
+        preventivo = _preventivo(righe)
+        calcola_totali_preventivo(preventivo)
+        assert calcolatore.totali() == preventivo.dettagli_totali
+        if righe:
+            indice = generatore.randrange(len(righe))
+            riga = preventivo.corpo_preventivo.righe[indice]
+            assert calcolatore.importi_riga(indice) == {
+                "numero_riga": riga.numero_riga,
+                "subtotale_riga_netto": riga.subtotale_riga_netto,
+                "importo_iva_riga": riga.importo_iva_riga,
+                "subtotale_riga_lordo": riga.subtotale_riga_lordo,
+            }
+
+    assert calcolatore.verifica(righe)
+    print("✅ Calcolo incrementale allineato al ricalcolo completo")
+
+
+def test_verifica_riallinea_stato():
+    """Se le righe sono cambiate senza passare dal calcolatore, verifica() ricostruisce lo stato"""
+    righe = _righe_casuali(random.Random(5), 10)
+    calcolatore = CalcolatoreTotaliIncrementale(righe)
+    righe[3] = dict(righe[3], quantita=righe[3]["quantita"] + 1, prezzo_unitario_netto=10.0)
+
+    assert not calcolatore.verifica(righe)
+    preventivo = _preventivo(righe)
+    calcola_totali_preventivo(preventivo)
+    assert calcolatore.totali() == preventivo.dettagli_totali
+    print("✅ verifica() riallinea lo stato incrementale")
+
+
+def test_calcolatore_da_totali_salvati():
+    """Partendo dai soli totali salvati e dalle aliquote si ottengono gli stessi risultati"""
+    generatore = random.Random(13)
+    righe = _righe_casuali(generatore, 25)
+    preventivo = _preventivo(righe)
+    calcola_totali_preventivo(preventivo)
+    dettagli = preventivo.dettagli_totali.model_dump(mode="json")
+    calcolatore = CalcolatoreTotaliIncrementale.da_totali(dettagli, [r["percentuale_iva"] for r in righe])
+
+    nuova = _righe_casuali(generatore, 1)[0]
+    calcolatore.aggiorna_riga(4, nuova, righe[4])
+    righe[4] = nuova
+    calcolatore.rimuovi_riga(0, righe.pop(0))
+    calcolatore.riordina_righe(list(reversed(range(len(righe)))))
+    righe.reverse()
+
+    atteso = _preventivo(righe)
+    calcola_totali_preventivo(atteso)
+    assert calcolatore.totali() == atteso.dettagli_totali
+
+    dettagli["riepilogo_iva"] = dettagli["riepilogo_iva"][1:]
+    try:
+        CalcolatoreTotaliIncrementale.da_totali(dettagli, [r["percentuale_iva"] for r in righe])
+        assert False, "Riepilogo incoerente non rilevato"
+    except ValueError:
+        pass
+    print("✅ Calcolo incrementale dai totali salvati corretto")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST CALCOLATORE TOTALI")
+    print("=" * 50)
+    test_arrotondamento_come_round_decimal()
+    test_totali_identici_al_calcolo_riga_per_riga()
+    test_batch_di_piu_preventivi()
+    test_calcolatore_incrementale_allineato_al_ricalcolo()
+    test_verifica_riallinea_stato()
+    test_calcolatore_da_totali_salvati()
+    print("\n🎉 Tutti i test del calcolatore sono passati")
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Test dell'instradamento delle letture sulla replica (app/database.py), con due file SQLite
+al posto del primario e della replica
+"""
+
+import os
+import tempfile
+import time
+import uuid
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, insert, select
+
+from app.database import SessioneLetture, registro_scritture
+
+metadata = MetaData()
+voci = Table("voci", metadata, Column("id", Integer, primary_key=True), Column("origine", String))
+
+
+def _database(origine):
+    percorso = os.path.join(tempfile.mkdtemp(), f"{origine}.db")
+    engine = create_engine(f"sqlite:///{percorso}")
+    metadata.create_all(engine)
+    with engine.begin() as connessione:
+        connessione.execute(insert(voci).values(id=1, origine=origine))
+    return engine
+
+
+def _origine(db):
+    return db.execute(select(voci.c.origine).where(voci.c.id == 1)).scalar()
+
+
+def test_letture_sulla_replica_e_scritture_sul_primario():
+    """Le letture vanno alla replica; dopo una scrittura la sessione resta sul primario"""
+    primario, replica = _database("primario"), _database("replica")
+    user_id = str(uuid.uuid4())
+
+    db = SessioneLetture(bind=primario, replica=replica, user_id=user_id)
+    assert _origine(db) == "replica"
+    db.execute(insert(voci).values(id=2, origine="nuova"))
+    assert _origine(db) == "primario"
+    db.commit()
+    db.close()
+
+    with primario.connect() as connessione:
+        assert connessione.execute(select(voci.c.origine).where(voci.c.id == 2)).scalar() == "nuova"
+    print("✅ Letture sulla replica, scritture sul primario")
+
+
+def test_letture_sul_primario_dopo_una_scrittura_recente():
+    """Per REPLICA_FINESTRA_SCRITTURA secondi le letture dell'utente che ha scritto restano sul primario"""
+    primario, replica = _database("primario"), _database("replica")
+    user_id, altro_utente = str(uuid.uuid4()), str(uuid.uuid4())
+    finestra = registro_scritture.finestra
+    registro_scritture.finestra = 0.2
+    try:
+        registro_scritture.segna(user_id)
+        assert _origine(SessioneLetture(bind=primario, replica=replica, user_id=user_id)) == "primario"
+        assert _origine(SessioneLetture(bind=primario, replica=replica, user_id=altro_utente)) == "replica"
+        time.sleep(0.25)
+        assert _origine(SessioneLetture(bind=primario, replica=replica, user_id=user_id)) == "replica"
+    finally:
+        registro_scritture.finestra = finestra
+
+    # Senza replica configurata tutto resta sul primario
+    assert _origine(SessioneLetture(bind=primario, replica=None, user_id=user_id)) == "primario"
+    print("✅ Read-your-writes per utente")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST REPLICA IN LETTURA")
+    print("=" * 50)
+    test_letture_sulla_replica_e_scritture_sul_primario()
+    test_letture_sul_primario_dopo_una_scrittura_recente()
+    print("\n🎉 Tutti i test della replica sono passati")
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Test della pulizia del cestino e del periodo di conservazione (app/services/retention_service.py).
+Richiedono PostgreSQL: vedi supporto_test_db.py
+"""
+
+import uuid
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from app.db_models import Preventivo, UserPreferences
+from app.services.preventivo_service import PreventivoService
+from app.services.retention_service import RetentionService
+from supporto_test_db import crea_preventivo, crea_utente, sessione_test
+
+VECCHIO = datetime.utcnow() - timedelta(days=200)
+
+
+def _conta(db, user_id, stato_record):
+    return db.query(Preventivo).filter_by(user_id=uuid.UUID(user_id), stato_record=stato_record).count()
+
+
+def test_eliminazione_a_blocchi():
+    """Tutti i preventivi che soddisfano le condizioni vengono eliminati, su più blocchi"""
+    db = sessione_test()
+    utente, altro_utente = crea_utente(db), crea_utente(db)
+    for indice in range(7):
+        crea_preventivo(db, utente, numero_preventivo=f"C{indice}", stato_record="cestinato", cestinato_il=VECCHIO)
+    crea_preventivo(db, utente, numero_preventivo="A1")
+    crea_preventivo(db, altro_utente, stato_record="cestinato", cestinato_il=VECCHIO)
+
+    eliminati = PreventivoService(db).elimina_in_blocchi(
+        Preventivo.user_id == uuid.UUID(utente),
+        Preventivo.stato_record == "cestinato",
+        dimensione_blocco=3
+    )
+
+    assert eliminati == 7
+    assert _conta(db, utente, "cestinato") == 0 and _conta(db, utente, "attivo") == 1
+    assert _conta(db, altro_utente, "cestinato") == 1
+    db.close()
+    print("✅ Eliminazione a blocchi")
+
+
+def test_periodo_di_conservazione():
+    """Solo i preventivi attivi degli utenti con preferenze, oltre il loro periodo, vanno nel cestino"""
+    db = sessione_test()
+    con_preferenze, senza_preferenze = crea_utente(db), crea_utente(db)
+    db.add(UserPreferences(user_id=uuid.UUID(con_preferenze), data_retention_days=100))
+    db.commit()
+    for user_id in (con_preferenze, senza_preferenze):
+        for indice in range(5):
+            crea_preventivo(db, user_id, numero_preventivo=f"V{indice}", updated_at=VECCHIO)
+        crea_preventivo(db, user_id, numero_preventivo="RECENTE", updated_at=datetime.utcnow() - timedelta(days=99))
+
+    with patch.object(PreventivoService, "_dopo_scrittura", autospec=True) as dopo_scrittura:
+        assert RetentionService(db, dimensione_blocco=2).applica_periodo_conservazione() == 5
+    assert _conta(db, con_preferenze, "cestinato") == 5 and _conta(db, con_preferenze, "attivo") == 1
+    assert _conta(db, senza_preferenze, "attivo") == 6
+
+    # Le cache (statistiche, modelli, PDF) dei preventivi spostati vengono invalidate, blocco per blocco
+    cestinati = {p.id for p in db.query(Preventivo).filter_by(user_id=uuid.UUID(con_preferenze), stato_record="cestinato")}
+    invalidati = [id_ for chiamata in dopo_scrittura.call_args_list for id_ in chiamata.args[2:]]
+    assert {str(chiamata.args[1]) for chiamata in dopo_scrittura.call_args_list} == {con_preferenze}
+    assert sorted(invalidati) == sorted(cestinati)
+    db.close()
+    print("✅ Periodo di conservazione")
+
+
+def test_pulizia_senza_conservazione_di_default():
+    """Di default la pulizia svuota solo il cestino scaduto e non tocca i preventivi attivi"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    db.add(UserPreferences(user_id=uuid.UUID(utente), data_retention_days=100))
+    db.commit()
+    crea_preventivo(db, utente, numero_preventivo="VECCHIO", updated_at=VECCHIO)
+    crea_preventivo(db, utente, numero_preventivo="SCADUTO", stato_record="cestinato", cestinato_il=VECCHIO)
+    crea_preventivo(db, utente, numero_preventivo="RECENTE", stato_record="cestinato", cestinato_il=datetime.utcnow())
+
+    esito = RetentionService(db).esegui_pulizia(giorni_scadenza_cestino=30)
+
+    assert esito.spostati_nel_cestino == 0 and esito.eliminati == 1
+    assert _conta(db, utente, "attivo") == 1 and _conta(db, utente, "cestinato") == 1
+    db.close()
+    print("✅ Pulizia del solo cestino")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST PULIZIA E CONSERVAZIONE")
+    print("=" * 50)
+    test_eliminazione_a_blocchi()
+    test_periodo_di_conservazione()
+    test_pulizia_senza_conservazione_di_default()
+    print("\n🎉 Tutti i test della pulizia sono passati")
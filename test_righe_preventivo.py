@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Test delle modifiche di singole righe di un preventivo salvato
+(app/services/righe_preventivo_service.py e endpoint /preventivo/{id}/righe).
+Richiedono PostgreSQL: vedi supporto_test_db.py
+
+Dopo ogni operazione le righe salvate devono avere numero_riga uguale alla posizione
+e i totali salvati devono coincidere con quelli ricalcolati da zero.
+"""
+
+from fastapi.testclient import TestClient
+
+from app.database import get_db
+from app.db_models import Preventivo
+from app.main import app
+from app.models import PreventivoMasterModel
+from app.services.preventivo_calculator import calcola_totali_preventivo
+from supporto_test_db import crea_preventivo, crea_utente, sessione_test
+
+
+def _riga(descrizione, quantita, prezzo, iva=22):
+    return {"descrizione": descrizione, "quantita": quantita, "prezzo_unitario_netto": prezzo, "percentuale_iva": iva}
+
+
+def _documento_salvato(righe) -> dict:
+    preventivo = PreventivoMasterModel(**{
+        "metadati_preventivo": {"id_preventivo": "0b7c3f4e-8d2a-4c61-9f35-2e1a7d6b8c90", "numero_preventivo": "PREV-RIGHE", "data_emissione": "2024-06-01", "oggetto_preventivo": "Righe"},
+        "azienda_emittente": {"nome_azienda": "Azienda", "partita_iva_azienda": "12345678901", "indirizzo_azienda": {"via": "Via Roma 1"}, "email_azienda": "info@azienda.it"},
+        "cliente_destinatario": {"nome_cliente": "Cliente", "indirizzo": {"via": "Via Milano 2"}},
+        "corpo_preventivo": {"righe": righe},
+        "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+    })
+    calcola_totali_preventivo(preventivo)
+    return preventivo.model_dump(mode="json")
+
+
+def _controlla_documento(db, preventivo_id, descrizioni):
+    """Righe salvate nell'ordine atteso, numerate da 1, con i totali di un ricalcolo completo"""
+    db.expire_all()
+    db_preventivo = db.get(Preventivo, preventivo_id)
+    dati = db_preventivo.dati_preventivo
+    righe = dati["corpo_preventivo"]["righe"]
+    assert [riga["descrizione"] for riga in righe] == descrizioni
+    assert [riga["numero_riga"] for riga in righe] == list(range(1, len(righe) + 1))
+
+    ricalcolato = PreventivoMasterModel(**dati)
+    calcola_totali_preventivo(ricalcolato)
+    attesi = ricalcolato.dettagli_totali.model_dump(mode="json")
+    assert dati["dettagli_totali"] == attesi
+    assert float(db_preventivo.valore_totale_lordo) == attesi["totale_generale_lordo"]
+    return attesi
+
+
+def test_operazioni_sulle_righe():
+    """Aggiunta (in coda e in mezzo), modifica, riordino ed eliminazione tramite gli endpoint"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    preventivo = crea_preventivo(db, utente, dati_preventivo=_documento_salvato([
+        _riga("A", 1, 100), _riga("B", 2, 50, iva=10), _riga("C", 3, 10),
+    ]))
+    base = f"/preventivo/{preventivo.id}/righe"
+    parametri = {"user_id": utente}
+
+    app.dependency_overrides[get_db] = lambda: db
+    try:
+        client = TestClient(app)
+
+        risposta = client.post(base, params=parametri, json=_riga("D", 1, 40, iva=4))
+        assert risposta.status_code == 201 and risposta.json()["indice"] == 3
+        _controlla_documento(db, preventivo.id, ["A", "B", "C", "D"])
+
+        risposta = client.post(base, params={**parametri, "posizione": 1}, json=_riga("X", 2, 25))
+        assert risposta.status_code == 201 and risposta.json()["riga"]["numero_riga"] == 2
+        totali = _controlla_documento(db, preventivo.id, ["A", "X", "B", "C", "D"])
+        assert risposta.json()["dettagli_totali"] == totali
+
+        risposta = client.patch(f"{base}/2", params=parametri, json={"quantita": 5, "percentuale_iva": 22})
+        assert risposta.status_code == 200
+        assert risposta.json()["riga"]["subtotale_riga_netto"] == 250
+        _controlla_documento(db, preventivo.id, ["A", "X", "B", "C", "D"])
+
+        risposta = client.put(f"{base}/ordine", params=parametri, json={"ordine": [4, 3, 2, 1, 0]})
+        assert risposta.status_code == 200 and risposta.json()["numero_righe"] == 5
+        _controlla_documento(db, preventivo.id, ["D", "C", "B", "X", "A"])
+
+        risposta = client.delete(f"{base}/1", params=parametri)
+        assert risposta.status_code == 200 and risposta.json()["numero_righe"] == 4
+        totali = _controlla_documento(db, preventivo.id, ["D", "B", "X", "A"])
+        assert risposta.json()["dettagli_totali"] == totali
+
+        # Indici non validi e preventivi di altri utenti
+        assert client.patch(f"{base}/9", params=parametri, json={"quantita": 1}).status_code == 404
+        assert client.delete(f"{base}/-1", params=parametri).status_code == 404
+        assert client.put(f"{base}/ordine", params=parametri, json={"ordine": [0, 0, 1, 2]}).status_code == 400
+        assert client.post(base, params={"user_id": crea_utente(db)}, json=_riga("Z", 1, 1)).status_code == 404
+        _controlla_documento(db, preventivo.id, ["D", "B", "X", "A"])
+    finally:
+        app.dependency_overrides.pop(get_db)
+    db.close()
+    print("✅ Operazioni sulle righe con totali e numerazione salvati")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST MODIFICHE DI RIGA")
+    print("=" * 50)
+    test_operazioni_sulle_righe()
+    print("\n🎉 Tutti i test delle modifiche di riga sono passati")
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Test della scelta del template per il rendering di un preventivo
+(DocumentTemplateService.risolvi_template_preventivo). Richiedono PostgreSQL: vedi supporto_test_db.py
+
+Verifica, nell'ordine del risolutore:
+1. Template richiesto esplicitamente: quello, oppure None (404 dagli endpoint) se non esiste
+2. Template associato al preventivo, se esiste ancora
+3. Template di default esistente
+4. Template di default creato una sola volta se manca
+"""
+
+import uuid
+
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import sessionmaker
+
+from app.database import get_db_lettura
+from app.db_models import DocumentTemplate
+from app.main import app
+from app.models import DocumentTemplateCreate, ModuleComposition, PreventivoMasterModel
+from app.services.document_template_service import DocumentTemplateService
+from supporto_test_db import crea_preventivo, crea_utente, engine_test, sessione_test
+
+
+def _crea_template(db, user_id, nome, is_default=False) -> str:
+    dati = DocumentTemplateCreate(
+        name=nome,
+        module_composition=ModuleComposition(**DocumentTemplateService.DEFAULT_TEMPLATE_COMPOSITION),
+        is_default=is_default
+    )
+    return str(DocumentTemplateService(db).create_template(user_id, dati).id)
+
+
+def _documento() -> dict:
+    return PreventivoMasterModel.model_validate({
+        "metadati_preventivo": {"id_preventivo": "0b7c3f4e-8d2a-4c61-9f35-2e1a7d6b8c90", "numero_preventivo": "PREV-1", "data_emissione": "2024-06-01", "oggetto_preventivo": "Oggetto"},
+        "azienda_emittente": {"nome_azienda": "Azienda", "partita_iva_azienda": "12345678901", "indirizzo_azienda": {"via": "Via Roma 1"}, "email_azienda": "info@azienda.it"},
+        "cliente_destinatario": {"nome_cliente": "Cliente", "indirizzo": {"via": "Via Milano 2"}},
+        "corpo_preventivo": {"righe": []},
+        "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+    }).model_dump(mode="json")
+
+
+def _conta_default(db, user_id) -> int:
+    return db.query(DocumentTemplate).filter_by(user_id=uuid.UUID(user_id), is_default=True).count()
+
+
+def test_template_esplicito():
+    """Il template richiesto vince sugli altri; se non esiste (o è di un altro utente) il risultato è None"""
+    db = sessione_test()
+    utente, altro_utente = crea_utente(db), crea_utente(db)
+    esplicito = _crea_template(db, utente, "Esplicito")
+    del_preventivo = _crea_template(db, utente, "Del preventivo")
+    di_altri = _crea_template(db, altro_utente, "Di un altro utente")
+    service = DocumentTemplateService(db)
+
+    assert str(service.risolvi_template_preventivo(utente, esplicito, del_preventivo).id) == esplicito
+    assert service.risolvi_template_preventivo(utente, str(uuid.uuid4()), del_preventivo) is None
+    assert service.risolvi_template_preventivo(utente, di_altri) is None
+    assert _conta_default(db, utente) == 0  # Il default non viene creato per un template esplicito mancante
+    db.close()
+    print("✅ Template esplicito")
+
+
+def test_template_esplicito_mancante_404():
+    """GET /preventivo/{id}/visualizza con un template_id inesistente risponde 404"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    preventivo = crea_preventivo(db, utente, dati_preventivo=_documento())
+    app.dependency_overrides[get_db_lettura] = lambda: db
+    try:
+        risposta = TestClient(app).get(
+            f"/preventivo/{preventivo.id}/visualizza",
+            params={"user_id": utente, "template_id": str(uuid.uuid4())}
+        )
+    finally:
+        app.dependency_overrides.pop(get_db_lettura)
+    assert risposta.status_code == 404 and risposta.json()["detail"] == "Template non trovato"
+    assert _conta_default(db, utente) == 0
+    db.close()
+    print("✅ Template esplicito mancante: 404")
+
+
+def test_template_del_preventivo_e_default_esistente():
+    """Senza template esplicito: quello del preventivo se esiste ancora, altrimenti il default"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    default = _crea_template(db, utente, "Default", is_default=True)
+    del_preventivo = _crea_template(db, utente, "Del preventivo")
+    service = DocumentTemplateService(db)
+
+    assert str(service.risolvi_template_preventivo(utente, template_id_preventivo=del_preventivo).id) == del_preventivo
+    assert service.delete_template(del_preventivo, utente)
+    assert str(service.risolvi_template_preventivo(utente, template_id_preventivo=del_preventivo).id) == default
+    assert str(service.risolvi_template_preventivo(utente).id) == default
+    assert _conta_default(db, utente) == 1
+    db.close()
+    print("✅ Template del preventivo e default esistente")
+
+
+def test_default_creato_una_volta():
+    """Senza default ne viene creato uno, riusato dalle richieste successive anche con altre sessioni"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    _crea_template(db, utente, "Non default")
+
+    creato = DocumentTemplateService(db).risolvi_template_preventivo(utente)
+    assert creato.is_default and creato.name == "Preventivo Standard A4 Verticale"
+
+    altra_sessione = sessionmaker(bind=engine_test())()
+    assert DocumentTemplateService(altra_sessione).risolvi_template_preventivo(utente).id == creato.id
+    # Una nuova creazione non ne aggiunge un altro: restituisce lo stesso default (ON CONFLICT DO NOTHING)
+    assert DocumentTemplateService(altra_sessione).create_default_template_for_user(utente).id == creato.id
+    altra_sessione.close()
+
+    assert _conta_default(db, utente) == 1
+    db.close()
+    print("✅ Default creato una sola volta")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST RISOLUZIONE DEL TEMPLATE")
+    print("=" * 50)
+    test_template_esplicito()
+    test_template_esplicito_mancante_404()
+    test_template_del_preventivo_e_default_esistente()
+    test_default_creato_una_volta()
+    print("\n🎉 Tutti i test della risoluzione del template sono passati")
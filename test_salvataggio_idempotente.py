@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Test del salvataggio idempotente dei preventivi (PreventivoService.salva_preventivo
+e POST /preventivo/salva). Richiedono PostgreSQL: vedi supporto_test_db.py
+"""
+
+import uuid
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.database import get_db
+from app.db_models import Preventivo
+from app.main import app
+from app.models import PreventivoMasterModel
+from app.services.preventivo_service import PreventivoCestinatoError, PreventivoService
+from supporto_test_db import crea_utente, sessione_test
+
+
+def _documento(oggetto: str = "Prima versione") -> dict:
+    return {
+        "metadati_preventivo": {
+            "id_preventivo": "00000000-0000-0000-0000-000000000000",
+            "numero_preventivo": "PREV-IDEMP-001",
+            "data_emissione": "2024-06-01",
+            "oggetto_preventivo": oggetto,
+        },
+        "azienda_emittente": {
+            "nome_azienda": "Test Azienda S.r.l.",
+            "partita_iva_azienda": "12345678901",
+            "indirizzo_azienda": {"via": "Via Test 123"},
+            "email_azienda": "info@testazienda.it",
+        },
+        "cliente_destinatario": {"nome_cliente": "Cliente Test", "indirizzo": {"via": "Via Cliente 456"}},
+        "corpo_preventivo": {"righe": []},
+        "dettagli_totali": {"totale_imponibile_netto": 0, "totale_iva": 0, "totale_generale_lordo": 0},
+    }
+
+
+def _salva(db, user_id, chiave, oggetto="Prima versione"):
+    return PreventivoService(db).salva_preventivo(PreventivoMasterModel(**_documento(oggetto)), user_id, chiave)
+
+
+def test_stessa_chiave_stesso_preventivo():
+    """Due invii con la stessa chiave producono una sola riga, aggiornata dal secondo"""
+    db = sessione_test()
+    utente = crea_utente(db)
+
+    primo = _salva(db, utente, "chiave-1")
+    secondo = _salva(db, utente, "chiave-1", oggetto="Seconda versione")
+
+    assert primo.id == secondo.id
+    righe = db.query(Preventivo).filter_by(user_id=uuid.UUID(utente)).all()
+    assert len(righe) == 1 and righe[0].oggetto_preventivo == "Seconda versione"
+    # Con una chiave diversa il documento è un altro
+    assert _salva(db, utente, "chiave-2").id != primo.id
+    db.close()
+    print("✅ Stessa chiave, un solo preventivo")
+
+
+def test_chiave_di_un_preventivo_cestinato():
+    """Un nuovo invio non riporta in vita un preventivo cestinato: il servizio solleva PreventivoCestinatoError e l'API risponde 409"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    preventivo = _salva(db, utente, "chiave-cestinata")
+    PreventivoService(db).cestina_preventivo(str(preventivo.id), utente)
+
+    with pytest.raises(PreventivoCestinatoError):
+        _salva(db, utente, "chiave-cestinata", oggetto="Dopo il cestino")
+
+    app.dependency_overrides[get_db] = lambda: db
+    try:
+        risposta = TestClient(app).post(
+            "/preventivo/salva",
+            json={**_documento("Dopo il cestino"), "user_id": utente},
+            headers={"Idempotency-Key": "chiave-cestinata"},
+        )
+    finally:
+        app.dependency_overrides.pop(get_db)
+
+    assert risposta.status_code == 409
+    assert "cestino" in risposta.json()["detail"]
+    db.refresh(preventivo)
+    assert preventivo.stato_record == "cestinato" and preventivo.oggetto_preventivo == "Prima versione"
+    db.close()
+    print("✅ Chiave di un preventivo cestinato rifiutata con 409")
+
+
+def test_altri_errori_restano_400():
+    """Solo la chiave di un preventivo cestinato dà 409: gli altri ValueError del salvataggio restano 400"""
+    db = sessione_test()
+    app.dependency_overrides[get_db] = lambda: db
+    try:
+        with patch.object(PreventivoService, "salva_preventivo", side_effect=ValueError("valore non valido")):
+            risposta = TestClient(app).post("/preventivo/salva", json=_documento())
+    finally:
+        app.dependency_overrides.pop(get_db)
+    assert risposta.status_code == 400
+    db.close()
+    print("✅ Altri errori di salvataggio restano 400")
+
+if __name__ == "__main__":
+    print("🧪 TEST SALVATAGGIO IDEMPOTENTE")
+    print("=" * 50)
+    test_stessa_chiave_stesso_preventivo()
+    test_chiave_di_un_preventivo_cestinato()
+    test_altri_errori_restano_400()
+    print("\n🎉 Tutti i test del salvataggio idempotente sono passati")
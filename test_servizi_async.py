@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Test dei servizi async su AsyncSession tramite GET /dashboard/dati, che esegue le tre
+letture in parallelo (in_parallelo). Richiedono PostgreSQL: vedi supporto_test_db.py;
+la sessione async usa asyncpg sullo stesso database.
+"""
+
+import uuid
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+from app import database
+from app.db_models import Cartella
+from app.main import app
+from app.services.document_template_service import DocumentTemplateService
+from supporto_test_db import TEST_DATABASE_URL, crea_preventivo, crea_utente, sessione_test
+
+
+def _sessioni_async():
+    """Sessioni async sul database di test (NullPool: il loop del TestClient non è quello del test)"""
+    url = TEST_DATABASE_URL.replace("postgresql+psycopg2://", "postgresql+asyncpg://", 1).replace("postgresql://", "postgresql+asyncpg://", 1)
+    return async_sessionmaker(create_async_engine(url, poolclass=NullPool), autoflush=False, expire_on_commit=False)
+
+
+def test_dati_dashboard():
+    """Cartelle, prima pagina dei preventivi (con la cartella) e template dell'utente in una richiesta"""
+    db = sessione_test()
+    utente = crea_utente(db)
+    cartella = Cartella(user_id=uuid.UUID(utente), nome="Clienti 2025", ordine=0)
+    db.add(cartella)
+    db.commit()
+    in_cartella = crea_preventivo(db, utente, numero_preventivo="PREV-1", cartella_id=cartella.id)
+    crea_preventivo(db, utente, numero_preventivo="PREV-2")
+    crea_preventivo(db, utente, numero_preventivo="PREV-CESTINATO", stato_record="cestinato")
+    crea_preventivo(db, crea_utente(db), numero_preventivo="PREV-ALTRO-UTENTE")
+    template = DocumentTemplateService(db).create_default_template_for_user(utente)
+
+    with patch.object(database, "AsyncSessionLocal", _sessioni_async()):
+        client = TestClient(app)
+        risposta = client.get("/dashboard/dati", params={"user_id": utente})
+        prima_pagina = client.get("/dashboard/dati", params={"user_id": utente, "limit": 1})
+
+    assert risposta.status_code == 200
+    dati = risposta.json()
+    assert [c["nome"] for c in dati["cartelle"]] == ["Clienti 2025"]
+    assert sorted(p["numero_preventivo"] for p in dati["preventivi"]) == ["PREV-1", "PREV-2"]
+    cartelle = {p["id"]: p["cartella_nome"] for p in dati["preventivi"]}
+    assert cartelle[str(in_cartella.id)] == "Clienti 2025"
+    assert [t["id"] for t in dati["templates"]] == [str(template.id)]
+    assert "X-Next-Cursor" not in risposta.headers
+
+    assert prima_pagina.status_code == 200
+    assert len(prima_pagina.json()["preventivi"]) == 1
+    assert prima_pagina.headers["X-Next-Cursor"]
+    db.close()
+    print("✅ Dati della dashboard letti in parallelo")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST SERVIZI ASYNC")
+    print("=" * 50)
+    test_dati_dashboard()
+    print("\n🎉 Tutti i test dei servizi async sono passati")
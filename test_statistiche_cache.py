@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Test della cache delle statistiche della dashboard (app/services/statistiche_service.py)
+"""
+
+from app.models import StatistichePreventivi
+from app.services.statistiche_service import StatisticheCache
+
+UTENTE = "da2cb935-e023-40dd-9703-d918f1066b24"
+ALTRO_UTENTE = "11111111-2222-3333-4444-555555555555"
+
+
+def _statistiche(numero):
+    return StatistichePreventivi(
+        stato_record="attivo",
+        numero_preventivi=numero,
+        valore_totale_lordo=0.0,
+        per_stato=[],
+        per_cartella=[],
+        per_mese=[],
+    )
+
+
+def test_invalidazione_per_utente():
+    """Una scrittura invalida solo le statistiche dell'utente interessato"""
+    cache = StatisticheCache(ttl=60)
+    cache.salva(UTENTE, "attivo", cache.generazione(UTENTE), _statistiche(3))
+    cache.salva(UTENTE, "cestinato", cache.generazione(UTENTE), _statistiche(1))
+    cache.salva(ALTRO_UTENTE, "attivo", cache.generazione(ALTRO_UTENTE), _statistiche(7))
+    assert cache.leggi(UTENTE, "attivo").numero_preventivi == 3
+
+    cache.invalida_utente(UTENTE)
+
+    assert cache.leggi(UTENTE, "attivo") is None
+    assert cache.leggi(UTENTE, "cestinato") is None
+    assert cache.leggi(ALTRO_UTENTE, "attivo").numero_preventivi == 7
+    print("✅ Invalidazione limitata all'utente")
+
+
+def test_risultato_calcolato_prima_di_una_scrittura_non_viene_salvato():
+    """Se il preventivo cambia mentre le statistiche vengono calcolate, il risultato è scartato"""
+    cache = StatisticheCache(ttl=60)
+    generazione = cache.generazione(UTENTE)
+    cache.invalida_utente(UTENTE)  # Scrittura concorrente
+    cache.salva(UTENTE, "attivo", generazione, _statistiche(3))
+
+    assert cache.leggi(UTENTE, "attivo") is None
+    print("✅ Risultato superato non salvato")
+
+
+def test_scadenza_e_cache_disabilitata():
+    cache = StatisticheCache(ttl=-1)
+    cache.salva(UTENTE, "attivo", cache.generazione(UTENTE), _statistiche(3))
+    assert cache.leggi(UTENTE, "attivo") is None
+
+    cache = StatisticheCache(ttl=60)
+    cache.salva(UTENTE, "attivo", cache.generazione(UTENTE), _statistiche(3))
+    chiave = (UTENTE, "attivo")
+    _, generazione, statistiche = cache._voci[chiave]
+    cache._voci[chiave] = (0.0, generazione, statistiche)  # Voce scaduta
+    assert cache.leggi(UTENTE, "attivo") is None
+    print("✅ Voci scadute e cache disabilitata")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST CACHE STATISTICHE")
+    print("=" * 50)
+    test_invalidazione_per_utente()
+    test_risultato_calcolato_prima_di_una_scrittura_non_viene_salvato()
+    test_scadenza_e_cache_disabilitata()
+    print("\n🎉 Tutti i test della cache statistiche sono passati")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Test della cache dei template (app/services/template_cache.py)
+"""
+
+import uuid
+from datetime import datetime
+from unittest.mock import patch
+
+from sqlalchemy import update
+
+from app.db_models import DocumentTemplate
+from app.services.document_template_service import DocumentTemplateService
+from app.services.template_cache import TemplateCache, TemplateInCache, template_cache
+from supporto_test_db import crea_utente, sessione_test
+
+UTENTE = "da2cb935-e023-40dd-9703-d918f1066b24"
+
+
+def _template(module_composition, version=3):
+    adesso = datetime(2025, 6, 1, 12, 0, 0)
+    return DocumentTemplate(
+        id=uuid.uuid4(), user_id=uuid.UUID(UTENTE), name="Template", description=None,
+        document_type="preventivo", module_composition=module_composition, page_format="A4",
+        page_orientation="portrait", margins=None, custom_styles=None, is_default=True,
+        is_public=False, version=version, created_at=adesso, updated_at=adesso
+    )
+
+
+def test_copia_con_risposta_gia_costruita():
+    """La copia in cache mantiene il dict per il rendering e la composizione validata per l'API"""
+    composizione = {"modules": [{"module_name": "tabella_preventivo", "order": 1, "enabled": True, "custom_config": {}}]}
+    template = TemplateInCache.da_db(_template(composizione))
+
+    assert template.module_composition == composizione
+    assert template.risposta.module_composition.modules[0].module_name == "tabella_preventivo"
+    assert template.risposta.version == 3 and template.risposta.user_id == UTENTE
+
+    non_valido = TemplateInCache.da_db(_template({"modules": [{"order": "x"}]}))
+    with patch("app.services.template_cache.logger") as logger:
+        assert non_valido.risposta.module_composition.modules == []
+    assert str(non_valido.id) in logger.error.call_args.args[0]
+    print("✅ Copia del template con risposta API")
+
+
+def test_invalidazione_durante_la_lettura():
+    """Un elenco letto prima di una modifica ai template non viene salvato"""
+    cache = TemplateCache(ttl=60)
+    generazione = cache.generazione(UTENTE)
+    cache.invalida_utente(UTENTE)  # Modifica concorrente
+    cache.salva(UTENTE, generazione, [])
+    assert cache.leggi(UTENTE, []) is None
+
+    cache.salva(UTENTE, cache.generazione(UTENTE), [])
+    assert cache.leggi(UTENTE, []) == []
+    cache.invalida_utente(UTENTE)
+    assert cache.leggi(UTENTE, []) is None
+    print("✅ Invalidazione per utente")
+
+
+def test_versioni_cambiate():
+    """Una voce vale solo se le coppie (id, version) lette dal database coincidono con quelle in cache"""
+    cache = TemplateCache(ttl=60)
+    templates = [TemplateInCache.da_db(_template({}, version=3)), TemplateInCache.da_db(_template({}, version=1))]
+    versioni = [(t.id, t.version) for t in templates]
+    cache.salva(UTENTE, cache.generazione(UTENTE), templates)
+
+    assert cache.leggi(UTENTE, reversed(versioni)) == templates
+    assert cache.leggi(UTENTE, [(str(id_), version) for id_, version in versioni]) == templates
+    assert cache.leggi(UTENTE, versioni + [(uuid.uuid4(), 1)]) is None  # Template aggiunto altrove
+
+    cache.salva(UTENTE, cache.generazione(UTENTE), templates)
+    assert cache.leggi(UTENTE, [versioni[0], (versioni[1][0], 2)]) is None  # Template modificato altrove
+    print("✅ Versioni verificate a ogni lettura")
+
+
+def test_modifica_da_un_altra_istanza():
+    """Un template modificato da un'altra istanza (senza invalidare questa cache) viene riletto (PostgreSQL)"""
+    db = sessione_test()
+    user_id = crea_utente(db)
+    service = DocumentTemplateService(db)
+    template = service.create_default_template_for_user(user_id)
+    template_id, versione = str(template.id), template.version
+    assert service.template_default(user_id).name == "Preventivo Standard A4 Verticale"
+
+    # Scrittura diretta, come da un altro worker: questa istanza non riceve l'invalidazione
+    generazione = template_cache.generazione(user_id)
+    db.execute(update(DocumentTemplate).where(DocumentTemplate.id == template_id).values(name="Modificato altrove", version=versione + 1))
+    db.commit()
+    assert template_cache.generazione(user_id) == generazione
+
+    assert service.template_default(user_id).name == "Modificato altrove"
+    assert service.template_per_id(template_id, user_id).version == versione + 1
+    db.close()
+    print("✅ Modifica di un'altra istanza rilevata")
+
+
+if __name__ == "__main__":
+    print("🧪 TEST CACHE TEMPLATE")
+    print("=" * 50)
+    test_copia_con_risposta_gia_costruita()
+    test_invalidazione_durante_la_lettura()
+    test_versioni_cambiate()
+    test_modifica_da_un_altra_istanza()
+    print("\n🎉 Tutti i test della cache template sono passati")